@@ -58,6 +58,7 @@ chatter = ArduFSM.chat.Chatter(to_user=logfilename, to_user_dir='./logfiles',
     baud_rate=115200, serial_timeout=.1, 
     serial_port=runner_params['serial_port'])
 logfilename = chatter.ofi.name
+log_follower = TrialSpeak.LogFollower(logfilename)
 
 params = {
             'SRVFAR' : 1100,
@@ -125,10 +126,11 @@ try:
         # Update chatter
         chatter.update(echo_to_stdout=ECHO_TO_STDOUT)
         
-        # Read lines and split by trial
-        # Could we skip this step if chatter reports no new device lines?
-        logfile_lines = TrialSpeak.read_lines_from_file(logfilename)
-        splines = TrialSpeak.split_by_trial(logfile_lines)
+        # Read new lines and split by trial
+        # Only the lines appended since the last tick are read
+        log_follower.update()
+        logfile_lines = log_follower.lines
+        splines = log_follower.splines
 
         #~ except ValueError:
             #~ raise ValueError("cannot get any lines; try reuploading protocol")
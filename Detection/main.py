@@ -82,20 +82,24 @@ try:
         plotter2 = ArduFSM.plot.LickPlotter()
         plotter2.init_handles()
         last_updated_trial = 0
+        
+        # Only the plots read the log
+        log_follower = TrialSpeak.LogFollower(logfilename)
     
     while True:
         ## Chat updates
         # Update chatter
         chatter.update(echo_to_stdout=ECHO_TO_STDOUT)
-        
-        # Read lines and split by trial
-        # Could we skip this step if chatter reports no new device lines?
-        #~ logfile_lines = TrialSpeak.read_lines_from_file(logfilename)
-        #~ splines = TrialSpeak.split_by_trial(logfile_lines)
 
         ## Update GUI
         # Put this in it's own try/except to catch plotting bugs
         if RUN_GUI:
+            # Read new lines and split by trial
+            # Only the lines appended since the last tick are read
+            log_follower.update()
+            logfile_lines = log_follower.lines
+            splines = log_follower.splines
+            
             if last_updated_trial < len(translated_trial_matrix):
                 # update plot
                 plotter.update(logfilename)     
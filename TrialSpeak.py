@@ -5,6 +5,13 @@ them by trial, and also for generating commands to send to the arduino.
 """
 import pandas, numpy as np, my
 import StringIO
+import os
+import json
+import zlib
+try:
+    import lzma
+except ImportError:
+    lzma = None
 
 ack_token = 'ACK'
 release_trial_token = 'RELEASE_TRL'
@@ -30,6 +37,15 @@ YES = 3
 NO = 2
 MD = 0 # "must-define"
 
+# shorthand column names in the trial matrix and their translations
+translated_column_names = {
+    'rwsd': 'rewside',
+    'resp': 'choice',
+    'outc': 'outcome',
+    'srvpos': 'servo_pos',
+    'stppos': 'stepper_pos',
+    }
+
 ## Reading functions
 def load_splines_from_file(filename):
     """Reads lines from file and split into list of lists by trial"""
@@ -74,11 +90,540 @@ def split_by_trial(lines):
     return splines
     
 def read_lines_from_file(filename):
-    """Reads all lines from file and returns as list"""
+    """Reads all lines from file and returns as list
+    
+    Logs compressed by Chatter (ending in .gz or .xz) are decompressed.
+    Segmented logs (see get_log_segments) are read from all segments.
+    """
+    segments = get_log_segments(filename)
+    if segments is not None:
+        lines = []
+        for segment in segments:
+            lines.extend(read_lines_from_file(segment['filename']))
+        return lines
+    
+    if get_log_compression(filename) is not None:
+        return StringIO.StringIO(read_logfile_data(filename)).readlines()
+    
     with file(filename) as fi:
         lines = fi.readlines()
     return lines
 
+## Compressed logfiles
+# Extensions of logs compressed by Chatter. See chat.CompressedLogFile.
+compressed_log_suffixes = {'.gz': 'gzip', '.xz': 'lzma'}
+
+def get_log_compression(filename):
+    """Returns 'gzip' or 'lzma' if filename is a compressed log, else None"""
+    return compressed_log_suffixes.get(os.path.splitext(filename)[1])
+
+class LogDecompressor(object):
+    """Decompresses a log incrementally, as it is read.
+    
+    Handles logs that are still being written, ie, that end partway through
+    a stream, and logs made of several concatenated streams, which is how
+    Chatter flushes lzma logs.
+    """
+    def __init__(self, compression):
+        if compression == 'lzma' and lzma is None:
+            raise IOError("reading lzma logs requires Python 3")
+        self.compression = compression
+        self.decompressor = self.make_decompressor()
+    
+    def make_decompressor(self):
+        if self.compression == 'gzip':
+            # wbits of 16 + MAX_WBITS expects a gzip header and trailer
+            return zlib.decompressobj(16 + zlib.MAX_WBITS)
+        return lzma.LZMADecompressor(lzma.FORMAT_XZ)
+    
+    def decompress(self, data):
+        """Returns the decompressed text of `data`, the next compressed bytes"""
+        res = []
+        while len(data) > 0:
+            # Begin a new stream if the last one ended
+            if getattr(self.decompressor, 'eof', False):
+                self.decompressor = self.make_decompressor()
+            res.append(self.decompressor.decompress(data))
+            data = self.decompressor.unused_data
+            if len(data) > 0:
+                self.decompressor = self.make_decompressor()
+        return b''.join(res)
+
+def read_logfile_data(filename):
+    """Returns the text of a logfile, decompressing it if necessary"""
+    compression = get_log_compression(filename)
+    with file(filename, 'rb') as fi:
+        data = fi.read()
+    if compression is None:
+        return data
+    return LogDecompressor(compression).decompress(data)
+
+## Segmented logfiles
+# The manifest of a segmented log. This must match chat.log_manifest_suffix.
+log_manifest_suffix = '.manifest.json'
+
+def get_log_segments(filename):
+    """Returns the segments of a log written by Chatter(log_segment_size=...)
+    
+    filename : the name of the log, without any segment number
+    
+    Returns: None if this is not a segmented log. Otherwise, a list of
+    dicts, one per segment in order, with the keys
+        filename : full path to the segment
+        first_time, last_time : device time of the first and last lines
+        first_trial, last_trial : trial in progress at the first and last
+            lines. Lines before the first TRL_START are trial -1.
+        n_lines, n_bytes : size of the segment
+        complete : False for the segment still being written, whose 
+            last_time and last_trial are out of date
+    """
+    manifest_filename = filename + log_manifest_suffix
+    if not os.path.exists(manifest_filename):
+        return None
+    with file(manifest_filename) as fi:
+        segments = json.load(fi)['segments']
+    
+    # Filenames are relative to the manifest
+    dirname = os.path.dirname(filename)
+    for segment in segments:
+        segment['filename'] = os.path.join(dirname, segment['filename'])
+    return segments
+
+def read_lines_for_trials(filename, first_trial, last_trial):
+    """Reads the lines of trials first_trial to last_trial, inclusive.
+    
+    Trials are numbered as in read_logfile_into_df. Each trial begins with
+    its TRL_START line, as in split_by_trial.
+    
+    For a segmented log, only the segments containing those trials are
+    read. Otherwise, the whole log is read.
+    """
+    segments = get_log_segments(filename)
+    if segments is None:
+        lines = read_lines_from_file(filename)
+        trial = -1
+    else:
+        # The segment being written may extend past its last_trial
+        segments = [segment for segment in segments
+            if segment['first_trial'] <= last_trial and (
+            segment['last_trial'] >= first_trial or not segment['complete'])]
+        if len(segments) == 0:
+            return []
+        lines = []
+        for segment in segments:
+            lines.extend(read_lines_from_file(segment['filename']))
+        trial = segments[0]['first_trial']
+    
+    res = []
+    for line in lines:
+        sp_line = line.split(None, 2)
+        if len(sp_line) > 1 and sp_line[1] == start_trial_token:
+            trial += 1
+            if trial > last_trial:
+                break
+        if trial >= first_trial:
+            res.append(line)
+    return res
+
+class LogFollower(object):
+    """Follows a logfile that is being appended to, eg by Chatter.
+
+    Rather than re-reading the whole file on every call, this keeps a byte
+    offset into the file and only reads what was appended since the last
+    call to `update`. A trailing line without a newline (ie, one that
+    Chatter is still writing) is held back until it is complete.
+
+    Compressed logs (see get_log_compression) are decompressed as they
+    are read. Segmented logs (see get_log_segments) are followed from one
+    segment to the next, and old segments are never read again.
+
+    The accumulated lines are available as `lines`, and the same lines
+    split by trial as `splines`. `splines` is kept identical to
+    split_by_trial(lines), but is extended in place, so each call costs
+    O(new lines) regardless of how long the session has run.
+
+    Usage in a main loop:
+        log_follower = TrialSpeak.LogFollower(logfilename)
+        while True:
+            chatter.update()
+            new_lines = log_follower.update()
+            logfile_lines = log_follower.lines
+            splines = log_follower.splines
+    """
+    def __init__(self, filename):
+        self.filename = filename
+
+        # For a segmented log, the segments, and which is being read
+        self.segments = None
+        self.manifest_stat = None
+        self.segment_index = 0
+
+        # Byte offset into the file of the first unread character
+        self.offset = 0
+
+        # Any incomplete line read at the end of the file
+        self.partial_line = ''
+
+        # Compressed logs are decompressed incrementally
+        self.decompressor = None
+        self.start_file(self.get_current_filename())
+
+        # Everything read so far, and the same split by trial
+        self.lines = []
+        self.splines = [[]]
+
+    def update_segments(self):
+        """Re-read the manifest of a segmented log, if it has changed"""
+        try:
+            st = os.stat(self.filename + log_manifest_suffix)
+        except OSError:
+            return
+        manifest_stat = (st.st_mtime, st.st_size, st.st_ino)
+        if manifest_stat != self.manifest_stat:
+            self.segments = get_log_segments(self.filename)
+            self.manifest_stat = manifest_stat
+
+    def get_current_filename(self):
+        """Returns the file being read: the log, or its current segment"""
+        self.update_segments()
+        if self.segments is None:
+            return self.filename
+        return self.segments[self.segment_index]['filename']
+
+    def start_file(self, filename):
+        """Begin reading `filename` from the start"""
+        self.offset = 0
+        self.decompressor = None
+        compression = get_log_compression(filename)
+        if compression is not None:
+            self.decompressor = LogDecompressor(compression)
+
+    def read_new_data(self, filename):
+        """Returns the text appended to `filename` since the last call"""
+        with file(filename, 'rb') as fi:
+            # If the file shrank, it was replaced, so start over
+            fi.seek(0, 2)
+            if fi.tell() < self.offset:
+                self.reset()
+                return ''
+
+            fi.seek(self.offset)
+            data = fi.read()
+            self.offset = fi.tell()
+
+        if self.decompressor is not None:
+            data = self.decompressor.decompress(data)
+        return data
+
+    def read_new_lines(self):
+        """Returns complete lines appended since the last call.
+
+        Does not update `lines` or `splines`; use `update` for that.
+        """
+        data = self.read_new_data(self.get_current_filename())
+
+        # Once a later segment has begun, the current one is complete, so
+        # we have read all of it and can move on
+        while (self.segments is not None and 
+            self.segment_index < len(self.segments) - 1):
+            self.segment_index += 1
+            filename = self.get_current_filename()
+            self.start_file(filename)
+            data = data + self.read_new_data(filename)
+
+        if len(data) == 0:
+            return []
+
+        # Prepend anything left over from last time, and hold back any
+        # incomplete line at the end
+        new_lines = (self.partial_line + data).splitlines(True)
+        if new_lines[-1].endswith('\n'):
+            self.partial_line = ''
+        else:
+            self.partial_line = new_lines.pop()
+
+        return new_lines
+
+    def update(self):
+        """Read newly appended lines and add them to `lines` and `splines`.
+
+        Returns: list of the new lines
+        """
+        new_lines = self.read_new_lines()
+
+        # Extend splines in the same way as split_by_trial
+        for line in new_lines:
+            sp_line = line.split()
+            if len(sp_line) > 1 and sp_line[1] == start_trial_token:
+                self.splines.append([])
+            self.splines[-1].append(line)
+
+        self.lines.extend(new_lines)
+        return new_lines
+
+    def reset(self):
+        """Forget everything read so far and start from the beginning"""
+        self.partial_line = ''
+        self.lines = []
+        self.splines = [[]]
+        self.segment_index = 0
+        self.start_file(self.get_current_filename())
+
+
+## Side stream
+# High-rate lines that Chatter(side_stream_prefixes=...) routed away from 
+# the log. This must match chat.side_stream_suffix.
+side_stream_suffix = '.side'
+
+def get_side_stream_filename(filename):
+    """Returns the side stream of the ardulines file `filename`, or None.
+    
+    The side stream has its own compression suffix if the log was
+    compressed.
+    """
+    side_filename = filename + side_stream_suffix
+    for suffix in [''] + sorted(compressed_log_suffixes.keys()):
+        if os.path.exists(side_filename + suffix):
+            return side_filename + suffix
+    return None
+
+def read_side_lines(filename):
+    """Reads the side stream of the ardulines file `filename`.
+    
+    These are TrialSpeak lines like those in the log, eg 'DBG L:...' or
+    'SENH', so the same parsers work on them. The device timestamps put
+    them in order with the log's lines.
+    
+    Returns: list of lines, empty if there is no side stream
+    """
+    side_filename = get_side_stream_filename(filename)
+    if side_filename is None:
+        return []
+    return read_lines_from_file(side_filename)
+
+
+## Host timestamps
+# Record format of the sidecar written by Chatter(host_timestamps=True).
+# This must match chat.host_timestamp_struct.
+host_timestamp_dtype = np.dtype([('host_time_ns', '<i8'), ('offset', '<u8')])
+host_timestamps_suffix = '.times'
+
+def read_host_timestamps(filename):
+    """Read the host timestamps sidecar written by Chatter.
+    
+    filename : the sidecar, or the ardulines file it belongs to
+    
+    Each record is the monotonic host time in nanoseconds at which Chatter
+    received a line, and the byte offset of that line in the ardulines
+    file. A partially written record at the end is ignored. The clock is
+    only comparable within one boot of the host; see
+    chat.make_monotonic_clock, and Chatter.get_wall_clock_offset to
+    convert to wall clock time.
+    
+    Returns: DataFrame with columns host_time_ns and offset
+    """
+    if not filename.endswith(host_timestamps_suffix):
+        filename = filename + host_timestamps_suffix
+    with file(filename, 'rb') as fi:
+        data = fi.read()
+    
+    n_records = len(data) // host_timestamp_dtype.itemsize
+    records = np.frombuffer(data, dtype=host_timestamp_dtype, 
+        count=n_records)
+    return pandas.DataFrame(records)
+
+def get_host_times_of_lines(lines, host_timestamps):
+    """Join host timestamps onto lines that have already been read.
+    
+    This does not re-read the logfile: the byte offset of each line is
+    computed from the lengths of `lines`, and matched to the offsets in
+    the sidecar.
+    
+    lines : every line of the logfile from the beginning, eg from
+        read_lines_from_file or LogFollower.lines
+    host_timestamps : result of read_host_timestamps
+    
+    Returns: array of host times in seconds, one per line. Lines without
+        a record (eg, written before the sidecar was enabled) are nan.
+    """
+    # Byte offset of the start of each line
+    line_lengths = np.array([len(line) for line in lines], dtype=np.int64)
+    line_offsets = np.cumsum(line_lengths) - line_lengths
+    
+    res = np.nan * np.ones(len(lines))
+    if len(host_timestamps) == 0:
+        return res
+    
+    # Find each line offset in the sidecar offsets, which are sorted
+    sidecar_offsets = host_timestamps['offset'].values.astype(np.int64)
+    idxs = np.searchsorted(sidecar_offsets, line_offsets)
+    idxs[idxs == len(sidecar_offsets)] = 0
+    found = sidecar_offsets[idxs] == line_offsets
+    
+    res[found] = host_timestamps['host_time_ns'].values[idxs[found]] / 1e9
+    return res
+
+
+## Binary records
+# After "BINARY 1", the device can send records as COBS-encoded frames
+# between zero bytes, instead of text lines. Chatter(binary_frames=True)
+# separates them from the text and writes them to a sidecar.
+# See libraries/chat/chat.h for the format.
+#
+# The name and field names of each record type, keyed by type byte.
+# This must match the arduino code.
+binary_record_formats = {
+    ord('I'): ('IR', ('l_c', 'l_m', 'l_x', 'r_c', 'r_m', 'r_x')),
+}
+binary_frames_suffix = '.frames'
+
+def get_binary_record_dtype(field_names):
+    """Returns the dtype of a decoded record with `field_names`"""
+    return np.dtype([('type', 'u1'), ('time', '<u4')] + 
+        [(field_name, '<i2') for field_name in field_names] + 
+        [('crc', '<u2')])
+
+def make_crc16_table():
+    """Returns the lookup table for CRC-16/CCITT-FALSE"""
+    table = np.zeros(256, dtype=np.uint16)
+    for n in range(256):
+        crc = n << 8
+        for bit in range(8):
+            if crc & 0x8000:
+                crc = ((crc << 1) ^ 0x1021) & 0xFFFF
+            else:
+                crc = (crc << 1) & 0xFFFF
+        table[n] = crc
+    return table
+crc16_table = make_crc16_table()
+
+def crc16_ccitt(rows):
+    """CRC-16/CCITT-FALSE of each row of a 2d uint8 array, as in chat.cpp
+    
+    The rows are processed together, one column at a time.
+    """
+    crc = np.ones(len(rows), dtype=np.uint16) * np.uint16(0xFFFF)
+    for ncol in range(rows.shape[1]):
+        crc = (crc << 8) ^ crc16_table[(crc >> 8) ^ rows[:, ncol]]
+    return crc
+
+def cobs_decode_rows(encoded):
+    """COBS-decode each row of a 2d uint8 array of equal-length frames.
+    
+    The frames must be shorter than 255 bytes, so that every code byte
+    stands for a zero, except the one that reaches the end of the frame.
+    The rows are processed together, one code byte at a time.
+    
+    Returns: decoded rows, one byte shorter than `encoded`, and a boolean
+        array of which rows were valid
+    """
+    n_rows, width = encoded.shape
+    decoded = encoded[:, 1:].copy()
+    valid = np.ones(n_rows, dtype=np.bool_)
+    
+    # Position of the current code byte in each row
+    code_idx = np.zeros(n_rows, dtype=np.intp)
+    active = np.arange(n_rows)
+    while len(active) > 0:
+        next_code_idx = code_idx[active] + encoded[active, code_idx[active]]
+        
+        # A code that overruns the frame is invalid
+        overrun = next_code_idx > width
+        valid[active[overrun]] = False
+        
+        # The others within the frame point to a byte that was a zero
+        within = next_code_idx < width
+        active = active[within]
+        code_idx[active] = next_code_idx[within]
+        decoded[active, code_idx[active] - 1] = 0
+    return decoded, valid
+
+def decode_binary_frames(data, record_formats=None):
+    """Decodes a chunk of binary frames into arrays of records.
+    
+    data : string of COBS-encoded frames, each followed by a zero byte, 
+        and optionally preceded by one, as sent by the device
+    record_formats : dict like binary_record_formats. If None, that is
+        used.
+    
+    Frames of the same length are decoded together, so a chunk of many
+    frames takes a few array operations rather than a loop over frames.
+    Frames that fail the COBS decoding or the CRC, or whose type or length
+    is unknown, are dropped and counted. An incomplete frame at the end of
+    `data` is ignored.
+    
+    Returns: records, n_invalid
+        records : dict from record name to a structured array with fields
+            'type', 'time' (device millis), the record's fields, and 'crc'
+        n_invalid : the number of frames that were dropped
+    """
+    if record_formats is None:
+        record_formats = binary_record_formats
+    
+    # The dtype and encoded length of each record type
+    type2dtype = {}
+    for record_type, (name, field_names) in record_formats.items():
+        type2dtype[record_type] = get_binary_record_dtype(field_names)
+    records = dict([(name, np.zeros(0, dtype=type2dtype[record_type]))
+        for record_type, (name, field_names) in record_formats.items()])
+    
+    # Find the frames between zero bytes
+    arr = np.frombuffer(data, dtype=np.uint8)
+    zero_idxs = np.concatenate([[-1], np.flatnonzero(arr == 0)])
+    starts = zero_idxs[:-1] + 1
+    lengths = zero_idxs[1:] - starts
+    
+    # Consecutive zeros, between frames, are not frames
+    starts = starts[lengths > 0]
+    lengths = lengths[lengths > 0]
+    n_invalid = 0
+    
+    for length in np.unique(lengths):
+        # Gather all frames of this length into rows
+        frame_starts = starts[lengths == length]
+        encoded = arr[frame_starts[:, None] + np.arange(length)]
+        decoded, valid = cobs_decode_rows(encoded)
+        n_invalid += np.sum(~valid)
+        decoded = decoded[valid]
+        
+        # Record types of this length
+        known = np.zeros(len(decoded), dtype=np.bool_)
+        for record_type, dtype in type2dtype.items():
+            if dtype.itemsize != length - 1:
+                continue
+            msk = decoded[:, 0] == record_type
+            rows = decoded[msk]
+            
+            # The CRC is stored after everything it covers
+            crc = rows[:, -2].astype(np.uint16) | (
+                rows[:, -1].astype(np.uint16) << 8)
+            crc_ok = crc16_ccitt(rows[:, :-2]) == crc
+            n_invalid += np.sum(~crc_ok)
+            known[msk] = True
+            
+            name = record_formats[record_type][0]
+            rows = np.ascontiguousarray(rows[crc_ok])
+            records[name] = np.concatenate([records[name],
+                rows.view(dtype).reshape(-1)])
+        n_invalid += np.sum(~known)
+    return records, int(n_invalid)
+
+def read_binary_records(filename, record_formats=None):
+    """Read the binary frames sidecar written by Chatter.
+    
+    filename : the sidecar, or the ardulines file it belongs to
+    
+    Returns: dict from record name to structured array. 
+        See decode_binary_frames.
+    """
+    if not filename.endswith(binary_frames_suffix):
+        filename = filename + binary_frames_suffix
+    with file(filename, 'rb') as fi:
+        data = fi.read()
+    
+    records, n_invalid = decode_binary_frames(data, record_formats)
+    return records
+
 
 ## Parsing functions
 def parse_lines_into_df(lines):
@@ -186,13 +731,7 @@ def my_replace(ser, d, nanval='nanval'):
 def translate_trial_matrix(trial_matrix):
     """Replace shorthand with longhand, eg, resp -> response."""
     trial_matrix = trial_matrix.copy()
-    trial_matrix = trial_matrix.rename(columns={
-        'rwsd': 'rewside',
-        'resp': 'choice',
-        'outc': 'outcome',
-        'srvpos': 'servo_pos',
-        'stppos': 'stepper_pos'
-        })
+    trial_matrix = trial_matrix.rename(columns=translated_column_names)
     
     
     # How to deal with current trial here?
@@ -426,6 +965,10 @@ def command_release_trial():
     """Returns the command to use to release the current trial."""
     return release_trial_token
 
+def command_binary_mode(enabled=True):
+    """Returns the command to turn the device's binary records on or off."""
+    return 'BINARY %d' % int(bool(enabled))
+
 
 
 
@@ -606,6 +1149,201 @@ def make_trials_matrix_from_logfile_lines2(logfile_lines,
     return res
 
 
+class IncrementalTrialMatrix(object):
+    """Builds the translated trial matrix incrementally from new lines.
+
+    This produces the same result as
+        translate_trial_matrix(make_trials_matrix_from_logfile_lines2(lines))
+    but each call to `update` only parses the lines it is given, and only
+    writes the values they carry, so the cost of an update does not grow
+    with the number of trials in the session.
+
+    The trials are stored in a preallocated DataFrame whose columns are
+    already in their final order and translated form. Each value is
+    translated once, as its line arrives, and written into the row of the
+    trial in progress. That row takes values until the next TRL_START: 
+    its TRLR lines, and then the TRL_RELEASED that the device logs just
+    before releasing the next trial, which is taken as its release_time
+    as in make_trials_matrix_from_logfile_lines2. When the storage is 
+    full its capacity is doubled, and when a new parameter appears a 
+    column is added, so both are rare.
+
+    Lines before the first TRL_START are setup info and are ignored, as
+    are lines that do not begin with an integer time.
+
+    The result is a view of the first rows of the storage, so it is
+    shared between consumers (trial setter, plotters, schedulers) and
+    changes as lines arrive. They should copy it before modifying it or
+    keeping it.
+
+    Usage:
+        itm = TrialSpeak.IncrementalTrialMatrix()
+        while True:
+            new_lines = log_follower.update()
+            translated_trial_matrix = itm.update(new_lines)
+    """
+    # Translated columns that are not floats, with their dtype and the
+    # value of a row that lacks them, as translate_trial_matrix leaves it
+    column_defaults = {
+        'outcome': (np.object, 'curr'),
+        'choice': (np.object, 'curr'),
+        'rewside': (np.object, 'nanval'),
+        'isrnd': (np.bool_, False),
+        }
+    
+    # How translate_trial_matrix translates each value
+    value_translations = {
+        'outcome': {HIT: 'hit', ERROR: 'error', SPOIL: 'spoil'},
+        'choice': {LEFT: 'left', RIGHT: 'right', NOGO: 'nogo'},
+        'rewside': {LEFT: 'left', RIGHT: 'right', NOGO: 'nogo'},
+        }
+    
+    def __init__(self, always_insert=('resp', 'outc'), initial_capacity=256):
+        """Initialize a new, empty IncrementalTrialMatrix.
+
+        always_insert : columns that are always inserted, even if they
+            weren't present, as in make_trials_matrix_from_logfile_lines2
+        initial_capacity : number of trials to allocate storage for
+        """
+        self.always_insert = always_insert
+        self.initial_capacity = initial_capacity
+
+        # The trial currently receiving lines
+        self.current_trial = -1
+
+        # Translated storage, allocated at the first trial
+        self.storage = None
+
+        # Every untranslated column name seen so far, for ordering
+        self.column_names = set()
+
+        # The most recent result
+        self.translated_trial_matrix = self._make_empty_trial_matrix()
+
+    def _make_empty_trial_matrix(self):
+        """Translated trial matrix to return before the first trial"""
+        return translate_trial_matrix(pandas.DataFrame(
+            np.zeros((0, len(self.always_insert))),
+            columns=self.always_insert))
+
+    def _make_column(self, col, capacity, old_values=None):
+        """Returns a column of `capacity` rows, holding `old_values` first"""
+        dtype, default = self.column_defaults.get(col, (np.float, np.nan))
+        values = np.empty(capacity, dtype=dtype)
+        values[:] = default
+        if old_values is not None:
+            values[:len(old_values)] = old_values
+        return values
+
+    def _allocate(self, capacity):
+        """Make storage for `capacity` trials, keeping what is stored"""
+        columns = self._get_ordered_columns()
+        data = {}
+        for col in columns:
+            old_values = None
+            if self.storage is not None and col in self.storage:
+                old_values = self.storage[col].values[
+                    :self.current_trial + 1]
+            data[col] = self._make_column(col, capacity, old_values)
+        self.storage = pandas.DataFrame(data, columns=columns,
+            index=pandas.Index(np.arange(capacity), name='trial'))
+
+    def _get_ordered_columns(self):
+        """Return the translated column names in the usual order.
+
+        This follows make_trials_matrix_from_logfile_lines2: timings first,
+        then the sorted shorthand names, then any missing always_insert.
+        """
+        ordered_cols = ['start_time', 'release_time', 'duration']
+        for col in sorted(self.column_names):
+            if col not in ordered_cols:
+                ordered_cols.append(col)
+        for col in self.always_insert:
+            if col not in ordered_cols:
+                ordered_cols.append(col)
+
+        return [translated_column_names.get(col, col) 
+            for col in ordered_cols]
+
+    def _set_value(self, name, value):
+        """Translate `value` of column `name`, and store it for this trial"""
+        if name not in self.column_names:
+            # Add the column, or move it to its place among the others
+            self.column_names.add(name)
+            if list(self.storage.columns) != self._get_ordered_columns():
+                self._allocate(len(self.storage))
+        col = translated_column_names.get(name, name)
+        
+        if col == 'isrnd':
+            value = value == YES
+        elif col in self.value_translations:
+            value = self.value_translations[col].get(value, value)
+        self.storage.iat[self.current_trial, 
+            self.storage.columns.get_loc(col)] = value
+
+    def _start_trial(self, start_time):
+        """Begin the row of the next trial"""
+        self.current_trial += 1
+        if self.storage is None:
+            self._allocate(self.initial_capacity)
+        elif self.current_trial >= len(self.storage):
+            # Include the new trial in what is kept
+            self._allocate(2 * len(self.storage))
+        self._set_value('start_time', start_time)
+
+    def update(self, new_lines):
+        """Parse new_lines and return the updated translated trial matrix.
+
+        new_lines : lines appended to the logfile since the last call,
+            eg from LogFollower.update
+        """
+        changed = False
+        for line in new_lines:
+            sp_line = line.split()
+            if len(sp_line) < 2:
+                continue
+            try:
+                time = int(sp_line[0])
+            except ValueError:
+                continue
+            command = sp_line[1]
+
+            if command == start_trial_token:
+                self._start_trial(time / 1000.)
+                changed = True
+
+            elif self.current_trial < 0:
+                # Setup info before the first trial
+                continue
+
+            elif command == trial_released_token:
+                release_time = time / 1000.
+                self._set_value('release_time', release_time)
+                start_time = self.storage['start_time'].values[
+                    self.current_trial]
+                self._set_value('duration', release_time - start_time)
+                changed = True
+
+            elif command in (trial_param_token, trial_result_token):
+                if len(sp_line) != 4:
+                    continue
+                try:
+                    value = float(sp_line[3])
+                except ValueError:
+                    continue
+                self._set_value(sp_line[2].lower(), value)
+                changed = True
+
+        if changed:
+            self.translated_trial_matrix = self.storage.iloc[
+                :self.current_trial + 1]
+
+        return self.translated_trial_matrix
+
+    def __len__(self):
+        return self.current_trial + 1
+
+
 def read_logfile_into_df(logfile, nargs=4, add_trial_column=True):
     """Read logfile into a DataFrame
     
@@ -641,6 +1379,13 @@ def read_logfile_into_df(logfile, nargs=4, add_trial_column=True):
     
     # Read. Important to avoid reading header of index or you can get
     # weird errors here, like unnamed columns.
+    # Compressed logs are decompressed here, rather than by pandas, so
+    # that logs that are still being written can be read.
+    # Segmented logs are joined back together.
+    if isinstance(logfile, basestring) and (
+        get_log_compression(logfile) is not None or 
+        get_log_segments(logfile) is not None):
+        logfile = StringIO.StringIO(''.join(read_lines_from_file(logfile)))
     rdf = pandas.read_table(logfile, sep=' ', names=all_cols, 
         index_col=False, header=None)
     if not np.all(rdf.columns == all_cols):
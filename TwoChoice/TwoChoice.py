@@ -154,8 +154,11 @@ scheduler = scheduler_obj(trial_types=trial_types, reverse_srvpos=True)
 logfilename = None # autodate
 chatter = ArduFSM.chat.Chatter(to_user=logfilename, to_user_dir='./logfiles',
     baud_rate=115200, serial_timeout=.1, 
-    serial_port=runner_params['serial_port'])
+    serial_port=runner_params['serial_port'],
+    ack_window_size=8, ack_window_bytes=64, ack_timeout=1.0,
+    latency_snapshot_interval=60, log_flush_interval=0.25)
 logfilename = chatter.ofi.name
+log_follower = TrialSpeak.LogFollower(logfilename)
 
 
 ## Reset video filename
@@ -224,6 +227,8 @@ try:
         if SHOW_IR_PLOT:
             plotter2 = ArduFSM.plot.LickPlotter()
             plotter2.init_handles()
+            lick_events = ArduFSM.chat.DeviceEventRecorder(maxlen=10000)
+            chatter.event_bus.subscribe(lick_events, ['DBG', 'TCH'])
             if window_position_IR_plot is not None:
                 move_figure(plotter2.handles['f'],
                     window_position_IR_plot[0], window_position_IR_plot[1])
@@ -231,6 +236,8 @@ try:
         if SHOW_SENSOR_PLOT:
             sensor_plotter = ArduFSM.plot.SensorPlotter()
             sensor_plotter.init_handles()
+            sensor_events = ArduFSM.chat.DeviceEventRecorder(maxlen=10000)
+            chatter.event_bus.subscribe(sensor_events, ['SENH'])
         
         last_updated_trial = 0
     
@@ -248,10 +255,11 @@ try:
         # Update chatter
         chatter.update(echo_to_stdout=ECHO_TO_STDOUT)
         
-        # Read lines and split by trial
-        # Could we skip this step if chatter reports no new device lines?
-        logfile_lines = TrialSpeak.read_lines_from_file(logfilename)
-        splines = TrialSpeak.split_by_trial(logfile_lines)
+        # Read new lines and split by trial
+        # Only the lines appended since the last tick are read
+        log_follower.update()
+        logfile_lines = log_follower.lines
+        splines = log_follower.splines
 
         # Run the trial setting logic
         # This try/except is no good because it conflates actual
@@ -271,11 +279,13 @@ try:
         if RUN_GUI:
             if last_updated_trial < len(translated_trial_matrix):
                 # update plot
-                plotter.update(logfilename)     
+                plotter.update(logfilename, translated_trial_matrix,
+                    logfile_lines, splines)
                 last_updated_trial = len(translated_trial_matrix)
             
                 if SHOW_SENSOR_PLOT:
-                    sensor_plotter.update(logfile_lines)
+                    sensor_plotter.update(logfile_lines, 
+                        event_recorder=sensor_events)
                 
                 # When there are multiple figures to show, it can be
                 # hard to make it update both of them. this seems to
@@ -284,7 +294,8 @@ try:
                 plotter.graphics_handles['f'].canvas.draw()
 
             if SHOW_IR_PLOT:
-                plotter2.update(logfile_lines)
+                plotter2.update(logfile_lines, 
+                    event_recorder=lick_events)
                 
                 #~ plt.pause(.01)
                 plotter2.handles['f'].canvas.draw()
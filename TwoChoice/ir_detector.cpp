@@ -3,6 +3,7 @@
 
 #include "ir_detector.h"
 #include "Arduino.h"
+#include "chat.h"
 
 // Just to get thresholds
 #include "States.h"
@@ -34,7 +35,8 @@ uint16_t pollTouchInputs(unsigned long time, bool debug)
   
   Can also issue a debug print statement that contains the current value,
   the current mean of the buffer, and the minimum value seen since the
-  last time the debug statement was printed.
+  last time the debug statement was printed. In binary_mode, these are
+  sent as a single binary record instead.
   
   
   
@@ -111,7 +113,11 @@ uint16_t pollTouchInputs(unsigned long time, bool debug)
   l_val = ltemp;
   
   // Debug
-  if (debug) {
+  if (debug && binary_mode) {
+    int fields[6] = {l_val, (int) l_mean, l_min, r_val, (int) r_mean, r_min};
+    send_binary_record(__IR_DETECTOR_H_RECORD_TYPE, time, fields, 6);
+  }
+  else if (debug) {
     Serial.print(time);
     Serial.print(" DBG L:c=");
     Serial.print(l_val);
@@ -128,7 +134,8 @@ uint16_t pollTouchInputs(unsigned long time, bool debug)
     Serial.print(";x=");
     Serial.print(r_min);        
     Serial.println(".");
-    
+  }
+  if (debug) {
     // reset debugging info
     l_min = 1023;
     r_min = 1023;
@@ -13,4 +13,9 @@ int get_touched_channel(uint16_t touched, unsigned int i);
 
 #define __IR_DETECTOR_H_BUFFER_SZ 20
 #define __IR_DETECTOR_H_UPDATE_T 400
+
+// The type of the binary record sent instead of the debug lines when
+// binary_mode is set. Its fields are the current value, mean, and min of the
+// left pin, then of the right pin. This must match TrialSpeak.py
+#define __IR_DETECTOR_H_RECORD_TYPE 'I'
 #endif
\ No newline at end of file
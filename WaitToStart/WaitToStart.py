@@ -43,7 +43,7 @@ try:
         chatter.update(echo_to_stdout=True)
 
         # Wait for all parameters to be set
-        if not PARAMS_SET and len(chatter.queued_writes) == 0:
+        if not PARAMS_SET and chatter.get_write_stats()['n_queued'] == 0:
             for i in range(20):
                 chatter.update(echo_to_stdout=True)
             PARAMS_SET = True
@@ -4,4 +4,5 @@ import TrialMatrix
 import TrialSpeak
 import trial_setter
 import trial_setter_ui
-import mainloop
\ No newline at end of file
+import mainloop
+import chatter_hub
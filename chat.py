@@ -5,6 +5,24 @@ import os
 import sys
 import errno
 import platform
+import select
+import socket
+import threading
+import collections
+import itertools
+import struct
+import json
+import zlib
+try:
+    import lzma
+except ImportError:
+    # Python 2 has no lzma, so only gzip compression is available
+    lzma = None
+try:
+    import selectors
+except ImportError:
+    # Python 2 has no selectors, so wait_for_input falls back to select
+    selectors = None
 
 ## From device to user
 def read_from_device(device):
@@ -12,18 +30,1423 @@ def read_from_device(device):
     new_lines = device.readlines()
     return new_lines
 
+def get_n_bytes_waiting(device):
+    """Returns the number of bytes waiting to be read from device"""
+    # Older versions of pyserial only have inWaiting
+    try:
+        return device.in_waiting
+    except AttributeError:
+        return device.inWaiting()
+
+def split_complete_lines(data, partial_line):
+    """Split `data` into lines, prepending `partial_line`.
+    
+    Returns: complete_lines, new_partial_line
+        complete_lines all end with a newline. new_partial_line is anything
+        left at the end without one.
+    """
+    lines = (partial_line + data).split(b'\n')
+    new_partial_line = lines.pop()
+    return [line + b'\n' for line in lines], new_partial_line
+
+def decode_device_text(data):
+    """Returns bytes from the device as text, ie str.
+    
+    On Python 2 this is `data` itself. On Python 3 it is decoded as ASCII,
+    which is all the device speaks, and each byte that is not ASCII is
+    replaced by one character, so that offsets are unchanged.
+    """
+    if isinstance(data, str):
+        return data
+    return data.decode('ascii', 'replace')
+
+def open_text_log(filename):
+    """Open a text file to write lines from the device to.
+    
+    On Python 3 it is encoded as ASCII, so that each character takes one
+    byte, as in the host timestamps sidecar.
+    """
+    if sys.version_info >= (3,):
+        return open(filename, 'w', encoding='ascii', errors='replace')
+    return open(filename, 'w')
+
+class DeviceLineReader(object):
+    """Reads lines from a device in bulk, through a reusable buffer.
+    
+    Unlike readlines, which reads one byte at a time and waits out the
+    whole timeout, each `read` takes everything waiting in one call. It
+    only waits, up to the device's timeout, if nothing is waiting at all.
+    The bytes are read straight into a bytearray that is reused across 
+    reads, which grows to fit what is waiting. A partial line at the end
+    stays in the buffer until the rest of it arrives.
+    
+    The complete lines are copied out of the buffer once, into `new_data`,
+    and each line that `read` returns is sliced from that. Lines are text
+    (str): on Python 3 they are decoded once here, by decode_device_text.
+    
+    If `frame_splitter` is not None, binary frames are removed from the
+    data before it is split into lines, and kept in `new_frames`.
+    
+    After each `read`, `new_data` is the complete lines joined, so that
+    they can be written out without joining them again, and `read_time`
+    is the host (monotonic) time at which they were read from the device.
+    """
+    def __init__(self, device, frame_splitter=None, partial_line=b'', 
+        buffer_size=4096):
+        self.device = device
+        self.frame_splitter = frame_splitter
+        self.buffer = bytearray(max(buffer_size, 2 * len(partial_line)))
+        self.buffer[:len(partial_line)] = partial_line
+        self.n_buffered = len(partial_line)
+        self.new_data = b''
+        self.new_frames = []
+        self.read_time = None
+        
+        # Statistics
+        self.n_reads = 0
+        self.n_bytes_read = 0
+    
+    def get_partial_line(self):
+        """Returns what has been read after the last complete line"""
+        return bytes(self.buffer[:self.n_buffered])
+    
+    def read_into_buffer(self, n_bytes):
+        """Read up to `n_bytes` from the device onto the end of the buffer.
+        
+        Returns the number of bytes read.
+        """
+        # Grow the buffer if needed, keeping what is in it
+        n_needed = self.n_buffered + n_bytes
+        if n_needed > len(self.buffer):
+            self.buffer.extend(bytearray(max(n_needed - len(self.buffer),
+                len(self.buffer))))
+        
+        try:
+            readinto = self.device.readinto
+        except AttributeError:
+            # Older versions of pyserial only have read
+            data = self.device.read(n_bytes)
+            self.buffer[self.n_buffered:self.n_buffered + len(data)] = data
+            n_read = len(data)
+        else:
+            view = memoryview(self.buffer)
+            n_read = readinto(view[self.n_buffered:n_needed]) or 0
+            
+            # The buffer cannot be resized while it is viewed
+            del view
+        
+        self.n_buffered += n_read
+        return n_read
+    
+    def fill(self):
+        """Read everything waiting on the device into the buffer.
+        
+        Returns the number of bytes read.
+        """
+        start = self.n_buffered
+        n_waiting = get_n_bytes_waiting(self.device)
+        if n_waiting == 0:
+            # Wait for the first byte, then take whatever followed it
+            if self.read_into_buffer(1) == 0:
+                return 0
+            n_waiting = get_n_bytes_waiting(self.device)
+        if n_waiting > 0:
+            self.read_into_buffer(n_waiting)
+        self.read_time = get_monotonic_time()
+        n_read = self.n_buffered - start
+        self.n_reads += 1
+        self.n_bytes_read += n_read
+        
+        if self.frame_splitter is not None:
+            text, frames = self.frame_splitter.split(
+                bytes(self.buffer[start:self.n_buffered]))
+            self.new_frames.extend(frames)
+            self.buffer[start:start + len(text)] = text
+            self.n_buffered = start + len(text)
+        return n_read
+    
+    def read(self):
+        """Read from the device, and return the new complete lines.
+        
+        Each line ends with a newline. New binary frames, if any, are in
+        `new_frames`.
+        """
+        self.new_frames = []
+        self.fill()
+        
+        # Everything up to the last newline is complete lines
+        n_complete = self.buffer.rfind(b'\n', 0, self.n_buffered) + 1
+        if n_complete == 0:
+            self.new_data = b''
+            return []
+        view = memoryview(self.buffer)
+        self.new_data = decode_device_text(view[:n_complete].tobytes())
+        
+        # The buffer cannot be changed while it is viewed
+        del view
+        
+        # Decoding keeps one character per byte, so the offsets still hold
+        lines = []
+        start = 0
+        while start < n_complete:
+            stop = self.buffer.find(b'\n', start, n_complete) + 1
+            lines.append(self.new_data[start:stop])
+            start = stop
+        
+        # Keep the partial line at the start of the buffer
+        n_partial = self.n_buffered - n_complete
+        self.buffer[:n_partial] = self.buffer[n_complete:self.n_buffered]
+        self.n_buffered = n_partial
+        
+        return lines
+    
+    def get_stats(self):
+        return {
+            'n_reads': self.n_reads,
+            'n_bytes_read': self.n_bytes_read,
+            'n_buffered': self.n_buffered,
+            }
+
+# Binary records are COBS frames between zero bytes. See TrialSpeak.
+binary_frames_suffix = '.frames'
+binary_mode_command = 'BINARY 1'
+
+def make_crc16_table():
+    """Returns the lookup table for CRC-16/CCITT-FALSE"""
+    table = []
+    for n in range(256):
+        crc = n << 8
+        for bit in range(8):
+            if crc & 0x8000:
+                crc = ((crc << 1) ^ 0x1021) & 0xFFFF
+            else:
+                crc = (crc << 1) & 0xFFFF
+        table.append(crc)
+    return table
+crc16_table = make_crc16_table()
+
+def crc16_ccitt(data):
+    """CRC-16/CCITT-FALSE of `data`, as in chat.cpp"""
+    crc = 0xFFFF
+    for byte in bytearray(data):
+        crc = ((crc << 8) & 0xFFFF) ^ crc16_table[(crc >> 8) ^ byte]
+    return crc
+
+def cobs_decode(frame):
+    """COBS-decode `frame`, without its zero bytes.
+    
+    Returns the decoded bytes as a bytearray, or None if `frame` is not
+    valid COBS.
+    """
+    encoded = bytearray(frame)
+    decoded = bytearray()
+    code_idx = 0
+    while code_idx < len(encoded):
+        code = encoded[code_idx]
+        next_code_idx = code_idx + code
+        if code == 0 or next_code_idx > len(encoded):
+            return None
+        decoded += encoded[code_idx + 1:next_code_idx]
+        if next_code_idx < len(encoded) and code < 0xFF:
+            decoded.append(0)
+        code_idx = next_code_idx
+    return decoded
+
+def is_valid_frame(frame):
+    """True if `frame` decodes to a record that ends with its own CRC"""
+    decoded = cobs_decode(frame)
+    if decoded is None or len(decoded) < 3:
+        return False
+    return crc16_ccitt(decoded[:-2]) == decoded[-2] | (decoded[-1] << 8)
+
+class BinaryFrameSplitter(object):
+    """Separates binary frames from the text coming from the device.
+    
+    The device sends each frame between two zero bytes, and text never
+    contains a zero byte. Frames and text may be split anywhere across
+    calls to `split`.
+    
+    Whatever lies between two zero bytes is only taken as a frame if it
+    decodes and its CRC matches. Anything else is text, and the zero byte
+    after it is taken to begin a frame. So if a zero byte is lost (eg, the
+    host started while the device was mid-frame, or a byte was dropped),
+    the bytes around it end up in the text, counted in `n_invalid`, and
+    the next frame is found again.
+    
+    Text after the last zero byte is returned immediately, unless a frame
+    may have begun there. A possible frame longer than `max_frame_size` 
+    is returned as text, and counted in `n_overlong`.
+    
+    Usage, where a frame lost its opening zero byte:
+        >>> from pseudo_arduino import cobs_encode, crc16_ccitt
+        >>> record = b'I\\x01\\x00\\x00\\x00'
+        >>> frame = cobs_encode(record + struct.pack('<H', 
+        ...     crc16_ccitt(record)))
+        >>> splitter = BinaryFrameSplitter()
+        >>> text, frames = splitter.split(frame + b'\\x00100 ACK SET X 1\\r\\n' +
+        ...     b'\\x00' + frame + b'\\x00200 TRLR 1\\r\\n')
+        >>> text.endswith(b'100 ACK SET X 1\\r\\n200 TRLR 1\\r\\n')
+        True
+        >>> frames == [frame, frame]
+        True
+    """
+    def __init__(self, max_frame_size=256):
+        self.max_frame_size = max_frame_size
+        self.in_frame = False
+        self.partial_frame = b''
+        self.n_frames = 0
+        self.n_invalid = 0
+        self.n_overlong = 0
+    
+    def split(self, data):
+        """Returns the text and the list of complete frames in `data`.
+        
+        The frames do not include their zero bytes.
+        """
+        if not self.in_frame and b'\0' not in data:
+            return data, []
+        
+        text_pieces = []
+        frames = []
+        pieces = data.split(b'\0')
+        last_piece = pieces.pop()
+        for npiece, piece in enumerate(pieces):
+            # Each of these pieces is ended by a zero byte
+            if self.in_frame:
+                piece = self.partial_frame + piece
+                self.partial_frame = b''
+            
+            if len(piece) > 0 and is_valid_frame(piece):
+                frames.append(piece)
+                self.in_frame = False
+                continue
+            
+            if self.in_frame and len(piece) > 0:
+                self.n_invalid += 1
+            elif not self.in_frame:
+                # A frame that lost its opening zero byte follows the text
+                frame_start = piece.rfind(b'\n') + 1
+                if frame_start < len(piece) and (
+                    is_valid_frame(piece[frame_start:])):
+                    frames.append(piece[frame_start:])
+                    text_pieces.append(piece[:frame_start])
+                    continue
+            text_pieces.append(piece)
+            self.in_frame = True
+        
+        # What follows the last zero byte may be a frame
+        if self.in_frame:
+            self.partial_frame += last_piece
+            if len(self.partial_frame) > self.max_frame_size:
+                self.n_overlong += 1
+                text_pieces.append(self.partial_frame)
+                self.partial_frame = b''
+                self.in_frame = False
+        else:
+            text_pieces.append(last_piece)
+        
+        self.n_frames += len(frames)
+        return b''.join(text_pieces), frames
+    
+    def get_stats(self):
+        return {
+            'n_frames': self.n_frames,
+            'n_invalid': self.n_invalid,
+            'n_overlong': self.n_overlong,
+            }
+
+# Written to the log in place of lines that LineRingBuffer dropped
+ring_buffer_gap_marker = 'ERR host dropped %d lines\n'
+
+class LineRingBuffer(object):
+    """Bounded, thread-safe buffer of complete lines from the device.
+    
+    One thread (eg DeviceReaderThread) puts lines and another gets them.
+    Each line is kept with the host time at which it was received. If more
+    than `maxlen` lines are waiting, the oldest are dropped and counted in
+    `n_overflowed`, and the next `get_with_times` reports how many were
+    dropped before the lines it returns. The largest number of lines ever
+    waiting is kept in `high_water_mark`.
+    """
+    def __init__(self, maxlen=10000):
+        self.maxlen = maxlen
+        self.lines = collections.deque(maxlen=maxlen)
+        self.receive_times = collections.deque(maxlen=maxlen)
+        self.condition = threading.Condition()
+        self.high_water_mark = 0
+        self.n_overflowed = 0
+        self.n_overflowed_since_get = 0
+        self.n_put = 0
+    
+    def put(self, lines, receive_time=None):
+        """Add lines to the buffer, dropping the oldest if it is full.
+        
+        `receive_time` : host time at which the lines were received. If
+            None, now.
+        """
+        if len(lines) == 0:
+            return
+        if receive_time is None:
+            receive_time = get_monotonic_time()
+        with self.condition:
+            n_overflowed = len(self.lines) + len(lines) - self.maxlen
+            if n_overflowed > 0:
+                self.n_overflowed += n_overflowed
+                self.n_overflowed_since_get += n_overflowed
+            self.lines.extend(lines)
+            self.receive_times.extend([receive_time] * len(lines))
+            self.n_put += len(lines)
+            if len(self.lines) > self.high_water_mark:
+                self.high_water_mark = len(self.lines)
+            self.condition.notify()
+    
+    def get(self, max_lines=None, timeout=None):
+        """Remove and return up to `max_lines` lines (all, if None).
+        
+        If the buffer is empty, waits up to `timeout` seconds for a line.
+        Returns an empty list if nothing arrived.
+        """
+        lines, receive_times, n_dropped = self.get_with_times(
+            max_lines, timeout)
+        return lines
+    
+    def get_with_times(self, max_lines=None, timeout=None):
+        """Like `get`, but also returns the receive time of each line.
+        
+        Returns: lines, receive_times, n_dropped
+            n_dropped is how many lines were dropped, since the last get,
+            from just before these lines
+        """
+        with self.condition:
+            if len(self.lines) == 0 and timeout != 0:
+                self.condition.wait(timeout)
+            
+            if max_lines is None or max_lines >= len(self.lines):
+                lines = list(self.lines)
+                receive_times = list(self.receive_times)
+                self.lines.clear()
+                self.receive_times.clear()
+            else:
+                lines = [self.lines.popleft() for n in range(max_lines)]
+                receive_times = [self.receive_times.popleft() 
+                    for n in range(max_lines)]
+            n_dropped = self.n_overflowed_since_get
+            self.n_overflowed_since_get = 0
+        return lines, receive_times, n_dropped
+    
+    def __len__(self):
+        with self.condition:
+            return len(self.lines)
+    
+    def get_stats(self):
+        """Returns a dict of the buffer occupancy statistics"""
+        with self.condition:
+            return {
+                'n_waiting': len(self.lines),
+                'maxlen': self.maxlen,
+                'high_water_mark': self.high_water_mark,
+                'n_overflowed': self.n_overflowed,
+                'n_put': self.n_put,
+                }
+
+class DeviceReaderThread(threading.Thread):
+    """Continuously drains a serial device into a LineRingBuffer.
+    
+    Only complete lines are put into the buffer, with the time at which
+    they were read. The device should have a read timeout, so that `stop`
+    takes effect promptly.
+    
+    If `frame_splitter` is not None, binary frames are removed before the
+    data is split into lines, and are taken with `get_frames`.
+    """
+    def __init__(self, device, line_buffer, partial_line=b'', 
+        frame_splitter=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.device = device
+        self.line_buffer = line_buffer
+        self.reader = DeviceLineReader(device, frame_splitter=frame_splitter,
+            partial_line=partial_line)
+        self.frames = collections.deque()
+        self.stop_event = threading.Event()
+    
+    def run(self):
+        while not self.stop_event.is_set():
+            # Read everything waiting, or block until the timeout for 1 byte
+            lines = self.reader.read()
+            if len(self.reader.new_frames) > 0:
+                self.frames.extend(self.reader.new_frames)
+            if len(lines) > 0:
+                self.line_buffer.put(lines, self.reader.read_time)
+    
+    def get_frames(self):
+        """Remove and return the binary frames read so far"""
+        frames = []
+        while len(self.frames) > 0:
+            frames.append(self.frames.popleft())
+        return frames
+    
+    def stop(self):
+        """Ask the thread to stop and wait for it to do so"""
+        self.stop_event.set()
+        self.join()
+
+## Parsed lines from the device
+# A line from the device, parsed once. `time` is the device millis and
+# `command` the TrialSpeak command, eg 'TRLR' or 'DBG'. Lines that do not
+# begin with a time (eg, "ERR ...") have time and command None, and all of
+# their words in `args`.
+DeviceEvent = collections.namedtuple('DeviceEvent', 
+    ['time', 'command', 'args', 'line'])
+
+def parse_device_line(line):
+    """Split a line from the device into a DeviceEvent"""
+    words = line.split()
+    try:
+        time = int(words[0])
+    except (IndexError, ValueError):
+        return DeviceEvent(None, None, words, line)
+    if len(words) < 2:
+        return DeviceEvent(time, None, [], line)
+    return DeviceEvent(time, words[1], words[2:], line)
+
+class DeviceEventBus(object):
+    """Publishes each line from the device to subscribers, by command.
+    
+    Each line is parsed once into a DeviceEvent, however many subscribers
+    there are, and only if there are any. Subscribers are called in the
+    order they subscribed.
+    """
+    def __init__(self):
+        # Callbacks keyed by command. The key None is for all commands.
+        self.subscribers = {}
+        self.n_published = 0
+    
+    def subscribe(self, callback, commands=None):
+        """Call `callback(event)` for each line with a command in `commands`.
+        
+        `commands` : list of commands, eg ['TRLR', 'ST_CHG']. If None,
+            `callback` receives every line, including lines without a 
+            command.
+        """
+        if commands is None:
+            commands = [None]
+        elif isinstance(commands, str):
+            commands = [commands]
+        for command in commands:
+            self.subscribers.setdefault(command, []).append(callback)
+    
+    def unsubscribe(self, callback):
+        """Stop calling `callback` for any command"""
+        for command in list(self.subscribers.keys()):
+            callbacks = [cb for cb in self.subscribers[command] 
+                if cb != callback]
+            if len(callbacks) == 0:
+                self.subscribers.pop(command)
+            else:
+                self.subscribers[command] = callbacks
+    
+    def publish(self, lines):
+        """Parse `lines` and call the subscribers of each"""
+        if len(self.subscribers) == 0:
+            return
+        all_callbacks = self.subscribers.get(None, [])
+        for line in lines:
+            event = parse_device_line(line)
+            if event.command is not None:
+                for callback in self.subscribers.get(event.command, []):
+                    callback(event)
+            for callback in all_callbacks:
+                callback(event)
+            self.n_published += 1
+
+class DeviceEventRecorder(object):
+    """A subscriber that keeps the events it receives.
+    
+    Subscribe it to a DeviceEventBus, and consumers read `events`, or
+    only the ones they have not seen with `get_events_since`. If 
+    `maxlen` is not None, only that many of the most recent are kept.
+    
+    Usage:
+        touches = DeviceEventRecorder(maxlen=10000)
+        chatter.event_bus.subscribe(touches, ['TCH'])
+        new_touches, n_seen = touches.get_events_since(0)
+        ...
+        new_touches, n_seen = touches.get_events_since(n_seen)
+    """
+    def __init__(self, maxlen=None):
+        self.events = collections.deque(maxlen=maxlen)
+        
+        # Total received, including those that have been dropped
+        self.n_received = 0
+    
+    def __call__(self, event):
+        self.events.append(event)
+        self.n_received += 1
+    
+    def __len__(self):
+        return len(self.events)
+    
+    def get_events_since(self, n_seen):
+        """Returns the events received after the first `n_seen`, and the total
+        
+        Pass the returned total as `n_seen` on the next call. Events that
+        were dropped because more than `maxlen` arrived in between are 
+        not returned. This takes time proportional to the number returned.
+        """
+        n_new = min(self.n_received - n_seen, len(self.events))
+        new_events = list(itertools.islice(reversed(self.events), n_new))
+        new_events.reverse()
+        return new_events, self.n_received
+
+# Text, for checking lines from the user
+try:
+    basestring_type = basestring
+except NameError:
+    basestring_type = str
+
+# clock_gettime's id for the monotonic clock, by sys.platform
+clock_monotonic_ids = {'linux': 1, 'linux2': 1, 'darwin': 6}
+
+def make_monotonic_clock():
+    """Returns a function that gives the monotonic host time in seconds.
+    
+    Python 3 has time.monotonic. Python 2 does not, so on Linux and macOS
+    clock_gettime(CLOCK_MONOTONIC) is called through ctypes instead.
+    Elsewhere, this falls back to the wall clock, time.time, which jumps
+    when the clock is stepped (eg, by NTP).
+    
+    Returns: get_time, is_monotonic
+    """
+    if hasattr(time, 'monotonic'):
+        return time.monotonic, True
+    clock_id = clock_monotonic_ids.get(sys.platform)
+    if clock_id is None:
+        return time.time, False
+    
+    try:
+        import ctypes
+        import ctypes.util
+        
+        class timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+        
+        # Older glibc only has clock_gettime in librt
+        clock_gettime = None
+        for library_name in ['c', 'rt']:
+            library_path = ctypes.util.find_library(library_name)
+            if library_path is None:
+                continue
+            library = ctypes.CDLL(library_path)
+            if hasattr(library, 'clock_gettime'):
+                clock_gettime = library.clock_gettime
+                break
+        if clock_gettime is None:
+            return time.time, False
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+    except (ImportError, OSError):
+        return time.time, False
+    
+    # A timespec for each call, because the reader thread calls this too
+    def get_time():
+        ts = timespec()
+        clock_gettime(clock_id, ctypes.byref(ts))
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+    
+    # Check that this clock id works here
+    if clock_gettime(clock_id, ctypes.byref(timespec())) != 0:
+        return time.time, False
+    return get_time, True
+
+# Host time for timestamps, deadlines and intervals. On the rare system
+# where no monotonic clock is found, this is the wall clock, and 
+# `host_clock_is_monotonic` is False.
+get_monotonic_time, host_clock_is_monotonic = make_monotonic_clock()
+
+class SentLine(object):
+    """A line written to the device that is awaiting acknowledgement.
+    
+    If `callback` is not None, it is called as callback(acknowledged, 
+    latency) once the line is acknowledged, or given up on.
+    """
+    def __init__(self, line, send_time, deadline=None, callback=None):
+        self.line = line
+        self.callback = callback
+        self.n_bytes = len(line) + 1
+        self.first_send_time = send_time
+        self.send_time = send_time
+        self.deadline = deadline
+        self.n_retransmits = 0
+        
+        # When each copy that has not been acknowledged was written, oldest
+        # first. Once retransmitted, several may be in the device's buffer.
+        self.copy_send_times = [send_time]
+    
+    def get_n_bytes_in_flight(self):
+        """Returns the bytes of the copies that have not been acknowledged"""
+        return self.n_bytes * len(self.copy_send_times)
+
+class WriteLane(object):
+    """A queue of lines waiting to be written to the device.
+    
+    Chatter has several lanes in priority order. Each keeps statistics on
+    its depth and on how long lines waited in it before being sent.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.lines = []
+        self.enqueue_times = []
+        self.callbacks = []
+        
+        # Statistics
+        self.n_enqueued = 0
+        self.n_sent = 0
+        self.max_depth = 0
+        self.total_wait = 0.
+        self.max_wait = 0.
+    
+    def append(self, line, callback=None):
+        self.lines.append(line)
+        self.enqueue_times.append(get_monotonic_time())
+        self.callbacks.append(callback)
+        self.n_enqueued += 1
+        if len(self.lines) > self.max_depth:
+            self.max_depth = len(self.lines)
+    
+    def pop(self):
+        """Remove the oldest line, recording its wait time.
+        
+        Returns: the line, and its callback
+        """
+        line = self.lines.pop(0)
+        callback = self.callbacks.pop(0)
+        wait = get_monotonic_time() - self.enqueue_times.pop(0)
+        self.n_sent += 1
+        self.total_wait += wait
+        if wait > self.max_wait:
+            self.max_wait = wait
+        return line, callback
+    
+    def __len__(self):
+        return len(self.lines)
+    
+    def get_stats(self):
+        """Returns a dict of depth and wait time (in seconds) statistics"""
+        if self.n_sent > 0:
+            mean_wait = self.total_wait / self.n_sent
+        else:
+            mean_wait = 0.
+        return {
+            'depth': len(self.lines),
+            'max_depth': self.max_depth,
+            'n_enqueued': self.n_enqueued,
+            'n_sent': self.n_sent,
+            'mean_wait': mean_wait,
+            'max_wait': self.max_wait,
+            }
+
+class DeviceClockEstimator(object):
+    """Online linear fit of host time against the device's millis().
+    
+    Every line from the device starts with its millis() timestamp. Each is
+    paired with the host time at which the line was received, and a
+    recursive least-squares fit is updated, so the mapping is always
+    current without refitting the whole logfile.
+    
+    The host receive time includes a variable delay (serial transfer, and
+    waiting for the next `update`), which shows up as jitter around the fit.
+    
+    If `forgetting_factor` is less than 1, older samples are down-weighted
+    exponentially so the fit can follow a drift that changes over the
+    session (eg, as the device warms up).
+    
+    If millis() goes backwards, the device was reset and the fit restarts.
+    """
+    def __init__(self, forgetting_factor=1.0):
+        self.forgetting_factor = forgetting_factor
+        self.reset()
+    
+    def reset(self):
+        # Samples are stored relative to the first one, to keep precision
+        self.device_origin = None
+        self.host_origin = None
+        self.last_device_time = None
+        self.n_samples = 0
+        
+        # Weighted means and co-moments
+        self.sum_weights = 0.0
+        self.mean_device = 0.0
+        self.mean_host = 0.0
+        self.comoment_dd = 0.0
+        self.comoment_dh = 0.0
+        self.comoment_hh = 0.0
+    
+    def add_sample(self, device_time, host_time):
+        """Add one pair of device time (ms) and host time (s)"""
+        if self.last_device_time is not None and (
+            device_time < self.last_device_time):
+            self.reset()
+        if self.device_origin is None:
+            self.device_origin = device_time
+            self.host_origin = host_time
+        self.last_device_time = device_time
+        self.n_samples += 1
+        
+        x = float(device_time - self.device_origin)
+        y = host_time - self.host_origin
+        lam = self.forgetting_factor
+        
+        self.sum_weights = lam * self.sum_weights + 1.0
+        dx = x - self.mean_device
+        dy = y - self.mean_host
+        self.mean_device += dx / self.sum_weights
+        self.mean_host += dy / self.sum_weights
+        self.comoment_dd = lam * self.comoment_dd + dx * (x - self.mean_device)
+        self.comoment_dh = lam * self.comoment_dh + dx * (y - self.mean_host)
+        self.comoment_hh = lam * self.comoment_hh + dy * (y - self.mean_host)
+    
+    def add_lines(self, lines, host_times):
+        """Add a sample for each line that starts with a device timestamp
+        
+        `host_times` : the host time at which each line was received
+        """
+        for line, host_time in zip(lines, host_times):
+            try:
+                device_time = int(line.split(None, 1)[0])
+            except (ValueError, IndexError):
+                continue
+            self.add_sample(device_time, host_time)
+    
+    def is_ready(self):
+        """True once there is enough spread in device time to fit"""
+        return self.n_samples >= 2 and self.comoment_dd > 0
+    
+    def get_slope(self):
+        """Host seconds per device millisecond"""
+        return self.comoment_dh / self.comoment_dd
+    
+    def device_to_host_time(self, device_time):
+        """Returns the host time (s) at which the device read `device_time`
+        
+        Returns None until is_ready.
+        """
+        if not self.is_ready():
+            return None
+        x = device_time - self.device_origin
+        return (self.host_origin + self.mean_host +
+            self.get_slope() * (x - self.mean_device))
+    
+    def host_to_device_time(self, host_time):
+        """Returns the device time (ms) corresponding to `host_time` (s)
+        
+        Returns None until is_ready.
+        """
+        if not self.is_ready():
+            return None
+        y = host_time - self.host_origin
+        return (self.device_origin + self.mean_device +
+            (y - self.mean_host) / self.get_slope())
+    
+    def get_stats(self):
+        """Returns a dict describing the current fit.
+        
+        drift_ppm : how much faster the host clock runs than the device
+            clock, in parts per million
+        offset : host time (s) at which millis() was zero
+        jitter : standard deviation (s) of the receive times around the fit
+        """
+        if not self.is_ready():
+            return {'n_samples': self.n_samples, 'drift_ppm': None,
+                'offset': None, 'jitter': None}
+        slope = self.get_slope()
+        residual_var = (self.comoment_hh -
+            self.comoment_dh * slope) / self.sum_weights
+        return {
+            'n_samples': self.n_samples,
+            'drift_ppm': (slope * 1000. - 1.) * 1e6,
+            'offset': self.device_to_host_time(0),
+            'jitter': max(residual_var, 0.) ** 0.5,
+            }
+
+class LatencyHistogram(object):
+    """Fixed-bucket histogram of latencies, in the style of HdrHistogram.
+    
+    Latencies are recorded in whole microseconds. Below 2 ** `sub_bucket_bits`
+    microseconds each value has its own bucket. Above that, each power of
+    two is split into 2 ** `sub_bucket_bits` equal buckets, so the relative
+    error is bounded (about 3% with the default of 5). Latencies beyond
+    `max_seconds` are counted in the last bucket.
+    
+    All buckets are allocated up front, so recording never allocates.
+    """
+    def __init__(self, sub_bucket_bits=5, max_seconds=256.):
+        self.sub_bucket_bits = sub_bucket_bits
+        self.sub_bucket_count = 2 ** sub_bucket_bits
+        self.max_value = int(max_seconds * 1e6)
+        self.counts = [0] * (self.get_bucket_index(self.max_value) + 1)
+        
+        self.n_recorded = 0
+        self.total = 0.
+        self.min_recorded = None
+        self.max_recorded = None
+    
+    def get_bucket_index(self, value):
+        """Returns the index of the bucket for `value` in microseconds"""
+        if value < self.sub_bucket_count:
+            return value
+        exponent = value.bit_length() - self.sub_bucket_bits - 1
+        return self.sub_bucket_count * exponent + (value >> exponent)
+    
+    def get_bucket_value(self, index):
+        """Returns the middle of bucket `index`, in microseconds"""
+        if index < self.sub_bucket_count:
+            return index
+        exponent = index // self.sub_bucket_count - 1
+        mantissa = index - self.sub_bucket_count * exponent
+        return (mantissa << exponent) + ((1 << exponent) - 1) / 2.
+    
+    def record(self, seconds):
+        """Add one latency, in seconds"""
+        value = min(max(int(seconds * 1e6), 0), self.max_value)
+        self.counts[self.get_bucket_index(value)] += 1
+        
+        self.n_recorded += 1
+        self.total += seconds
+        if self.min_recorded is None or seconds < self.min_recorded:
+            self.min_recorded = seconds
+        if self.max_recorded is None or seconds > self.max_recorded:
+            self.max_recorded = seconds
+    
+    def get_percentile(self, percentile):
+        """Returns the latency in seconds at `percentile` (0-100), or None"""
+        if self.n_recorded == 0:
+            return None
+        
+        # The rank of the requested sample, counting from 1
+        rank = max(int(round(percentile / 100. * self.n_recorded)), 1)
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                break
+        
+        # The bucket's value can lie slightly outside what was recorded
+        res = self.get_bucket_value(index) / 1e6
+        return min(max(res, self.min_recorded), self.max_recorded)
+    
+    def get_stats(self, percentiles=(50, 95, 99)):
+        """Returns a dict of the count, mean, extremes and percentiles.
+        
+        Percentiles are keyed like 'p50'. All times are in seconds.
+        """
+        res = {'n': self.n_recorded, 'min': self.min_recorded,
+            'max': self.max_recorded, 'mean': None}
+        if self.n_recorded > 0:
+            res['mean'] = self.total / self.n_recorded
+        for percentile in percentiles:
+            res['p%g' % percentile] = self.get_percentile(percentile)
+        return res
+
+# Lines logged by the device at the start and end of a trial, and when the
+# next trial is released. See TrialSpeak.
+trial_start_token = 'TRL_START'
+trial_result_token = 'TRLR'
+trial_released_token = 'TRL_RELEASED'
+trial_release_latency_key = 'TRLR->TRL_RELEASED'
+latency_snapshot_suffix = '.latency.json'
+
+# Each record in the host timestamps sidecar: the monotonic host time in
+# nanoseconds at which the line was received (see make_monotonic_clock),
+# and the byte offset of the line in the ardulines file. See
+# TrialSpeak.read_host_timestamps.
+host_timestamp_struct = struct.Struct('<qQ')
+host_timestamps_suffix = '.times'
+
+def write_host_timestamps(buffer, data, receive_times, offset):
+    """Write a host timestamp record to `buffer` for each line in `data`.
+    
+    `receive_times` : host time in seconds at which each line was received
+    `offset` : byte offset in the ardulines file of the first line
+    
+    Returns: the byte offset just past the last line
+    """
+    records = []
+    for line, receive_time in zip(data, receive_times):
+        records.append(host_timestamp_struct.pack(int(receive_time * 1e9), 
+            offset))
+        offset += len(line)
+    buffer.write(b''.join(records))
+    buffer.flush()
+    return offset
+
 def write_to_user(buffer, data):
     """Write `data` to the user via `buffer`
     
     `buffer` : a file
+    
+    The lines are joined into a single write.
     """
     # No matter what, pipe new_lines to savefile here
-    for line in data:
-        if sys.version_info>=(3,1):
-            line = str(line)
-        buffer.write(line)
+    if sys.version_info>=(3,1):
+        data = [str(line) for line in data]
+    buffer.write(''.join(data))
     buffer.flush()
 
+# Written to the terminal in place of lines that EchoThread dropped
+echo_skipped_marker = '[%d lines skipped]\n'
+
+class EchoThread(threading.Thread):
+    """Echoes lines from the device to a terminal in the background.
+    
+    `put` never waits for the terminal, so a slow terminal cannot slow
+    down the Chatter. If more than `maxlen` lines are waiting, the oldest
+    are dropped, and the terminal is shown how many were skipped in their
+    place. See echo_skipped_marker.
+    """
+    def __init__(self, buffer, maxlen=1000):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.buffer = buffer
+        self.maxlen = maxlen
+        self.lines = collections.deque()
+        self.n_skipped_since_write = 0
+        self.condition = threading.Condition()
+        self.stopping = False
+        
+        # Statistics
+        self.n_put = 0
+        self.n_written = 0
+        self.n_skipped = 0
+        self.max_write_duration = 0.
+    
+    def put(self, lines):
+        """Add lines to be echoed, dropping the oldest if too many wait"""
+        if len(lines) == 0:
+            return
+        with self.condition:
+            self.lines.extend(lines)
+            self.n_put += len(lines)
+            n_dropped = len(self.lines) - self.maxlen
+            if n_dropped > 0:
+                for n in range(n_dropped):
+                    self.lines.popleft()
+                self.n_skipped_since_write += n_dropped
+                self.n_skipped += n_dropped
+            self.condition.notify()
+    
+    def run(self):
+        while True:
+            with self.condition:
+                while len(self.lines) == 0 and not self.stopping:
+                    self.condition.wait()
+                if len(self.lines) == 0:
+                    return
+                lines = list(self.lines)
+                self.lines.clear()
+                n_skipped = self.n_skipped_since_write
+                self.n_skipped_since_write = 0
+            
+            n_lines = len(lines)
+            if n_skipped > 0:
+                lines.insert(0, echo_skipped_marker % n_skipped)
+            start_time = get_monotonic_time()
+            write_to_user(self.buffer, lines)
+            write_duration = get_monotonic_time() - start_time
+            self.n_written += n_lines
+            if write_duration > self.max_write_duration:
+                self.max_write_duration = write_duration
+    
+    def stop(self, timeout=1.):
+        """Echo what is waiting, and stop.
+        
+        Waits at most `timeout` seconds, in case the terminal is stuck.
+        """
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+        self.join(timeout)
+    
+    def get_stats(self):
+        """Returns a dict of the lines echoed and skipped"""
+        with self.condition:
+            return {
+                'n_waiting': len(self.lines),
+                'n_put': self.n_put,
+                'n_written': self.n_written,
+                'n_skipped': self.n_skipped,
+                'max_write_duration': self.max_write_duration,
+                }
+
+# Extension given to compressed output files. These are recognized by
+# TrialSpeak.read_lines_from_file and the other readers.
+compressed_log_suffixes = {'gzip': '.gz', 'lzma': '.xz'}
+
+class CompressedLogFile(object):
+    """Write-only file that compresses what is written to it as it goes.
+    
+    `compression` : 'gzip' or 'lzma' (xz)
+    
+    Each `flush` makes everything written so far readable from the file,
+    eg by TrialSpeak.LogFollower, even though the file is still open. For
+    gzip this is a sync flush. lzma has no such thing, so each flush ends
+    the xz stream, and the next write begins a new one; the readers
+    handle the concatenated streams.
+    
+    Flushing often costs compression, so flush at trial boundaries or at
+    intervals rather than on every line. See LogWriter.
+    """
+    def __init__(self, name, compression):
+        if compression == 'lzma' and lzma is None:
+            raise ValueError("lzma compression requires Python 3")
+        if compression not in compressed_log_suffixes:
+            raise ValueError("unknown compression: %s" % compression)
+        self.name = name
+        self.compression = compression
+        self.raw = open(name, 'wb')
+        self.compressor = None
+    
+    def make_compressor(self):
+        if self.compression == 'gzip':
+            # wbits of 16 + MAX_WBITS writes a gzip header and trailer
+            return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return lzma.LZMACompressor(lzma.FORMAT_XZ)
+    
+    def write(self, data):
+        if not isinstance(data, bytes):
+            data = data.encode('ascii', 'replace')
+        if self.compressor is None:
+            self.compressor = self.make_compressor()
+        self.raw.write(self.compressor.compress(data))
+    
+    def flush(self):
+        if self.compressor is not None:
+            if self.compression == 'gzip':
+                self.raw.write(self.compressor.flush(zlib.Z_SYNC_FLUSH))
+            else:
+                self.raw.write(self.compressor.flush())
+                self.compressor = None
+        self.raw.flush()
+    
+    def fileno(self):
+        return self.raw.fileno()
+    
+    def close(self):
+        """End the compressed stream and close the file"""
+        if self.compressor is not None:
+            self.raw.write(self.compressor.flush())
+            self.compressor = None
+        self.raw.close()
+
+def write_json_atomically(obj, filename):
+    """Write `obj` as JSON to `filename`, replacing any previous one.
+    
+    Writes to a temporary file first, so a reader never sees half.
+    """
+    temp_filename = filename + '.tmp'
+    with open(temp_filename, 'w') as fi:
+        json.dump(obj, fi, indent=2, sort_keys=True)
+    try:
+        os.rename(temp_filename, filename)
+    except OSError:
+        # Windows will not rename over an existing file
+        os.remove(filename)
+        os.rename(temp_filename, filename)
+
+# The manifest of a segmented log is named like the log plus this. See
+# TrialSpeak.get_log_segments.
+log_manifest_suffix = '.manifest.json'
+
+class SegmentedLogFile(object):
+    """Write-only file that rolls over into segments of a fixed size.
+    
+    `name` : the name of the logical log. Nothing is written to this
+        exactly. Segments are named like `name` plus '.0000', '.0001', etc,
+        plus the compression suffix if any.
+    `segment_size` : a new segment is begun once the current one holds
+        this many (uncompressed) bytes. Segments only end on a newline.
+    `compression` : None, or as for CompressedLogFile
+    
+    A manifest, named like `name` plus '.manifest.json', lists every
+    segment with its first and last device time and trial number, so that
+    readers can load only the segments that they need. It is rewritten
+    whenever a segment begins or ends. Until the current segment ends,
+    its last time and trial are as of when it began and 'complete' is
+    False.
+    
+    Trials are numbered as in TrialSpeak.read_logfile_into_df: lines
+    before the first TRL_START are trial -1. A segment's first trial is
+    the one in progress when it began, so if it begins with a TRL_START,
+    that is the previous trial.
+    """
+    def __init__(self, name, segment_size, compression=None):
+        self.name = name
+        self.segment_size = segment_size
+        self.compression = compression
+        self.manifest_filename = name + log_manifest_suffix
+        self.segments = []
+        self.segment_file = None
+        self.current_trial = -1
+        self.at_line_start = True
+        self.open_segment()
+    
+    def open_segment(self):
+        filename = '%s.%04d' % (self.name, len(self.segments))
+        if self.compression is not None:
+            filename = filename + compressed_log_suffixes[self.compression]
+            self.segment_file = CompressedLogFile(filename, self.compression)
+        else:
+            self.segment_file = open_text_log(filename)
+        
+        self.segments.append({
+            'filename': os.path.basename(filename),
+            'first_time': None,
+            'last_time': None,
+            'first_trial': self.current_trial,
+            'last_trial': self.current_trial,
+            'n_lines': 0,
+            'n_bytes': 0,
+            'complete': False,
+            })
+        self.write_manifest()
+    
+    def close_segment(self):
+        self.segment_file.close()
+        self.segments[-1]['complete'] = True
+        self.write_manifest()
+    
+    def write_manifest(self):
+        write_json_atomically({'segments': self.segments}, 
+            self.manifest_filename)
+    
+    def write(self, data):
+        for line in data.splitlines(True):
+            self.write_line(line)
+    
+    def write_line(self, line):
+        segment = self.segments[-1]
+        if self.at_line_start and segment['n_bytes'] >= self.segment_size:
+            self.close_segment()
+            self.open_segment()
+            segment = self.segments[-1]
+        
+        # Keep track of the time and trial
+        if self.at_line_start:
+            sp_line = line.split(None, 2)
+            if len(sp_line) > 1 and sp_line[1] == trial_start_token:
+                self.current_trial += 1
+            try:
+                device_time = int(sp_line[0])
+            except (ValueError, IndexError):
+                pass
+            else:
+                if segment['first_time'] is None:
+                    segment['first_time'] = device_time
+                segment['last_time'] = device_time
+            segment['last_trial'] = self.current_trial
+            segment['n_lines'] += 1
+        
+        segment['n_bytes'] += len(line)
+        self.at_line_start = line.endswith('\n')
+        self.segment_file.write(line)
+    
+    def flush(self):
+        self.segment_file.flush()
+    
+    def fileno(self):
+        return self.segment_file.fileno()
+    
+    def close(self):
+        self.close_segment()
+
+# High-rate lines can be routed to a side stream named like the output file
+# plus this
+side_stream_suffix = '.side'
+
+class LineRouter(object):
+    """Separates high-rate lines from the device into a side stream.
+    
+    A line is a side line if its text after the timestamp begins with one
+    of `prefixes`, eg 'SENH' or 'DBG L:'. Everything else is a control
+    line. Prefixes are matched on the whole text, so 'DBG L:' matches the
+    IR detector's debugging values but not 'DBG begin setup'.
+    
+    Only every `decimation`th side line with each prefix is sampled for
+    display, so that the echo and anything watching the lines keep up.
+    The side stream keeps all of them.
+    """
+    def __init__(self, prefixes, decimation=1):
+        self.prefixes = tuple(prefixes)
+        self.decimation = decimation
+        
+        # Statistics, and the decimation phase, by prefix
+        self.n_control_lines = 0
+        self.n_side_lines = dict([(prefix, 0) for prefix in self.prefixes])
+        self.n_sampled_lines = 0
+    
+    def get_prefix(self, line):
+        """Returns which of `prefixes` `line` begins with, or None"""
+        start = line.find(' ') + 1
+        if start == 0 or not line.startswith(self.prefixes, start):
+            return None
+        for prefix in self.prefixes:
+            if line.startswith(prefix, start):
+                return prefix
+    
+    def route(self, lines, receive_times=None):
+        """Split `lines` into control lines and side lines.
+        
+        `receive_times` : if not None, the host time at which each line was
+            received, to be routed along with the lines
+        
+        Returns: control_lines, side_lines, sampled_lines, control_times,
+            sampled_times
+            sampled_lines are the control lines and the sampled side 
+            lines, in their original order. The times are of the control
+            and sampled lines, or None if `receive_times` is None.
+        """
+        if receive_times is None:
+            receive_times = [None] * len(lines)
+        control_lines = []
+        side_lines = []
+        sampled_lines = []
+        control_times = []
+        sampled_times = []
+        for line, receive_time in zip(lines, receive_times):
+            prefix = self.get_prefix(line)
+            if prefix is None:
+                control_lines.append(line)
+                sampled_lines.append(line)
+                control_times.append(receive_time)
+                sampled_times.append(receive_time)
+                continue
+            
+            side_lines.append(line)
+            if self.n_side_lines[prefix] % self.decimation == 0:
+                sampled_lines.append(line)
+                sampled_times.append(receive_time)
+                self.n_sampled_lines += 1
+            self.n_side_lines[prefix] += 1
+        
+        self.n_control_lines += len(control_lines)
+        return (control_lines, side_lines, sampled_lines, control_times, 
+            sampled_times)
+    
+    def get_stats(self):
+        """Returns a dict of the number of lines routed each way"""
+        return {
+            'n_control_lines': self.n_control_lines,
+            'n_side_lines': dict(self.n_side_lines),
+            'n_sampled_lines': self.n_sampled_lines,
+            }
+
+class LogWriter(object):
+    """Buffers lines for a log file, and writes them out according to a policy.
+    
+    Lines are held in memory and written in a single call when any of these
+    is true:
+    * a line begins (after its timestamp) with one of `flush_tokens`, so
+      that trial boundaries reach the disk immediately
+    * `flush_lines` lines are waiting
+    * `flush_interval` seconds have passed since the last write
+    
+    If `flush_lines` and `flush_interval` are both None, lines are written
+    on every call to `write_lines`.
+    
+    If `fsync` is True, each write is followed by an fsync, so that it
+    survives a crash of the machine as well as of this process.
+    """
+    def __init__(self, buffer, flush_interval=None, flush_lines=None,
+        flush_tokens=('TRL_START', 'TRLR', 'TRL_RELEASED'), fsync=False):
+        self.buffer = buffer
+        self.flush_interval = flush_interval
+        self.flush_lines = flush_lines
+        self.flush_tokens = flush_tokens
+        self.fsync = fsync
+        self.pending_chunks = []
+        self.n_pending_lines = 0
+        self.last_flush_time = get_monotonic_time()
+        
+        # Statistics
+        self.n_lines_written = 0
+        self.n_flushes = 0
+        self.max_flush_duration = 0.
+    
+    def write_lines(self, lines, data=None):
+        """Add `lines` to the buffer, and write it out if the policy says so.
+        
+        Call this on every update, even with no lines, so that the
+        flush_interval is honored.
+        
+        `data` : if not None, `lines` already joined together. It is kept
+            instead of joining them again.
+        """
+        if len(lines) > 0:
+            if data is None:
+                data = ''.join(lines)
+            self.pending_chunks.append(data)
+            self.n_pending_lines += len(lines)
+        if self.n_pending_lines == 0:
+            return
+        
+        if self.flush_lines is None and self.flush_interval is None:
+            flush = True
+        elif self.flush_lines is not None and (
+            self.n_pending_lines >= self.flush_lines):
+            flush = True
+        elif self.flush_interval is not None and (
+            get_monotonic_time() - self.last_flush_time >= 
+            self.flush_interval):
+            flush = True
+        else:
+            flush = self.has_flush_token(lines)
+        
+        if flush:
+            self.flush()
+    
+    def get_next_flush_time(self):
+        """Returns when the waiting lines are due by `flush_interval`, or None"""
+        if self.flush_interval is None or self.n_pending_lines == 0:
+            return None
+        return self.last_flush_time + self.flush_interval
+    
+    def has_flush_token(self, lines):
+        """True if any of `lines` has one of `flush_tokens` as its command"""
+        for line in lines:
+            sp_line = line.split(None, 2)
+            if len(sp_line) > 1 and sp_line[1] in self.flush_tokens:
+                return True
+        return False
+    
+    def flush(self):
+        """Write out all waiting lines"""
+        start_time = get_monotonic_time()
+        if self.n_pending_lines > 0:
+            write_to_user(self.buffer, self.pending_chunks)
+            if self.fsync:
+                os.fsync(self.buffer.fileno())
+            self.n_lines_written += self.n_pending_lines
+            self.n_flushes += 1
+            self.pending_chunks = []
+            self.n_pending_lines = 0
+        
+        self.last_flush_time = get_monotonic_time()
+        flush_duration = self.last_flush_time - start_time
+        if flush_duration > self.max_flush_duration:
+            self.max_flush_duration = flush_duration
+    
+    def get_stats(self):
+        """Returns a dict of the number of lines written and flushes"""
+        return {
+            'n_pending': self.n_pending_lines,
+            'n_lines_written': self.n_lines_written,
+            'n_flushes': self.n_flushes,
+            'max_flush_duration': self.max_flush_duration,
+            }
+    
+    def close(self):
+        """Write out any waiting lines. Does not close the file."""
+        self.flush()
+
 
 ## From user to device
 def read_from_user(buffer, buffer_size=1024):
@@ -73,6 +1496,397 @@ def write_to_device(device, data):
         device.write(data)
 
 
+## Startup
+# Printed by every sketch at the beginning of setup()
+startup_banner = 'DBG begin setup'
+# Answered by chat.cpp with "<millis> HELLO"
+hello_command = 'HELLO'
+
+def is_ready_line(line):
+    """Returns True if `line` is the setup banner or a reply to HELLO"""
+    if not isinstance(line, str):
+        line = line.decode('ascii', 'replace')
+    if startup_banner in line:
+        return True
+    return line.split()[1:] == [hello_command]
+
+def wait_for_device_ready(device, timeout, hello_interval=0.5, 
+    poll_interval=0.01):
+    """Wait until the sketch on `device` is running, or `timeout` seconds.
+    
+    A device that is reset by opening the port prints the setup banner 
+    once its bootloader is done. One that is not (eg, an emulator, or a
+    board whose auto-reset is disabled) is sent HELLO every
+    `hello_interval` seconds until it answers. The first HELLO is not sent
+    until `hello_interval` has passed, to give a bootloader time to finish.
+    
+    Everything received before the banner or the answer is discarded,
+    including leftover input from a previous run.
+    
+    Returns: ready, lines, partial_line
+        ready is False if `timeout` passed first. lines are the banner or
+        answer and any complete lines after it, as text, and partial_line
+        is the bytes after them without a newline.
+    """
+    device.flushInput()
+    start_time = get_monotonic_time()
+    if hello_interval is None:
+        next_hello_time = None
+    else:
+        next_hello_time = start_time + hello_interval
+    
+    partial_line = b''
+    while get_monotonic_time() - start_time < timeout:
+        n_bytes = get_n_bytes_waiting(device)
+        if n_bytes == 0:
+            if (next_hello_time is not None and 
+                get_monotonic_time() >= next_hello_time):
+                write_to_device(device, hello_command + '\n')
+                next_hello_time += hello_interval
+            time.sleep(poll_interval)
+            continue
+        
+        lines, partial_line = split_complete_lines(
+            device.read(n_bytes), partial_line)
+        for nline, line in enumerate(lines):
+            if is_ready_line(line):
+                return True, [decode_device_text(ready_line) 
+                    for ready_line in lines[nline:]], partial_line
+    
+    return False, [], b''
+
+
+## Control endpoint
+class ControlConnection(object):
+    """One client of a ControlServer, with its unparsed input and unsent
+    replies"""
+    def __init__(self, sock):
+        self.sock = sock
+        self.in_data = b''
+        self.out_data = b''
+
+class ControlServer(object):
+    """Accepts commands for a running Chatter over local sockets.
+    
+    Clients connect to a Unix-domain socket, or to a TCP port on localhost,
+    and send requests as JSON objects, one per line. Each request gets one
+    reply, a JSON object on one line with the request's 'id' and 'ok'.
+    Requests are:
+    
+        {"id": 1, "op": "send", "line": "SET RD_L 50", "lane": "urgent"}
+            Queue a line for the device (the lane defaults to 'bulk'). The
+            reply comes once the device acknowledges it, with its latency
+            in seconds, or with ok false if it was given up on. If "wait"
+            is false, the reply comes once it is queued.
+        {"id": 2, "op": "status"}
+            Statistics of the Chatter. See `get_status`.
+        {"id": 3, "op": "ping"}
+    
+    Malformed requests get ok false and an 'error'. Any number of clients 
+    may be connected at once. Nothing here blocks: the sockets are serviced
+    on each Chatter.update. Use ControlClient to make requests.
+    """
+    def __init__(self, chatter, unix_path=None, tcp_port=None, 
+        selector=None, max_request_size=4096):
+        """Initialize a new ControlServer.
+        
+        `unix_path` : path of a Unix-domain socket to listen on. Any 
+            existing socket there is replaced.
+        `tcp_port` : TCP port to listen on, on localhost only
+        `selector` : if not None, a selector that our sockets are 
+            registered with, so that a Chatter waiting on it wakes up for
+            requests
+        `max_request_size` : a client sending a longer line is disconnected
+        """
+        self.chatter = chatter
+        self.unix_path = unix_path
+        self.selector = selector
+        self.max_request_size = max_request_size
+        self.listen_socks = []
+        self.connections = {}
+        self.n_requests = 0
+        
+        # Callbacks for other event loops to follow our sockets
+        self.sock_watchers = []
+        
+        if unix_path is not None:
+            if os.path.exists(unix_path):
+                os.remove(unix_path)
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.bind(unix_path)
+            self.add_listen_sock(sock)
+        if tcp_port is not None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind(('127.0.0.1', tcp_port))
+            self.add_listen_sock(sock)
+    
+    def add_listen_sock(self, sock):
+        sock.listen(5)
+        sock.setblocking(False)
+        self.listen_socks.append(sock)
+        if self.selector is not None:
+            self.selector.register(sock, selectors.EVENT_READ)
+        self.notify_sock_watchers(sock, True)
+    
+    def get_socks(self):
+        """Returns the sockets to wait on for requests"""
+        return self.listen_socks + [conn.sock 
+            for conn in self.connections.values()]
+    
+    def get_filenos(self):
+        """Returns the file descriptors to wait on for requests"""
+        return [sock.fileno() for sock in self.get_socks()]
+    
+    def add_sock_watcher(self, on_add, on_remove):
+        """Follow the sockets to wait on, as clients come and go.
+        
+        `on_add(sock)` is called now for each socket in `get_socks`, and
+        then for each new one. `on_remove(sock)` is called just before
+        each is closed. This is for an event loop other than `selector`
+        that should wake up for requests.
+        
+        Returns: the watcher, for `remove_sock_watcher`
+        """
+        watcher = (on_add, on_remove)
+        self.sock_watchers.append(watcher)
+        for sock in self.get_socks():
+            on_add(sock)
+        return watcher
+    
+    def remove_sock_watcher(self, watcher):
+        """Stop following the sockets, calling `on_remove` for each"""
+        self.sock_watchers.remove(watcher)
+        on_add, on_remove = watcher
+        for sock in self.get_socks():
+            on_remove(sock)
+    
+    def notify_sock_watchers(self, sock, added):
+        for on_add, on_remove in list(self.sock_watchers):
+            if added:
+                on_add(sock)
+            else:
+                on_remove(sock)
+    
+    def update(self):
+        """Accept clients, handle their requests, and send replies"""
+        for sock in self.listen_socks:
+            self.accept(sock)
+        for conn in list(self.connections.values()):
+            self.receive(conn)
+        for conn in list(self.connections.values()):
+            self.send_replies(conn)
+    
+    def accept(self, listen_sock):
+        while True:
+            try:
+                sock, address = listen_sock.accept()
+            except socket.error as err:
+                if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            sock.setblocking(False)
+            self.connections[sock.fileno()] = ControlConnection(sock)
+            if self.selector is not None:
+                self.selector.register(sock, selectors.EVENT_READ)
+            self.notify_sock_watchers(sock, True)
+    
+    def disconnect(self, conn):
+        if self.selector is not None:
+            self.selector.unregister(conn.sock)
+        self.notify_sock_watchers(conn.sock, False)
+        self.connections.pop(conn.sock.fileno())
+        conn.sock.close()
+    
+    def receive(self, conn):
+        """Read what `conn` has sent, and handle each complete request"""
+        while True:
+            try:
+                data = conn.sock.recv(4096)
+            except socket.error as err:
+                if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                self.disconnect(conn)
+                return
+            if len(data) == 0:
+                # The client closed the connection
+                self.disconnect(conn)
+                return
+            conn.in_data += data
+        
+        requests = conn.in_data.split(b'\n')
+        conn.in_data = requests.pop()
+        if len(conn.in_data) > self.max_request_size:
+            self.disconnect(conn)
+            return
+        for request in requests:
+            if len(request.strip()) > 0:
+                self.handle_request(conn, request)
+    
+    def reply(self, conn, reply):
+        """Queue `reply` for `conn`, if it is still connected"""
+        conn.out_data += (json.dumps(reply) + '\n').encode('utf-8')
+    
+    def send_replies(self, conn):
+        while len(conn.out_data) > 0:
+            try:
+                n_sent = conn.sock.send(conn.out_data)
+            except socket.error as err:
+                if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                self.disconnect(conn)
+                return
+            conn.out_data = conn.out_data[n_sent:]
+    
+    def handle_request(self, conn, data):
+        """Carry out one request from `conn`, and reply"""
+        self.n_requests += 1
+        try:
+            request = json.loads(data.decode('utf-8'))
+            request_id = request.get('id')
+            op = request['op']
+        except (ValueError, KeyError, AttributeError, TypeError):
+            self.reply(conn, {'id': None, 'ok': False, 
+                'error': 'malformed request'})
+            return
+        
+        if op == 'ping':
+            self.reply(conn, {'id': request_id, 'ok': True})
+        elif op == 'status':
+            self.reply(conn, {'id': request_id, 'ok': True, 
+                'status': self.get_status()})
+        elif op == 'send':
+            self.handle_send(conn, request_id, request)
+        else:
+            self.reply(conn, {'id': request_id, 'ok': False,
+                'error': 'unknown op: %s' % op})
+    
+    def handle_send(self, conn, request_id, request):
+        line = request.get('line')
+        if not isinstance(line, basestring_type) or (
+            len(line.strip()) == 0 or '\n' in line.strip()):
+            self.reply(conn, {'id': request_id, 'ok': False, 
+                'error': 'line must be one non-empty line'})
+            return
+        
+        # The device only speaks ASCII. On Python 2, json gives unicode.
+        try:
+            line.encode('ascii')
+        except UnicodeError:
+            self.reply(conn, {'id': request_id, 'ok': False, 
+                'error': 'line must be ASCII'})
+            return
+        lane = request.get('lane', 'bulk')
+        if lane not in [write_lane.name 
+            for write_lane in self.chatter.write_lanes]:
+            self.reply(conn, {'id': request_id, 'ok': False, 
+                'error': 'unknown write lane: %s' % lane})
+            return
+        
+        if request.get('wait', True):
+            def callback(acknowledged, latency):
+                if acknowledged:
+                    self.reply(conn, {'id': request_id, 'ok': True,
+                        'latency': latency})
+                else:
+                    self.reply(conn, {'id': request_id, 'ok': False,
+                        'error': 'not acknowledged'})
+        else:
+            callback = None
+        
+        self.chatter.queued_write_to_device(str(line.strip()), lane=lane,
+            callback=callback)
+        if callback is None:
+            self.reply(conn, {'id': request_id, 'ok': True})
+    
+    def get_status(self):
+        """Returns a dict of the Chatter's statistics"""
+        chatter = self.chatter
+        return {
+            'log_filename': chatter.ofi.name,
+            'write': chatter.get_write_stats(),
+            'write_lanes': chatter.get_write_lane_stats(),
+            'latency': chatter.get_latency_stats(),
+            'clock': chatter.get_clock_stats(),
+            'log': chatter.get_log_stats(),
+            'frames': chatter.get_frame_stats(),
+            'side_stream': chatter.get_side_stream_stats(),
+            'echo': chatter.get_echo_stats(),
+            'device_read': chatter.get_device_read_stats(),
+            'device_buffer': chatter.get_device_buffer_stats(),
+            'n_control_clients': len(self.connections),
+            }
+    
+    def close(self):
+        for conn in list(self.connections.values()):
+            self.send_replies(conn)
+            self.disconnect(conn)
+        for sock in self.listen_socks:
+            if self.selector is not None:
+                self.selector.unregister(sock)
+            self.notify_sock_watchers(sock, False)
+            sock.close()
+        self.listen_socks = []
+        if self.unix_path is not None and os.path.exists(self.unix_path):
+            os.remove(self.unix_path)
+
+class ControlClient(object):
+    """Makes requests of a Chatter's ControlServer, and waits for replies.
+    
+    Usage:
+        client = ControlClient(unix_path='/tmp/rig_L1.sock')
+        client.send('ACT REWARD_L', lane='urgent')
+        print(client.status()['write'])
+    """
+    def __init__(self, unix_path=None, tcp_port=None, timeout=5.):
+        if unix_path is not None:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            address = unix_path
+        elif tcp_port is not None:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            address = ('127.0.0.1', tcp_port)
+        else:
+            raise ValueError("must provide unix_path or tcp_port")
+        self.sock.settimeout(timeout)
+        self.sock.connect(address)
+        self.in_data = b''
+        self.next_id = 0
+        
+        # Replies to other requests that arrived while waiting
+        self.replies = {}
+    
+    def request(self, op, **kwargs):
+        """Send a request and return its reply, a dict"""
+        request_id = self.next_id
+        self.next_id += 1
+        request = dict(kwargs)
+        request['id'] = request_id
+        request['op'] = op
+        self.sock.sendall((json.dumps(request) + '\n').encode('utf-8'))
+        
+        while request_id not in self.replies:
+            data = self.sock.recv(4096)
+            if len(data) == 0:
+                raise IOError("control server closed the connection")
+            lines = (self.in_data + data).split(b'\n')
+            self.in_data = lines.pop()
+            for line in lines:
+                reply = json.loads(line.decode('utf-8'))
+                self.replies[reply['id']] = reply
+        return self.replies.pop(request_id)
+    
+    def send(self, line, lane='bulk', wait=True):
+        """Send `line` to the device. See ControlServer."""
+        return self.request('send', line=line, lane=lane, wait=wait)
+    
+    def status(self):
+        """Returns the Chatter's status. See ControlServer.get_status."""
+        return self.request('status')['status']
+    
+    def close(self):
+        self.sock.close()
+
+
 class Chatter:
     """Object to manage chat between serial device and user.
     
@@ -85,21 +1899,149 @@ class Chatter:
     Call `close` to shut down the connections.
     
     Call `main_loop` to iterate over `update` calls until CTRL+C is received.
+    
+    In event-driven mode, `update` waits on the serial port and the input
+    pipe together, and returns as soon as either has data instead of
+    always waiting out the serial timeout. Use `run_until` to block until
+    some condition is met, or `add_to_event_loop` to have an asyncio
+    event loop call `update` whenever data arrives. Either also calls
+    `update` at each deadline (see `get_next_deadline`), so that lines
+    are retransmitted and the log is flushed while the device is quiet.
     """
     def __init__(self, serial_port='/dev/ttyACM0', from_user='TO_DEV', 
-        to_user=None, to_user_dir=None, serial_timeout=0.01, baud_rate=9600):
+        to_user=None, to_user_dir=None, serial_timeout=0.01, baud_rate=9600,
+        event_driven=False, reader_thread=False, max_lines_per_update=None,
+        ring_buffer_size=10000, ack_window_size=1, ack_window_bytes=None,
+        ack_timeout=None, max_retransmits=3, retransmit_backoff=2.0,
+        no_retransmit_tokens=('RELEASE_TRL', 'ACT'), host_timestamps=False,
+        clock_forgetting_factor=1.0, latency_snapshot_interval=None,
+        log_flush_interval=None, log_flush_lines=None, 
+        log_flush_tokens=('TRL_START', 'TRLR', 'TRL_RELEASED'), 
+        log_fsync=False, compression=None, log_segment_size=None,
+        binary_frames=False, control_socket=None, control_port=None,
+        startup_timeout=None, hello_interval=0.5, side_stream_prefixes=None,
+        side_stream_decimation=1, echo_queue_size=1000):
         """Initialize a new Chatter.
         
         `serial_port` : where the device is located
-        `from_user` : name of pipe to use to collect user's input
+        `from_user` : name of pipe to use to collect user's input. If None,
+            there is no pipe, and input comes only from the control socket
+            and from queued_write_to_device.
         `to_user` : name of file to print information from the device
             If None, autonames with the datetime
             If `to_user_dir` is not None, puts in that directory
+        `serial_timeout` : how long to wait for the device on each update
+        `event_driven` : if True, the serial port is read without blocking
+            and `update` waits at most `serial_timeout` for either the
+            device or the user, returning as soon as either has data.
+            Only available on Unix-based systems.
+        `reader_thread` : if True, a background thread continuously drains
+            the serial port into a bounded buffer of lines, and `update`
+            takes lines from that buffer, waiting at most `serial_timeout`.
+            Cannot be combined with `event_driven`.
+        `max_lines_per_update` : in reader_thread mode, the maximum number
+            of lines taken on each `update`. None means all waiting lines.
+        `ring_buffer_size` : in reader_thread mode, the maximum number of
+            lines waiting in the buffer. Beyond this the oldest are dropped,
+            and a line like "ERR host dropped 10 lines" is written to the
+            output file in their place.
+        `ack_window_size` : the maximum number of queued writes that may be
+            sent before they are acknowledged. The default of 1 waits for
+            each acknowledgement before sending the next line. If None, 
+            only `ack_window_bytes` limits them.
+        `ack_window_bytes` : if not None, the maximum number of bytes
+            (including newlines) that may be unacknowledged at once. Set
+            this to the device's serial receive buffer size (64 on an Uno)
+            so that pipelined lines cannot overrun it. Lines from the pipe
+            are then queued in the urgent lane, so that they count too.
+            See `get_write_stats` for how often writes stalled waiting for
+            room, and how deep the backlog got.
+        `ack_timeout` : if not None, how long in seconds to wait for the
+            acknowledgement of a line before retransmitting it. If None,
+            we wait forever.
+        `max_retransmits` : how many times to retransmit a line before
+            giving up on it
+        `retransmit_backoff` : each retransmission waits this many times
+            longer than the last
+        `no_retransmit_tokens` : lines beginning with these are not
+            idempotent (eg, releasing a trial twice would skip a trial),
+            so they are never retransmitted. On timeout they are given up.
+        
+        Lines that are given up on are removed from the window, so the
+        rest of the queue can proceed, and are counted as failures. See
+        `get_write_stats`.
+        
+        `host_timestamps` : if True, a binary sidecar file named like the
+            output file plus '.times' records the host receive time and
+            byte offset of every line from the device. Use
+            TrialSpeak.read_host_timestamps to read it.
+        `clock_forgetting_factor` : passed to the DeviceClockEstimator that
+            maps the device's millis() to monotonic host time as lines
+            arrive. See `clock_estimator` and `get_clock_stats`.
+        `latency_snapshot_interval` : if not None, every this many seconds
+            the latency statistics (see `get_latency_stats`) are written
+            as JSON to a file named like the output file plus
+            '.latency.json'. They are also written on `close`.
+        `log_flush_interval`, `log_flush_lines`, `log_flush_tokens`,
+            `log_fsync` : when lines from the device are written to the
+            output file. By default, on every update. See LogWriter.
+            Anything else reading the output file, such as a
+            TrialSpeak.LogFollower, only sees lines once written.
+        `compression` : if 'gzip' or 'lzma', the output file is compressed
+            as it is written, and '.gz' or '.xz' is added to its name.
+            See CompressedLogFile. Use the log_flush_* options so that it
+            is not flushed, and the compression ratio lost, on every update.
+        `log_segment_size` : if not None, the output file is split into
+            segments of about this many bytes, with a manifest. See
+            SegmentedLogFile. The readers in TrialSpeak treat the segments
+            as one log named like the output file.
+        `binary_frames` : if True, the device is asked to send binary 
+            records (eg, the IR detector's debugging values) instead of 
+            text lines, and they are separated from the text. They are 
+            available as `new_device_frames`, and written to a sidecar
+            named like the output file plus '.frames'. Use 
+            TrialSpeak.read_binary_records or decode_binary_frames to read
+            them. Control lines are still text.
+        `control_socket`, `control_port` : if not None, a Unix-domain
+            socket path and/or localhost TCP port on which to accept 
+            framed commands and status queries. See ControlServer and
+            ControlClient. Unlike the pipe, each command is acknowledged
+            to the client that sent it, and many clients can connect.
+        `startup_timeout` : if None, wait a fixed 2 seconds for the device
+            to start. Otherwise, wait at most this long for the sketch's
+            setup banner, or its answer to HELLO, discarding everything
+            before it. See wait_for_device_ready. `device_ready` is False
+            if it timed out, and `startup_duration` is how long it took.
+        `hello_interval` : how often to send HELLO while waiting
+        `side_stream_prefixes` : if not None, lines whose text after the
+            timestamp begins with one of these (eg 'DBG L:', 'DBG R:', 
+            'SENH') go to a side stream named like the output file plus
+            '.side' instead of the output file, which keeps the output 
+            file small and quick to parse. The side stream is compressed
+            like the output file, and written with the same log_flush_*
+            options. See LineRouter and TrialSpeak.read_side_lines.
+        `side_stream_decimation` : only every this many side lines with
+            each prefix are echoed, published to `event_bus`, and put in
+            `new_device_lines`. All of them are in `new_side_lines`.
+        `echo_queue_size` : when `update` echoes to stdout, it leaves the
+            lines to an EchoThread, so that a slow terminal cannot slow 
+            it down. If more than this many lines are waiting for the 
+            terminal, the oldest are skipped. If None, `update` writes to 
+            stdout itself, and waits for it.
         """
+        if event_driven and reader_thread:
+            raise ValueError("cannot use both event_driven and reader_thread")
+        self.event_driven = event_driven
+        self.max_lines_per_update = max_lines_per_update
+        self.serial_timeout = serial_timeout
+        
         ## Set up TO_DEV
         platformName = platform.system() #Implementation will depend on OS...
+        self.pipein_keepalive = None
+        if from_user is None:
+            self.pipein = None
         #...for Unix-based operating systems:
-        if platformName.find('Windows',0) == -1:
+        elif platformName.find('Windows',0) == -1:
             # Read from this pipe whenever something writes to it, and send
             # to device
             # Begin by deleting any existing FIFO or file, which should prevent stale
@@ -108,8 +2050,16 @@ class Chatter:
                 os.remove(from_user)
             os.mkfifo(from_user)
             self.pipein = os.open(from_user, os.O_RDONLY | os.O_NONBLOCK)
+            
+            # Once a writer closes the pipe, it always polls as readable
+            # (at EOF). Holding it open for writing ourselves prevents this.
+            if event_driven:
+                self.pipein_keepalive = os.open(from_user, 
+                    os.O_WRONLY | os.O_NONBLOCK)
         #...for Windows:
         else:
+            if event_driven:
+                raise ValueError("event_driven requires a Unix-based system")
             self.pipein = open(from_user, 'w') #opening the file with the 'w' flag will create a new file and overwrite any existing file named 'TO_DEV'
 
         ## Set up FROM_DEV
@@ -120,16 +2070,67 @@ class Chatter:
             if to_user_dir is not None:
                 to_user = os.path.join(
                     os.path.realpath(to_user_dir), to_user)
-        if sys.version_info<=(3,1):
+        if log_segment_size is not None:
+            self.ofi = SegmentedLogFile(to_user, log_segment_size, compression)
+        elif compression is not None:
+            suffix = compressed_log_suffixes.get(compression, '')
+            if not to_user.endswith(suffix):
+                to_user = to_user + suffix
+            self.ofi = CompressedLogFile(to_user, compression)
+        elif sys.version_info<=(3,1):
             self.ofi = file(to_user, 'w')
         else:
-            self.ofi = open(to_user, 'w')
+            self.ofi = open_text_log(to_user)
+        self.log_writer = LogWriter(self.ofi, 
+            flush_interval=log_flush_interval, flush_lines=log_flush_lines,
+            flush_tokens=log_flush_tokens, fsync=log_fsync)
+        
+        # Sidecar of host receive times, and where we are in the output file
+        self.timestamps_file = None
+        if host_timestamps:
+            self.timestamps_file = open(to_user + host_timestamps_suffix, 'wb')
+        self.n_bytes_to_user = 0
+        
+        # Echo to stdout in the background, started by the first echo
+        self.echo_queue_size = echo_queue_size
+        self.echo_thread = None
+        
+        # High-rate lines, routed to their own file
+        self.line_router = None
+        self.side_file = None
+        self.side_log_writer = None
+        self.new_side_lines = []
+        if side_stream_prefixes is not None:
+            self.line_router = LineRouter(side_stream_prefixes, 
+                side_stream_decimation)
+            side_filename = to_user + side_stream_suffix
+            if compression is not None:
+                side_filename += compressed_log_suffixes.get(compression, '')
+                self.side_file = CompressedLogFile(side_filename, compression)
+            else:
+                self.side_file = open_text_log(side_filename)
+            self.side_log_writer = LogWriter(self.side_file, 
+                flush_interval=log_flush_interval, 
+                flush_lines=log_flush_lines, flush_tokens=(), fsync=log_fsync)
+        
+        # Binary frames interleaved with the text
+        self.frame_splitter = None
+        self.frames_file = None
+        self.new_device_frames = []
+        if binary_frames:
+            self.frame_splitter = BinaryFrameSplitter()
+            self.frames_file = open(to_user + binary_frames_suffix, 'wb')
             
         ## Set up device
         # 0 means return whatever is available immediately
         # otherwise, wait for specified time
         # 0.01 takes a noticeable but small amount of CPU time
-        self.ser = serial.Serial(serial_port, baud_rate, timeout=serial_timeout)
+        # In event-driven mode, we wait in wait_for_input instead.
+        if event_driven:
+            self.ser = serial.Serial(serial_port, baud_rate, timeout=0)
+        else:
+            self.ser = serial.Serial(serial_port, baud_rate, 
+                timeout=serial_timeout)
 
         # This should reset arduino with new serial connection
         if (platform.system().lower() == "darwin"):
@@ -138,9 +2139,22 @@ class Chatter:
             self.ser.setDTR(True)
 
         # Wait for it to initialize the arduino
-        time.sleep(1) # without this sleep, still leftover input from previous run
-        self.ser.flushInput() # otherwise still input from previous run pending
-        time.sleep(1) # without this sleep, it will not send the first line or so to the device
+        self.startup_lines = []
+        startup_partial_line = b''
+        startup_start_time = get_monotonic_time()
+        if startup_timeout is None:
+            self.device_ready = None
+            time.sleep(1) # without this sleep, still leftover input from previous run
+            self.ser.flushInput() # otherwise still input from previous run pending
+            time.sleep(1) # without this sleep, it will not send the first line or so to the device
+        else:
+            # Once it has spoken, it is reading what we send, and anything
+            # left from a previous run has been discarded
+            self.device_ready, self.startup_lines, startup_partial_line = (
+                wait_for_device_ready(self.ser, startup_timeout, 
+                hello_interval))
+        self.startup_lines_time = get_monotonic_time()
+        self.startup_duration = self.startup_lines_time - startup_start_time
         
         # these don't appear to be necessary??
         # actually, the chatter still picks up leftover input
@@ -151,86 +2165,831 @@ class Chatter:
         
         self.new_user_text = ''
         self.new_device_lines = []
+        self.new_device_lines_times = []
+        
+        # Consumers subscribe here to the lines from the device, parsed
+        self.event_bus = DeviceEventBus()
+        
+        # Map the device clock onto the host clock
+        self.clock_estimator = DeviceClockEstimator(clock_forgetting_factor)
+        
+        # Latency histograms, keyed by the command that was acknowledged,
+        # or by trial_release_latency_key
+        self.latency_histograms = {}
+        self.trial_result_device_time = None
+        self.latency_snapshot_interval = latency_snapshot_interval
+        self.latency_snapshot_filename = to_user + latency_snapshot_suffix
+        self.last_latency_snapshot_time = get_monotonic_time()
+        
+        # Drain the device in the background, or read it in bulk on each 
+        # update. Either way, a partial line is held until the rest arrives.
+        self.device_reader = None
+        self.device_line_buffer = None
+        self.device_reader_thread = None
+        if reader_thread:
+            self.device_line_buffer = LineRingBuffer(ring_buffer_size)
+            self.device_reader_thread = DeviceReaderThread(
+                self.ser, self.device_line_buffer, startup_partial_line,
+                frame_splitter=self.frame_splitter)
+            self.device_reader_thread.start()
+        else:
+            self.device_reader = DeviceLineReader(self.ser, 
+                frame_splitter=self.frame_splitter, 
+                partial_line=startup_partial_line)
+        
+        # Wait on the device and the user together
+        self.selector = None
+        if event_driven and selectors is not None:
+            self.selector = selectors.DefaultSelector()
+            self.selector.register(self.ser.fileno(), selectors.EVENT_READ)
+            if self.pipein is not None:
+                self.selector.register(self.pipein, selectors.EVENT_READ)
+        
+        # An asyncio event loop calling `update`. See add_to_event_loop.
+        self.event_loop = None
+        self.event_loop_handle = None
+        self.event_loop_wake = None
+        self.event_loop_watcher = None
         
         # Check for acknowledged lines
         self.last_sent_line = None
         self.last_sent_line_acknowledged = True
-        self.queued_writes = []
+        
+        # Queued writes, in priority order. Urgent operator commands (eg
+        # manual rewards) jump ahead of bulk parameter uploads.
+        self.write_lanes = [WriteLane('urgent'), WriteLane('bulk')]
+        
+        # Lines that have been sent but not acknowledged, oldest first
+        self.ack_window_size = ack_window_size
+        self.ack_window_bytes = ack_window_bytes
+        self.unacknowledged_lines = []
+        
+        # Retransmission of lines that are not acknowledged in time
+        self.ack_timeout = ack_timeout
+        self.max_retransmits = max_retransmits
+        self.retransmit_backoff = retransmit_backoff
+        self.no_retransmit_tokens = no_retransmit_tokens
+        self.n_lines_sent = 0
+        self.n_lines_acknowledged = 0
+        self.n_retransmits = 0
+        self.n_skipped_retransmits = 0
+        self.failed_lines = []
+        
+        # Lines that were acknowledged or given up on while other copies of
+        # them may still be acknowledged. Those ACKs are consumed here, 
+        # rather than taken for a later identical line, and the copies
+        # count against the window until then, or for `ack_timeout`.
+        self.resent_lines = []
+        self.n_stray_acks = 0
+        
+        # Backlog and stalls, when queued writes wait for room in the window
+        self.max_unacknowledged_lines = 0
+        self.max_unacknowledged_bytes = 0
+        self.max_queued_lines = 0
+        self.write_stall_start_time = None
+        self.n_write_stalls = 0
+        self.total_write_stall_time = 0.
+        self.max_write_stall_time = 0.
+        
+        # Text from the pipe after its last newline, when it is queued
+        self.partial_user_text = ''
+        
+        if binary_frames:
+            self.queued_write_to_device(binary_mode_command)
+        
+        # Commands and queries from scripts and dashboards
+        self.control_server = None
+        if control_socket is not None or control_port is not None:
+            self.control_server = ControlServer(self, 
+                unix_path=control_socket, tcp_port=control_port, 
+                selector=self.selector)
 
-    def update(self, echo_to_stdout=True):
+    def update(self, echo_to_stdout=True, wait=True):
         """Called repeatedly to deal with inputs and outputs
         
         * Reads any user text on the pipe and writes to device
-        * Reads any lines from the devices and writes to output file
-        * Optionally echos to stdout
+        * Reads any lines from the devices and writes to output file. 
+          `new_device_lines_times` is the host time at which each of
+          `new_device_lines` was read from the device.
+        * Optionally echos to stdout, in the background (see EchoThread)
+        * Publishes the lines to the subscribers of `event_bus`
         * Checks whether the last sent command was acknowledged
-        * If it was acknoweledged, then sends top of queued_writes
+        * If there is room in the window, sends queued writes, taking the
+          urgent lane before the bulk lane
         
-        Right now there is a bug in which the Arduino can write text so quickly
-        that this function will get stuck at reading from devices. Need some
-        kind of maximum read size check for this. Alternatively, insert delays
-        in the Arduino loop function.
+        Lines from the device are read in bulk by a DeviceLineReader, which
+        takes only what is already waiting, so an Arduino that writes text
+        quickly cannot keep us reading here. If nothing is waiting, this
+        waits up to `serial_timeout` for it.
+        
+        In event-driven mode, this first waits up to `serial_timeout` for
+        input from the device or the user, but returns as soon as there is
+        some. If `wait` is False, it does not wait, eg because the caller
+        already has.
+        
+        In reader_thread mode, lines are taken from the buffer filled by the
+        reader thread, at most `max_lines_per_update` at a time, so a burst
+        of output from the device cannot trap us here.
         """
+        if self.event_driven and wait:
+            self.wait_for_input(self.serial_timeout)
         
         # Read any new text from the user and send to device
-        self.new_user_text = read_from_user(self.pipein)
-        #print('new_user_text = ' + self.new_user_text) #DK 160319 here for debugging
-        write_to_device(self.ser, self.new_user_text)
+        if self.pipein is not None:
+            self.new_user_text = read_from_user(self.pipein)
+            #print('new_user_text = ' + self.new_user_text) #DK 160319 here for debugging
+            if self.ack_window_bytes is None:
+                write_to_device(self.ser, self.new_user_text)
+            else:
+                self.queue_user_text(self.new_user_text)
         
-        # Read any new lines from the device and send to user
-        self.new_device_lines = read_from_device(self.ser)
+        # Queue commands from the control socket
+        if self.control_server is not None:
+            self.control_server.update()
+        
+        # Read any new lines from the device and send to user, with the
+        # host time at which each was read
+        new_device_data = None
+        if self.device_line_buffer is not None:
+            (self.new_device_lines, self.new_device_lines_times, 
+                n_dropped) = self.device_line_buffer.get_with_times(
+                self.max_lines_per_update, timeout=self.serial_timeout)
+            
+            # Mark where the buffer overflowed, so the log shows the gap
+            if n_dropped > 0:
+                if len(self.new_device_lines_times) > 0:
+                    gap_time = self.new_device_lines_times[0]
+                else:
+                    gap_time = get_monotonic_time()
+                self.new_device_lines.insert(0, 
+                    ring_buffer_gap_marker % n_dropped)
+                self.new_device_lines_times.insert(0, gap_time)
+            if self.frame_splitter is not None:
+                self.write_binary_frames(
+                    self.device_reader_thread.get_frames())
+        else:
+            self.new_device_lines = self.device_reader.read()
+            self.new_device_lines_times = [self.device_reader.read_time
+                ] * len(self.new_device_lines)
+            new_device_data = self.device_reader.new_data
+            if self.frame_splitter is not None:
+                self.write_binary_frames(self.device_reader.new_frames)
+        
+        # Lines that arrived during the startup handshake, after the banner
+        if len(self.startup_lines) > 0:
+            self.new_device_lines = self.startup_lines + self.new_device_lines
+            self.new_device_lines_times = [self.startup_lines_time] * len(
+                self.startup_lines) + self.new_device_lines_times
+            self.startup_lines = []
+            new_device_data = None
+        self.clock_estimator.add_lines(self.new_device_lines, 
+            self.new_device_lines_times)
+        
+        # High-rate lines go to the side stream, and are sampled for display
+        if self.line_router is not None:
+            (control_lines, self.new_side_lines, self.new_device_lines,
+                control_times, self.new_device_lines_times) = (
+                self.line_router.route(self.new_device_lines, 
+                self.new_device_lines_times))
+            self.side_log_writer.write_lines(self.new_side_lines)
+            if len(self.new_side_lines) > 0:
+                new_device_data = None
+        else:
+            control_lines = self.new_device_lines
+            control_times = self.new_device_lines_times
+        if new_device_data is None:
+            new_device_data = ''.join(control_lines)
         """
         #DK 160319 here for debugging
         print('new_device_lines = ') 
         for line in self.new_device_lines:
             print(line)
         """
-        write_to_user(self.ofi, self.new_device_lines)
+        self.log_writer.write_lines(control_lines, new_device_data)
+        if self.timestamps_file is not None:
+            self.n_bytes_to_user = write_host_timestamps(
+                self.timestamps_file, control_lines, control_times,
+                self.n_bytes_to_user)
         
         # Echo
         if echo_to_stdout:
-            write_to_user(sys.stdout, self.new_device_lines)
-            sys.stdout.flush()
+            if self.echo_queue_size is not None:
+                if self.echo_thread is None:
+                    self.echo_thread = EchoThread(sys.stdout, 
+                        self.echo_queue_size)
+                    self.echo_thread.start()
+                self.echo_thread.put(self.new_device_lines)
+            elif self.line_router is not None:
+                write_to_user(sys.stdout, self.new_device_lines)
+            else:
+                write_to_user(sys.stdout, [new_device_data])
+        
+        # Parse once for all subscribers
+        self.event_bus.publish(self.new_device_lines)
         
-        # Check whether last_sent_command was acknowledged
+        # Check whether the unacknowledged lines were acknowledged
         # Note that we always write to device (potentially setting
         # last_sent_line) before we read from device (potentially receiving
         # an acknowledgement).
-        if not self.last_sent_line_acknowledged:
+        if len(self.unacknowledged_lines) > 0 or len(self.resent_lines) > 0:
             for line in self.new_device_lines:
-                # Any line ending with "ACK %s" % self.last_sent_line qualifies
-                # This accounts for the time at the beginning.
-                # Should probably separate this logic somehow.
-                if line.strip().endswith('ACK ' + self.last_sent_line):
-                    self.last_sent_line_acknowledged = True
+                self.check_acknowledgement(line)
+        
+        # Time from each trial's outcome until the next trial is released
+        for line in self.new_device_lines:
+            if trial_result_token in line or trial_released_token in line:
+                self.check_trial_release(line)
+        if self.latency_snapshot_interval is not None and (
+            get_monotonic_time() - self.last_latency_snapshot_time >=
+            self.latency_snapshot_interval):
+            self.write_latency_snapshot()
+        
+        # Retransmit or give up on lines that have not been acknowledged
+        if self.ack_timeout is not None:
+            self.check_ack_deadlines()
+        
+        # Send queued writes while there is room in the window
+        self.send_queued_writes()
+        
+        # Send replies to commands acknowledged during this update
+        if self.control_server is not None:
+            self.control_server.update()
+
+    def send_queued_writes(self):
+        """Send queued writes, highest priority lane first, while they fit.
+        
+        A line is never sent ahead of an earlier line in its own lane, nor
+        ahead of a line in a higher priority lane.
+        
+        Waiting for room under `ack_window_bytes` is recorded as a stall,
+        because it means the device's receive buffer is full. Waiting
+        for ACKs under `ack_window_size` is how the window normally works,
+        so it is not.
+        """
+        for lane in self.write_lanes:
+            while len(lane) > 0:
+                limit = self.get_ack_window_limit(lane.lines[0])
+                if limit == 'bytes':
+                    if self.write_stall_start_time is None:
+                        self.write_stall_start_time = get_monotonic_time()
+                        self.n_write_stalls += 1
+                    return
+                elif limit is not None:
+                    if self.write_stall_start_time is not None:
+                        self.end_write_stall()
+                    return
+                if self.write_stall_start_time is not None:
+                    self.end_write_stall()
+                line, callback = lane.pop()
+                self.write_to_device(line, callback=callback)
+    
+    def end_write_stall(self):
+        """Record how long queued writes waited for room in the window"""
+        stall_time = get_monotonic_time() - self.write_stall_start_time
+        self.write_stall_start_time = None
+        self.total_write_stall_time += stall_time
+        if stall_time > self.max_write_stall_time:
+            self.max_write_stall_time = stall_time
+    
+    def queue_user_text(self, text):
+        """Queue the complete lines of `text` from the pipe, urgently.
+        
+        Anything after the last newline waits for the rest of its line.
+        """
+        if text is None:
+            return
+        if not isinstance(text, str):
+            text = text.decode('utf-8')
+        lines = (self.partial_user_text + text).split('\n')
+        self.partial_user_text = lines.pop()
+        for line in lines:
+            if len(line.strip()) > 0:
+                self.queued_write_to_device(line, lane='urgent')
+
+    def check_acknowledgement(self, line):
+        """Remove the unacknowledged line that `line` acknowledges, if any.
+        
+        Any line ending with "ACK %s" % sent_line qualifies. This accounts
+        for the time at the beginning. Acknowledgements may arrive in any
+        order; if identical copies are in flight, the oldest is taken.
+        That may be a copy of a retransmitted line that was already
+        acknowledged (see `resent_lines`), in which case the ACK is only
+        counted in `n_stray_acks`.
+        
+        The latency is from when the line was first written.
+        
+        Returns True if `line` was an acknowledgement.
+        """
+        stripped_line = line.strip()
+        acked_line = None
+        for sent_line in self.unacknowledged_lines + self.resent_lines:
+            if stripped_line.endswith('ACK ' + sent_line.line) and (
+                acked_line is None or sent_line.copy_send_times[0] < 
+                acked_line.copy_send_times[0]):
+                acked_line = sent_line
+        if acked_line is None:
+            return False
+        acked_line.copy_send_times.pop(0)
+        
+        # A duplicate of a line that was already dealt with
+        if acked_line in self.resent_lines:
+            self.n_stray_acks += 1
+            if len(acked_line.copy_send_times) == 0:
+                self.resent_lines.remove(acked_line)
+            return True
+        
+        self.unacknowledged_lines.remove(acked_line)
+        if len(acked_line.copy_send_times) > 0:
+            self.hold_resent_line(acked_line)
+        latency = get_monotonic_time() - acked_line.first_send_time
+        sp_line = acked_line.line.split()
+        if len(sp_line) > 0:
+            self.record_latency(sp_line[0], latency)
+        if acked_line.callback is not None:
+            acked_line.callback(True, latency)
+        self.last_sent_line_acknowledged = (
+            len(self.unacknowledged_lines) == 0)
+        self.n_lines_acknowledged += 1
+        return True
+    
+    def hold_resent_line(self, sent_line):
+        """Wait up to `ack_timeout` for the ACKs of the other copies"""
+        sent_line.deadline = get_monotonic_time() + self.ack_timeout
+        self.resent_lines.append(sent_line)
+    
+    def check_trial_release(self, line):
+        """Record the latency from a trial's outcome to the next release.
+        
+        Uses the device's timestamps on the first TRLR line of the trial
+        and on the TRL_RELEASED line, so this includes the time taken by
+        the host to notice the outcome and release the next trial.
+        """
+        sp_line = line.split()
+        if len(sp_line) < 2:
+            return
+        try:
+            device_time = int(sp_line[0])
+        except ValueError:
+            return
+        
+        if sp_line[1] == trial_result_token:
+            if self.trial_result_device_time is None:
+                self.trial_result_device_time = device_time
+        elif sp_line[1] == trial_released_token:
+            if self.trial_result_device_time is not None:
+                self.record_latency(trial_release_latency_key,
+                    (device_time - self.trial_result_device_time) / 1000.)
+            self.trial_result_device_time = None
+    
+    def record_latency(self, key, seconds):
+        """Add a latency in seconds to the histogram for `key`"""
+        if key not in self.latency_histograms:
+            self.latency_histograms[key] = LatencyHistogram()
+        self.latency_histograms[key].record(seconds)
+    
+    def get_latency_stats(self):
+        """Returns latency statistics, in seconds, keyed by command.
+        
+        For each command type that has been acknowledged, this is the time
+        from when it was first written until its ACK was received, even if
+        it was retransmitted. The key
+        'TRLR->TRL_RELEASED' is the time from each trial's outcome until
+        the next trial was released. See LatencyHistogram.get_stats.
+        """
+        return dict([(key, histogram.get_stats())
+            for key, histogram in self.latency_histograms.items()])
+    
+    def write_latency_snapshot(self, filename=None):
+        """Write `get_latency_stats` as JSON, replacing any previous one.
+        
+        `filename` : defaults to the output file plus '.latency.json'
+        """
+        if filename is None:
+            filename = self.latency_snapshot_filename
+        
+        write_json_atomically(self.get_latency_stats(), filename)
+        self.last_latency_snapshot_time = get_monotonic_time()
+    
+    def check_ack_deadlines(self):
+        """Retransmit, or give up on, lines whose deadline has passed.
+        
+        Each retransmission waits `retransmit_backoff` times longer than the
+        previous one. Lines beginning with `no_retransmit_tokens`, lines
+        that have been retransmitted `max_retransmits` times, and lines 
+        too long for another copy to ever fit in `ack_window_bytes`, are
+        given up on instead: they are removed from the window and appended
+        to `failed_lines`.
         
-        # Send a queued write if ready
-        if self.last_sent_line_acknowledged and len(self.queued_writes) > 0:            
-            self.write_to_device(self.queued_writes.pop(0))
+        The device may only be busy (eg, rotating the stepper), with the
+        earlier copies still in its receive buffer, so those copies count
+        against `ack_window_bytes`. A retransmission for which another
+        copy does not fit is skipped, and counted in 
+        `n_skipped_retransmits`, but it still counts towards
+        `max_retransmits`, so that the line is given up on in the same
+        time either way. Copies of lines that were acknowledged or given
+        up on are waited for in `resent_lines`, for `ack_timeout`.
+        """
+        now = get_monotonic_time()
+        for sent_line in list(self.resent_lines):
+            if now >= sent_line.deadline:
+                self.resent_lines.remove(sent_line)
+        
+        for sent_line in list(self.unacknowledged_lines):
+            if now < sent_line.deadline:
+                continue
+            
+            # Decide whether to retransmit
+            sp_line = sent_line.line.split()
+            retransmittable = (len(sp_line) > 0 and
+                sp_line[0] not in self.no_retransmit_tokens and (
+                self.ack_window_bytes is None or
+                sent_line.get_n_bytes_in_flight() + sent_line.n_bytes <=
+                self.ack_window_bytes))
+            if (not retransmittable or 
+                sent_line.n_retransmits >= self.max_retransmits):
+                self.unacknowledged_lines.remove(sent_line)
+                self.hold_resent_line(sent_line)
+                self.failed_lines.append(sent_line.line)
+                if sent_line.callback is not None:
+                    sent_line.callback(False, None)
+                continue
+            
+            # Retransmit with a longer deadline, if another copy fits
+            sent_line.n_retransmits += 1
+            sent_line.deadline = now + self.ack_timeout * (
+                self.retransmit_backoff ** sent_line.n_retransmits)
+            if self.ack_window_bytes is not None and (
+                self.get_n_unacknowledged_bytes() + sent_line.n_bytes >
+                self.ack_window_bytes):
+                self.n_skipped_retransmits += 1
+                continue
+            sent_line.send_time = now
+            sent_line.copy_send_times.append(now)
+            self.n_retransmits += 1
+            write_to_device(self.ser, sent_line.line + '\n')
+        
+        self.last_sent_line_acknowledged = len(self.unacknowledged_lines) == 0
+    
+    def get_write_stats(self):
+        """Returns a dict of counts of lines sent, retransmitted, and failed.
+        
+        Also how deep the backlog of unacknowledged and queued lines got,
+        and how often, and for how long in seconds, queued writes stalled
+        waiting for room under ack_window_bytes. 'n_stray_acks' counts
+        the ACKs of extra copies of retransmitted lines, which 
+        acknowledged nothing, and 'n_skipped_retransmits' the
+        retransmissions skipped because another copy did not fit.
+        """
+        if self.n_write_stalls > 0:
+            mean_stall_time = self.total_write_stall_time / self.n_write_stalls
+        else:
+            mean_stall_time = 0.
+        return {
+            'n_sent': self.n_lines_sent,
+            'n_acknowledged': self.n_lines_acknowledged,
+            'n_retransmits': self.n_retransmits,
+            'n_skipped_retransmits': self.n_skipped_retransmits,
+            'n_stray_acks': self.n_stray_acks,
+            'n_failures': len(self.failed_lines),
+            'n_unacknowledged': len(self.unacknowledged_lines),
+            'n_unacknowledged_bytes': self.get_n_unacknowledged_bytes(),
+            'n_queued': sum([len(lane) for lane in self.write_lanes]),
+            'max_unacknowledged': self.max_unacknowledged_lines,
+            'max_unacknowledged_bytes': self.max_unacknowledged_bytes,
+            'max_queued': self.max_queued_lines,
+            'stalled': self.write_stall_start_time is not None,
+            'n_stalls': self.n_write_stalls,
+            'mean_stall_time': mean_stall_time,
+            'max_stall_time': self.max_write_stall_time,
+            }
+    
+    def get_n_unacknowledged_bytes(self):
+        """Returns the number of bytes sent and not yet acknowledged.
+        
+        This counts every copy of a retransmitted line, including those
+        waited for in `resent_lines`.
+        """
+        return sum([sent_line.get_n_bytes_in_flight()
+            for sent_line in self.unacknowledged_lines + self.resent_lines])
+    
+    def get_write_lane_stats(self):
+        """Returns a dict mapping each lane's name to its statistics"""
+        return dict([(lane.name, lane.get_stats()) 
+            for lane in self.write_lanes])
+    
+    def ack_window_has_room(self, s):
+        """Returns True if `s` can be sent without exceeding the window."""
+        return self.get_ack_window_limit(s) is None
+    
+    def get_ack_window_limit(self, s):
+        """Returns which limit of the window stops `s` from being sent.
+        
+        Returns 'lines' if `ack_window_size` lines are in flight, 'bytes'
+        if `s` does not fit in `ack_window_bytes`, or None if it can be
+        sent. A line is always allowed if nothing is in flight, even if 
+        it is longer than ack_window_bytes, because otherwise it could
+        never be sent.
+        """
+        if len(self.unacknowledged_lines) == 0 and (
+            len(self.resent_lines) == 0):
+            return None
+        if self.ack_window_size is not None and (
+            len(self.unacknowledged_lines) >= self.ack_window_size):
+            return 'lines'
+        if self.ack_window_bytes is not None:
+            n_bytes = self.get_n_unacknowledged_bytes()
+            if n_bytes + len(s.strip()) + 1 > self.ack_window_bytes:
+                return 'bytes'
+        return None
+
+    def write_binary_frames(self, frames):
+        """Make `frames` the new_device_frames, and save them"""
+        self.new_device_frames = frames
+        if len(self.new_device_frames) > 0:
+            self.frames_file.write(b''.join(
+                [frame + b'\0' for frame in self.new_device_frames]))
+            self.frames_file.flush()
+
+    def wait_for_input(self, timeout=None):
+        """Wait until the device or the user has data to read.
+        
+        `timeout` : maximum time to wait in seconds, or None to wait forever
+        
+        Returns True if there is data, or False if the timeout elapsed.
+        Does not read anything.
+        """
+        if self.selector is not None:
+            return len(self.selector.select(timeout)) > 0
+        
+        filenos = [self.ser.fileno()]
+        if self.pipein is not None:
+            filenos.append(self.pipein)
+        if self.control_server is not None:
+            filenos += self.control_server.get_filenos()
+        readable, writable, exceptional = select.select(
+            filenos, [], [], timeout)
+        return len(readable) > 0
+    
+    def get_next_deadline(self):
+        """Returns the host time at which `update` next has timed work.
+        
+        This is the earliest of the next ACK deadline, when lines waiting
+        for the output file are due by `log_flush_interval`, and when the
+        next latency snapshot is due. None if there is none of these.
+        """
+        deadlines = []
+        if self.ack_timeout is not None:
+            deadlines += [sent_line.deadline for sent_line in 
+                self.unacknowledged_lines + self.resent_lines]
+        for log_writer in [self.log_writer, self.side_log_writer]:
+            if log_writer is not None:
+                flush_time = log_writer.get_next_flush_time()
+                if flush_time is not None:
+                    deadlines.append(flush_time)
+        if self.latency_snapshot_interval is not None:
+            deadlines.append(self.last_latency_snapshot_time + 
+                self.latency_snapshot_interval)
+        if len(deadlines) == 0:
+            return None
+        return min(deadlines)
+    
+    def run_until(self, condition=None, timeout=None, echo_to_stdout=True):
+        """Call `update` as data arrives until `condition` is met.
+        
+        `condition` : a function with no arguments, called after each
+            update. We return once it returns True. If None, we run until
+            the timeout.
+        `timeout` : maximum total time in seconds, or None for no limit
+        
+        Queued writes are sent before each wait, and `update` is also
+        called at each deadline (see `get_next_deadline`), even if nothing
+        arrives.
+        
+        Returns True if `condition` was met, otherwise False.
+        """
+        if not self.event_driven:
+            raise ValueError("run_until requires event_driven mode")
+        
+        if timeout is not None:
+            stop_time = get_monotonic_time() + timeout
+        
+        while True:
+            # Send what was queued since the last update
+            self.send_queued_writes()
+            
+            # Wait until the timeout, or the next deadline if sooner
+            now = get_monotonic_time()
+            wait_time = None
+            deadline = self.get_next_deadline()
+            if deadline is not None:
+                wait_time = max(deadline - now, 0)
+            if timeout is not None:
+                if now >= stop_time:
+                    return False
+                if wait_time is None or stop_time - now < wait_time:
+                    wait_time = stop_time - now
+            
+            # Update whether something arrived or a deadline passed
+            self.wait_for_input(wait_time)
+            self.update(echo_to_stdout=echo_to_stdout, wait=False)
+            if condition is not None and condition():
+                return True
+    
+    def add_to_event_loop(self, loop, callback=None, echo_to_stdout=True):
+        """Have an asyncio event loop call `update` when data arrives.
+        
+        `loop` : the event loop, eg asyncio.get_event_loop()
+        `callback` : if not None, called with this Chatter after each update
+        
+        `update` is called when the device, the pipe, or a control socket
+        has data. It is also called at each deadline (see 
+        `get_next_deadline`), and soon after each `queued_write_to_device`
+        so that the line is sent.
+        
+        Use `remove_from_event_loop` to stop.
+        """
+        if not self.event_driven:
+            raise ValueError("add_to_event_loop requires event_driven mode")
+        
+        def on_update():
+            self.update(echo_to_stdout=echo_to_stdout, wait=False)
+            if callback is not None:
+                callback(self)
+            if self.event_loop is None:
+                # The callback removed us
+                return
+            
+            # Come back at the next deadline, even if nothing arrives
+            deadline = self.get_next_deadline()
+            if deadline is not None:
+                schedule(max(deadline - get_monotonic_time(), 0))
+            elif self.event_loop_handle is not None:
+                self.event_loop_handle.cancel()
+                self.event_loop_handle = None
+        
+        def schedule(delay):
+            if self.event_loop_handle is not None:
+                self.event_loop_handle.cancel()
+            self.event_loop_handle = loop.call_later(delay, on_update)
+        
+        self.event_loop = loop
+        self.event_loop_wake = lambda: schedule(0)
+        loop.add_reader(self.ser.fileno(), on_update)
+        if self.pipein is not None:
+            loop.add_reader(self.pipein, on_update)
+        if self.control_server is not None:
+            self.event_loop_watcher = self.control_server.add_sock_watcher(
+                lambda sock: loop.add_reader(sock.fileno(), on_update),
+                lambda sock: loop.remove_reader(sock.fileno()))
+        schedule(0)
+    
+    def remove_from_event_loop(self, loop):
+        """Stop an event loop from calling `update`"""
+        loop.remove_reader(self.ser.fileno())
+        if self.pipein is not None:
+            loop.remove_reader(self.pipein)
+        if self.event_loop_watcher is not None:
+            self.control_server.remove_sock_watcher(self.event_loop_watcher)
+            self.event_loop_watcher = None
+        if self.event_loop_handle is not None:
+            self.event_loop_handle.cancel()
+            self.event_loop_handle = None
+        self.event_loop = None
+        self.event_loop_wake = None
+
+    def get_clock_stats(self):
+        """Returns the drift and jitter of the device clock.
+        
+        See DeviceClockEstimator.get_stats. To convert a device timestamp
+        to host time, use `clock_estimator.device_to_host_time`.
+        
+        The fit is against the monotonic host clock (see 
+        make_monotonic_clock), so that it is not disturbed when the wall
+        clock is stepped or slewed (eg, by NTP). 'wall_clock_offset' is
+        what to add to a monotonic time to get the current wall clock
+        time, for aligning with other recordings. 'host_clock_monotonic'
+        is False on a system without a monotonic clock, where host times
+        are the wall clock, and the offset is about 0.
+        """
+        stats = self.clock_estimator.get_stats()
+        stats['wall_clock_offset'] = self.get_wall_clock_offset()
+        stats['host_clock_monotonic'] = host_clock_is_monotonic
+        return stats
+    
+    def get_wall_clock_offset(self):
+        """Returns the wall clock time minus the monotonic time, now"""
+        return time.time() - get_monotonic_time()
+
+    def get_log_stats(self):
+        """Returns the statistics of writing to the output file"""
+        return self.log_writer.get_stats()
+
+    def get_echo_stats(self):
+        """Returns the statistics of echoing to stdout, or None"""
+        if self.echo_thread is None:
+            return None
+        return self.echo_thread.get_stats()
+
+    def get_side_stream_stats(self):
+        """Returns the statistics of the side stream, or None"""
+        if self.line_router is None:
+            return None
+        stats = self.line_router.get_stats()
+        stats['log'] = self.side_log_writer.get_stats()
+        return stats
+
+    def get_frame_stats(self):
+        """Returns the statistics of binary frames, or None"""
+        if self.frame_splitter is None:
+            return None
+        return self.frame_splitter.get_stats()
+
+    def get_device_read_stats(self):
+        """Returns the statistics of the DeviceLineReader"""
+        if self.device_reader_thread is not None:
+            return self.device_reader_thread.reader.get_stats()
+        return self.device_reader.get_stats()
+
+    def get_device_buffer_stats(self):
+        """Returns the statistics of the reader_thread buffer, or None"""
+        if self.device_line_buffer is None:
+            return None
+        return self.device_line_buffer.get_stats()
 
     def close(self):
+        if self.device_reader_thread is not None:
+            self.device_reader_thread.stop()
+        if self.control_server is not None:
+            self.control_server.close()
+        if self.selector is not None:
+            self.selector.close()
         self.ser.close()
+        if self.echo_thread is not None:
+            self.echo_thread.stop()
+        self.log_writer.close()
         self.ofi.close()
+        if self.side_file is not None:
+            self.side_log_writer.close()
+            self.side_file.close()
+        if self.latency_snapshot_interval is not None:
+            self.write_latency_snapshot()
+        if self.timestamps_file is not None:
+            self.timestamps_file.close()
+        if self.frames_file is not None:
+            self.frames_file.close()
+        if getattr(self, 'pipein_keepalive', None) is not None:
+            os.close(self.pipein_keepalive)
         #pipein.close()
     
-    def queued_write_to_device(self, s):
+    def queued_write_to_device(self, s, lane='bulk', callback=None):
         """Adds the string `s` to the write queue.
 
-        These queued strings are written to the device one at a time
-        during `update` calls, and we wait for an acknowledgement before
-        sending the next one.
+        These queued strings are written to the device during `update`
+        calls. By default they are written one at a time, and we wait for an
+        acknowledgement before sending the next one. If `ack_window_size`
+        is greater than 1, up to that many may be unacknowledged at once,
+        and no more than `ack_window_bytes`.
+        
+        `lane` : 'urgent' for operator commands that should jump ahead of
+            anything waiting in the 'bulk' lane, such as parameter uploads
+        `callback` : if not None, called as callback(acknowledged, latency)
+            once the line is acknowledged, or given up on. See SentLine.
         """
-        self.queued_writes.append(s)
+        for write_lane in self.write_lanes:
+            if write_lane.name == lane:
+                write_lane.append(s, callback)
+                n_queued = sum([len(queued_lane) 
+                    for queued_lane in self.write_lanes])
+                if n_queued > self.max_queued_lines:
+                    self.max_queued_lines = n_queued
+                if self.event_loop_wake is not None:
+                    self.event_loop_wake()
+                return
+        raise ValueError("unknown write lane: %s" % lane)
     
-    def write_to_device(self, s, auto_newline=True):
+    def write_to_device(self, s, auto_newline=True, callback=None):
         """Write a line to the device.
         
         Adds a newline character automatically if necessary.
         Does not call update.
-        Caches string to last_sent_line.
+        Caches string to last_sent_line, and adds it to the unacknowledged
+        lines.
         """
         self.last_sent_line = s 
         self.last_sent_line_acknowledged = False
+        send_time = get_monotonic_time()
+        if self.ack_timeout is None:
+            deadline = None
+        else:
+            deadline = send_time + self.ack_timeout
+        self.unacknowledged_lines.append(
+            SentLine(s.strip(), send_time, deadline, callback))
+        self.n_lines_sent += 1
+        if len(self.unacknowledged_lines) > self.max_unacknowledged_lines:
+            self.max_unacknowledged_lines = len(self.unacknowledged_lines)
+        n_bytes = self.get_n_unacknowledged_bytes()
+        if n_bytes > self.max_unacknowledged_bytes:
+            self.max_unacknowledged_bytes = n_bytes
         
         if auto_newline and not s.endswith('\n'):
             s = s + '\n'
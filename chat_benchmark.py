@@ -0,0 +1,346 @@
+"""Benchmarks the throughput and latency of the serial link.
+
+Runs a Chatter against an emulated device from pseudo_arduino, and
+measures how many lines and bytes per second it receives, the round-trip
+time from writing a line until its ACK arrives, and how much CPU the
+host spends per line. This is repeated for every combination of
+`serial_timeout`, baud rate, rate of DBG output from the device, and
+Chatter mode (polling, event_driven or reader_thread).
+
+The emulator runs in its own process, so that the CPU time measured is
+only the host's. With a baud rate, the emulator's output takes as long
+as it would on a real serial link; the pty itself is not throttled.
+
+The results are written as JSON, so that releases can be compared:
+    python chat_benchmark.py -o results_new.json
+    python chat_benchmark.py --compare results_old.json results_new.json
+
+Or from Python:
+    results = chat_benchmark.run_sweep(serial_timeouts=[.01, .1],
+        dbg_rates=[10, 1000], filename='results.json')
+"""
+import os
+import sys
+import time
+import datetime
+import platform
+import argparse
+import tempfile
+import shutil
+import threading
+import subprocess
+import multiprocessing
+import json
+import serial
+import chat
+import pseudo_arduino
+
+# Keyword arguments to Chatter for each mode
+chatter_mode_kwargs = {
+    'polling': {},
+    'event_driven': {'event_driven': True},
+    'reader_thread': {'reader_thread': True},
+    }
+
+# The line sent to measure ACK round-trip times. It changes nothing,
+# because no trial is ever released.
+ack_probe_line = 'SET ITI 3000'
+
+# The parameters that identify each result
+result_key_names = ('mode', 'serial_timeout', 'baud_rate', 'dbg_rate')
+
+def get_cpu_time():
+    """User plus system CPU time of this process, in seconds"""
+    times = os.times()
+    return times[0] + times[1]
+
+class DebugPseudoArduino(pseudo_arduino.PseudoArduino):
+    """Emulates a device that emits `dbg_rate` DBG lines per second.
+    
+    The lines look like the IR detector's. Otherwise this behaves like any
+    sketch before its first trial: it ACKs and parses every line, and
+    announces the time.
+    
+    If the link cannot keep up, lines are skipped, as a sketch blocked
+    on Serial.print would emit fewer of them.
+    """
+    # The most lines emitted on one loop, when catching up
+    max_lines_per_loop = 10
+    
+    def __init__(self, dbg_rate, **kwargs):
+        pseudo_arduino.PseudoArduino.__init__(self, 
+            pseudo_arduino.twochoice_param_abbrevs,
+            pseudo_arduino.twochoice_param_values, **kwargs)
+        self.dbg_rate = dbg_rate
+        self.n_dbg_lines = 0
+    
+    def loop(self):
+        pseudo_arduino.PseudoArduino.loop(self)
+        
+        # Catch up on the lines due by now, even if that is more than one
+        # per loop, but not on those that a blocked sketch would skip
+        n_due = int((pseudo_arduino.get_monotonic_time() - self.start_time) 
+            * self.dbg_rate)
+        self.n_dbg_lines = max(self.n_dbg_lines, 
+            n_due - self.max_lines_per_loop)
+        while self.n_dbg_lines < n_due:
+            self.println("%d DBG L:c=512;m=510;x=498." % self.millis())
+            self.n_dbg_lines += 1
+
+def run_emulator(conn, dbg_rate, baud_rate):
+    """Run a DebugPseudoArduino until told to stop over `conn`.
+
+    Sends the port name once started, and the emulator's statistics once
+    stopped.
+    """
+    emulator = DebugPseudoArduino(dbg_rate, baud_rate=baud_rate)
+    emulator.start()
+    conn.send(emulator.port_name)
+
+    conn.recv()
+    stats = emulator.get_stats()
+    emulator.close()
+    conn.send(stats)
+
+def run_benchmark(serial_timeout=0.01, baud_rate=115200, dbg_rate=100,
+    mode='polling', duration=3., warmup=1., ack_interval=0.1):
+    """Measure one Chatter configuration against the emulator.
+
+    `serial_timeout`, `baud_rate` : passed to Chatter
+    `dbg_rate` : approximate number of DBG lines per second from the device
+    `mode` : a key of chatter_mode_kwargs
+    `duration` : how long to measure for, in seconds
+    `warmup` : how long to run before measuring, in seconds, so that the
+        output that piled up while the Chatter started is not counted
+    `ack_interval` : how often to queue a line for the ACK round trip
+
+    Returns: dict of the parameters, and of the measurements
+        n_lines, n_bytes, lines_per_s, bytes_per_s : received from device
+        n_updates, max_update_duration : of Chatter.update. If a single
+            update takes most of the duration, the device output did not
+            let the serial port time out.
+        cpu_s, cpu_fraction, cpu_per_line_us : host CPU time
+        ack : LatencyHistogram.get_stats of the ACK round trips, or None
+        write : Chatter.get_write_stats
+        device : the emulator's statistics
+    """
+    parent_conn, child_conn = multiprocessing.Pipe()
+    proc = multiprocessing.Process(target=run_emulator,
+        args=(child_conn, dbg_rate, baud_rate))
+    proc.daemon = True
+    proc.start()
+    port_name = parent_conn.recv()
+
+    # Stopping the emulator closes the pty. This also ends an update that
+    # would otherwise go on reading as long as the device keeps talking.
+    stop_lock = threading.Lock()
+    stopped = []
+    def stop_emulator():
+        with stop_lock:
+            if len(stopped) == 0:
+                parent_conn.send('stop')
+                stopped.append(True)
+    stop_timer = threading.Timer(warmup + duration + 1., stop_emulator)
+
+    log_dir = tempfile.mkdtemp()
+    chatter = chat.Chatter(serial_port=port_name, from_user=None,
+        to_user=os.path.join(log_dir, 'ardulines'),
+        serial_timeout=serial_timeout, baud_rate=baud_rate, startup_timeout=5.,
+        **chatter_mode_kwargs[mode])
+
+    stop_timer.start()
+    try:
+        warmup_stop_time = chat.get_monotonic_time() + warmup
+        while chat.get_monotonic_time() < warmup_stop_time:
+            chatter.update(echo_to_stdout=False)
+    except (serial.SerialException, OSError):
+        pass
+    
+    n_lines = 0
+    n_bytes = 0
+    n_updates = 0
+    max_update_duration = 0.
+    start_time = chat.get_monotonic_time()
+    start_cpu_time = get_cpu_time()
+    next_ack_time = start_time
+    try:
+        while True:
+            update_start_time = chat.get_monotonic_time()
+            if update_start_time - start_time >= duration:
+                break
+            if update_start_time >= next_ack_time:
+                chatter.queued_write_to_device(ack_probe_line)
+                next_ack_time += ack_interval
+
+            chatter.update(echo_to_stdout=False)
+
+            update_duration = chat.get_monotonic_time() - update_start_time
+            if update_duration > max_update_duration:
+                max_update_duration = update_duration
+            n_updates += 1
+            n_lines += len(chatter.new_device_lines)
+            n_bytes += sum([len(line) for line in chatter.new_device_lines])
+    except (serial.SerialException, OSError):
+        # The emulator was stopped during an update
+        pass
+    elapsed = chat.get_monotonic_time() - start_time
+    cpu_time = get_cpu_time() - start_cpu_time
+
+    stop_timer.cancel()
+    chatter.close()
+    stop_emulator()
+    device_stats = parent_conn.recv()
+    proc.join()
+    shutil.rmtree(log_dir)
+
+    cpu_per_line_us = None
+    if n_lines > 0:
+        cpu_per_line_us = cpu_time / n_lines * 1e6
+    return {
+        'mode': mode,
+        'serial_timeout': serial_timeout,
+        'baud_rate': baud_rate,
+        'dbg_rate': dbg_rate,
+        'duration': elapsed,
+        'n_lines': n_lines,
+        'n_bytes': n_bytes,
+        'lines_per_s': n_lines / elapsed,
+        'bytes_per_s': n_bytes / elapsed,
+        'n_updates': n_updates,
+        'max_update_duration': max_update_duration,
+        'cpu_s': cpu_time,
+        'cpu_fraction': cpu_time / elapsed,
+        'cpu_per_line_us': cpu_per_line_us,
+        'ack': chatter.get_latency_stats().get(ack_probe_line.split()[0]),
+        'write': chatter.get_write_stats(),
+        'device': device_stats,
+        }
+
+def get_revision():
+    """Returns the git revision of this code, or None"""
+    try:
+        return subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'],
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_sweep(serial_timeouts=(0.01, 0.1), baud_rates=(9600, 115200),
+    dbg_rates=(10, 100, 1000), modes=('polling', 'event_driven'),
+    duration=3., filename=None, verbose=True):
+    """Run `run_benchmark` on every combination of the parameters.
+
+    `filename` : if not None, the results are written here as JSON
+    `verbose` : if True, print each result as it finishes
+
+    Returns: dict with the 'results' of each run, and the 'created' time,
+        'platform', 'python' version and git 'revision'
+    """
+    results = []
+    for mode in modes:
+        for serial_timeout in serial_timeouts:
+            for baud_rate in baud_rates:
+                for dbg_rate in dbg_rates:
+                    result = run_benchmark(serial_timeout=serial_timeout,
+                        baud_rate=baud_rate, dbg_rate=dbg_rate, mode=mode,
+                        duration=duration)
+                    results.append(result)
+                    if verbose:
+                        print(format_result(result))
+
+    res = {
+        'created': datetime.datetime.now().isoformat(),
+        'platform': platform.platform(),
+        'python': sys.version.split()[0],
+        'revision': get_revision(),
+        'results': results,
+        }
+    if filename is not None:
+        chat.write_json_atomically(res, filename)
+    return res
+
+def format_result(result):
+    """Returns a one-line summary of a result"""
+    if result['ack'] is None:
+        ack_s = 'no ACKs'
+    else:
+        ack_s = 'ACK p50 %.1fms p99 %.1fms' % (
+            result['ack']['p50'] * 1000, result['ack']['p99'] * 1000)
+    if result['cpu_per_line_us'] is None:
+        cpu_s = 'no lines'
+    else:
+        cpu_s = '%.0fus CPU/line' % result['cpu_per_line_us']
+    if result['max_update_duration'] > result['duration'] / 2:
+        cpu_s += ' (update blocked)'
+
+    return '%-13s timeout=%-5g baud=%-6d dbg=%-5d: %7.0f lines/s %8.0f B/s %s %s' % (
+        result['mode'], result['serial_timeout'], result['baud_rate'],
+        result['dbg_rate'], result['lines_per_s'], result['bytes_per_s'],
+        ack_s, cpu_s)
+
+def compare_results(old, new):
+    """Compare two sets of results from run_sweep, or their JSON files.
+
+    Returns: list of dicts, one for each configuration in both, with its
+        parameters and the old and new lines_per_s, ACK p50 and
+        cpu_per_line_us
+    """
+    if not isinstance(old, dict):
+        with open(old) as fi:
+            old = json.load(fi)
+    if not isinstance(new, dict):
+        with open(new) as fi:
+            new = json.load(fi)
+
+    def get_key(result):
+        return tuple([result[key_name] for key_name in result_key_names])
+    def get_ack_p50(result):
+        if result['ack'] is None:
+            return None
+        return result['ack']['p50']
+    old_results = dict([(get_key(result), result)
+        for result in old['results']])
+
+    res = []
+    for new_result in new['results']:
+        old_result = old_results.get(get_key(new_result))
+        if old_result is None:
+            continue
+        comparison = dict(zip(result_key_names, get_key(new_result)))
+        for name, getter in [
+            ('lines_per_s', lambda result: result['lines_per_s']),
+            ('ack_p50', get_ack_p50),
+            ('cpu_per_line_us', lambda result: result['cpu_per_line_us']),
+            ]:
+            comparison['old_' + name] = getter(old_result)
+            comparison['new_' + name] = getter(new_result)
+        res.append(comparison)
+    return res
+
+def parse_list(s, typ):
+    return [typ(val) for val in s.split(',')]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-o', '--output', default=None,
+        help='write the results as JSON here')
+    parser.add_argument('--duration', type=float, default=3.,
+        help='seconds to measure each configuration')
+    parser.add_argument('--serial-timeouts', default='0.01,0.1')
+    parser.add_argument('--baud-rates', default='9600,115200')
+    parser.add_argument('--dbg-rates', default='10,100,1000')
+    parser.add_argument('--modes', default='polling,event_driven')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+        help='compare two results files instead of running')
+    args = parser.parse_args()
+
+    if args.compare is not None:
+        for comparison in compare_results(*args.compare):
+            print(json.dumps(comparison, sort_keys=True))
+    else:
+        run_sweep(
+            serial_timeouts=parse_list(args.serial_timeouts, float),
+            baud_rates=parse_list(args.baud_rates, int),
+            dbg_rates=parse_list(args.dbg_rates, int),
+            modes=parse_list(args.modes, str),
+            duration=args.duration, filename=args.output)
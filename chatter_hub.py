@@ -0,0 +1,230 @@
+"""Runs several rigs from one process.
+
+A ChatterHub owns one event-driven Chatter per rig, each with its own
+serial port, input pipe and log file, and optionally its own TrialSetter.
+A single loop waits on all of the serial ports, pipes and control
+sockets at once, and updates only the rigs that have data, so one process can drive many rigs
+without polling each in turn.
+
+Each rig keeps latency histograms of how long it waited to be serviced
+after its data arrived, and of how long its updates took, so that a rig
+that starves the others shows up in `get_rig_stats`.
+
+Usage:
+    hub = ChatterHub(log_dir='./logfiles')
+    for rigname in ['L1', 'L2', 'L3']:
+        hub.add_rig(rigname, mainloop.get_serial_port(rigname),
+            params_table=params_table, scheduler=scheduler)
+    hub.run()
+"""
+import os
+import select
+import chat
+import TrialSpeak
+import trial_setter
+
+try:
+    import selectors
+except ImportError:
+    # Python 2 has no selectors, so wait_for_ready_rigs falls back to select
+    selectors = None
+
+class HubRig(object):
+    """One rig in a ChatterHub: its Chatter, log, and TrialSetter"""
+    def __init__(self, name, chatter, ts_obj=None):
+        self.name = name
+        self.chatter = chatter
+        self.ts_obj = ts_obj
+        self.log_follower = TrialSpeak.LogFollower(chatter.ofi.name)
+        self.translated_trial_matrix = None
+
+        # Statistics
+        self.n_updates = 0
+        self.last_update_time = chat.get_monotonic_time()
+        self.service_delay = chat.LatencyHistogram()
+        self.update_duration = chat.LatencyHistogram()
+
+    def update(self):
+        """Update the chatter, and release trials if necessary"""
+        self.chatter.update(echo_to_stdout=False)
+        if self.ts_obj is not None:
+            self.log_follower.update()
+            translated_trial_matrix = self.ts_obj.update(
+                self.log_follower.splines, self.log_follower.lines)
+            if translated_trial_matrix is not None:
+                self.translated_trial_matrix = translated_trial_matrix
+        self.n_updates += 1
+
+    def get_stats(self):
+        """Returns a dict of this rig's service and write statistics"""
+        return {
+            'n_updates': self.n_updates,
+            'service_delay': self.service_delay.get_stats(),
+            'update_duration': self.update_duration.get_stats(),
+            'write': self.chatter.get_write_stats(),
+            'latency': self.chatter.get_latency_stats(),
+            }
+
+class ChatterHub(object):
+    """Multiplexes the Chatters of many rigs on a single event loop.
+
+    Call `add_rig` for each rig, then `run` until CTRL+C, or call `update`
+    repeatedly from your own loop. Call `close` to close all of the rigs.
+    """
+    def __init__(self, log_dir=None, timeout=0.1, max_idle=0.1):
+        """Initialize a new ChatterHub.
+
+        `log_dir` : each rig logs to a subdirectory of this named after the
+            rig. If None, the current directory.
+        `timeout` : how long `update` waits for data from any rig
+        `max_idle` : rigs without any data are still updated this often,
+            so that retransmissions and trial releasing are not delayed
+        """
+        if log_dir is None:
+            log_dir = '.'
+        self.log_dir = log_dir
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.rigs = []
+
+        # Rotated on each update so that no rig is always serviced first
+        self.next_rig_index = 0
+
+        self.selector = None
+        if selectors is not None:
+            self.selector = selectors.DefaultSelector()
+        self.fd2rig = {}
+
+    def add_rig(self, name, serial_port, params_table=None, scheduler=None,
+        **chatter_kwargs):
+        """Open a rig and add it to the hub.
+
+        `name` : the rig name, eg 'L1'. Its input pipe is 'TO_DEV_' + name,
+            and it logs into a subdirectory of `log_dir` named `name`.
+        `serial_port` : where the rig's device is located
+        `params_table`, `scheduler` : if both are provided, a TrialSetter
+            releases trials on this rig
+        `chatter_kwargs` : passed to Chatter. The Chatter is always
+            event-driven with no serial timeout, because the hub does
+            the waiting.
+
+        Returns: the new HubRig
+        """
+        if name in [rig.name for rig in self.rigs]:
+            raise ValueError("rig %s already added" % name)
+
+        to_user_dir = os.path.join(self.log_dir, name)
+        if not os.path.exists(to_user_dir):
+            os.makedirs(to_user_dir)
+        chatter_kwargs.setdefault('from_user', 'TO_DEV_' + name)
+        chatter_kwargs.setdefault('to_user_dir', to_user_dir)
+        chatter_kwargs['event_driven'] = True
+        chatter_kwargs['serial_timeout'] = 0
+        chatter = chat.Chatter(serial_port=serial_port, **chatter_kwargs)
+
+        ts_obj = None
+        if params_table is not None and scheduler is not None:
+            ts_obj = trial_setter.TrialSetter(chatter=chatter,
+                params_table=params_table, scheduler=scheduler)
+
+        rig = HubRig(name, chatter, ts_obj)
+        self.rigs.append(rig)
+        self.register_fd(chatter.ser.fileno(), rig)
+        if chatter.pipein is not None:
+            self.register_fd(chatter.pipein, rig)
+        
+        # The control sockets, including clients as they come and go
+        if chatter.control_server is not None:
+            chatter.control_server.add_sock_watcher(
+                lambda sock: self.register_fd(sock.fileno(), rig),
+                lambda sock: self.unregister_fd(sock.fileno()))
+        return rig
+
+    def register_fd(self, fd, rig):
+        """Wake up for `rig` when `fd` is readable"""
+        self.fd2rig[fd] = rig
+        if self.selector is not None:
+            self.selector.register(fd, selectors.EVENT_READ, rig)
+
+    def unregister_fd(self, fd):
+        """Stop waiting on `fd`, which is about to be closed"""
+        self.fd2rig.pop(fd, None)
+        if self.selector is not None:
+            self.selector.unregister(fd)
+
+    def get_rig(self, name):
+        for rig in self.rigs:
+            if rig.name == name:
+                return rig
+        raise ValueError("no rig named %s" % name)
+
+    def wait_for_ready_rigs(self, timeout=None):
+        """Wait up to `timeout` for data, and return the rigs that have some"""
+        if self.selector is not None:
+            events = self.selector.select(timeout)
+            ready_rigs = [key.data for key, mask in events]
+        else:
+            readable, writable, exceptional = select.select(
+                list(self.fd2rig.keys()), [], [], timeout)
+            ready_rigs = [self.fd2rig[fd] for fd in readable]
+
+        # A rig is ready once even if its port and pipe are both readable
+        res = []
+        for rig in ready_rigs:
+            if rig not in res:
+                res.append(rig)
+        return res
+
+    def update(self, timeout=None):
+        """Wait for data from any rig, and update the rigs that need it.
+
+        `timeout` : how long to wait. If None, use the hub's timeout.
+
+        Rigs are updated if they have data, or if they have not been
+        updated for `max_idle`. Returns the rigs that were updated.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        if len(self.rigs) == 0:
+            return []
+
+        ready_rigs = self.wait_for_ready_rigs(timeout)
+        wake_time = chat.get_monotonic_time()
+
+        # Also update idle rigs, in the rotated order
+        n_rigs = len(self.rigs)
+        rotated_rigs = (self.rigs[self.next_rig_index % n_rigs:] +
+            self.rigs[:self.next_rig_index % n_rigs])
+        self.next_rig_index += 1
+        rigs_to_update = [rig for rig in rotated_rigs if rig in ready_rigs or
+            wake_time - rig.last_update_time >= self.max_idle]
+
+        for rig in rigs_to_update:
+            start_time = chat.get_monotonic_time()
+            if rig in ready_rigs:
+                rig.service_delay.record(start_time - wake_time)
+            rig.update()
+            rig.last_update_time = chat.get_monotonic_time()
+            rig.update_duration.record(rig.last_update_time - start_time)
+        return rigs_to_update
+
+    def run(self):
+        """Call `update` until CTRL+C is received, then close all rigs"""
+        try:
+            while True:
+                self.update()
+        except KeyboardInterrupt:
+            print("Keyboard interrupt received")
+        finally:
+            self.close()
+
+    def get_rig_stats(self):
+        """Returns a dict of HubRig.get_stats, keyed by rig name"""
+        return dict([(rig.name, rig.get_stats()) for rig in self.rigs])
+
+    def close(self):
+        if self.selector is not None:
+            self.selector.close()
+            self.selector = None
+        for rig in self.rigs:
+            rig.chatter.close()
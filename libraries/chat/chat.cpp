@@ -19,6 +19,9 @@ char receive_line[__CHAT_H_RECEIVE_BUFFER_SZ] = "";
 unsigned long speak_at = 1000;
 unsigned long interval = 1000;
 
+// Whether to send binary records, set by the BINARY command
+bool binary_mode = 0;
+
 
 
 //// Functions for receiving chats
@@ -87,6 +90,101 @@ char* receive_chat()
 
 
 
+//// Functions for sending binary records
+uint16_t crc16_ccitt(const uint8_t *data, unsigned int len)
+{ /* CRC-16/CCITT-FALSE: polynomial 0x1021, initial value 0xFFFF */
+  uint16_t crc = 0xFFFF;
+  
+  for (unsigned int i = 0; i < len; i++)
+  {
+    crc ^= (uint16_t) data[i] << 8;
+    for (int bit = 0; bit < 8; bit++)
+    {
+      if (crc & 0x8000)
+        crc = (crc << 1) ^ 0x1021;
+      else
+        crc = crc << 1;
+    }
+  }
+  return crc;
+}
+
+unsigned int cobs_encode(const uint8_t *src, unsigned int len, uint8_t *dst)
+{ /* COBS-encodes `len` bytes of `src` into `dst`, which contains no zeros.
+  
+  `dst` must have room for len + len / 254 + 1 bytes.
+  Returns the number of bytes written to `dst`.
+  */
+  unsigned int read_idx = 0;
+  unsigned int write_idx = 1;
+  unsigned int code_idx = 0;
+  uint8_t code = 1;
+  
+  while (read_idx < len)
+  {
+    if (src[read_idx] == 0)
+    {
+      // Each zero is replaced by the distance to the next one
+      dst[code_idx] = code;
+      code = 1;
+      code_idx = write_idx++;
+      read_idx++;
+    }
+    else
+    {
+      dst[write_idx++] = src[read_idx++];
+      code++;
+      
+      // A run of 254 non-zero bytes gets a code byte without a zero
+      if (code == 0xFF)
+      {
+        dst[code_idx] = code;
+        code = 1;
+        code_idx = write_idx++;
+      }
+    }
+  }
+  dst[code_idx] = code;
+  
+  return write_idx;
+}
+
+void send_binary_record(uint8_t record_type, unsigned long time,
+  const int *fields, uint8_t n_fields)
+{ /* Sends a record as a COBS frame. See chat.h for the format.
+  
+  Only the first __CHAT_H_MAX_RECORD_FIELDS fields are sent.
+  */
+  uint8_t record[__CHAT_H_RECORD_SZ];
+  uint8_t frame[__CHAT_H_RECORD_SZ + 2];
+  unsigned int len = 0;
+  unsigned int frame_len = 0;
+  uint16_t crc = 0;
+  
+  if (n_fields > __CHAT_H_MAX_RECORD_FIELDS)
+    n_fields = __CHAT_H_MAX_RECORD_FIELDS;
+  
+  // Pack the record, little-endian
+  record[len++] = record_type;
+  for (int i = 0; i < 4; i++)
+    record[len++] = (time >> (8 * i)) & 0xFF;
+  for (int i = 0; i < n_fields; i++)
+  {
+    record[len++] = fields[i] & 0xFF;
+    record[len++] = (fields[i] >> 8) & 0xFF;
+  }
+  crc = crc16_ccitt(record, len);
+  record[len++] = crc & 0xFF;
+  record[len++] = (crc >> 8) & 0xFF;
+  
+  // Send between zero bytes
+  frame_len = cobs_encode(record, len, frame);
+  Serial.write((uint8_t) 0);
+  Serial.write(frame, frame_len);
+  Serial.write((uint8_t) 0);
+}
+
+
 //// Begin TrialSpeak code.
 int communications(unsigned long time)
 { /* Run the chat receiving and debug announcing stuff, independent of
@@ -151,8 +249,10 @@ int handle_chat(char* received_chat,
   char *argument2)
 { /* Parses a received line and takes appropriate action.
   
-  Currently the only command this can parse is RELEASE_TRL. Other general
-  TrialSpeak commands should go here.
+  Currently the only commands this can parse are RELEASE_TRL, 
+  BINARY 1 or BINARY 0, which turn binary records on or off, and HELLO,
+  which is answered with a HELLO line so the host knows we are listening.
+  Other general TrialSpeak commands should go here.
 
   If a protocol-specific command is received (e.g., "SET"), then 
   the following String variables are set:
@@ -238,6 +338,29 @@ int handle_chat(char* received_chat,
     }
   }
   
+  //// Turning binary records on or off
+  else if (strncmp(strs[0], "BINARY\0", 7) == 0)
+  {
+    if (n_strs != 2)
+    {
+      // syntax error
+      return 3;
+    }
+    binary_mode = (strcmp(strs[1], "0") != 0);
+  }
+  
+  //// Startup handshake with the host
+  else if (strncmp(strs[0], "HELLO\0", 6) == 0)
+  {
+    if (n_strs != 1)
+    {
+      // syntax error
+      return 3;
+    }
+    Serial.print(millis());
+    Serial.println(" HELLO");
+  }
+  
   //// User-defined command
   else if (strncmp(strs[0], "ACT\0", 4) == 0)
   {
@@ -25,5 +25,24 @@ int handle_chat(char* received_chat,
 //// General chat stuff
 char* receive_chat();
 
+//// Binary framing
+// Instead of text debug lines, records can be sent as binary frames. Each
+// record is: a type byte, millis() as 4 bytes, then each field as 2 bytes,
+// then a CRC-16/CCITT of all of the preceding bytes as 2 bytes, all 
+// little-endian. The record is COBS-encoded so that it contains no zero
+// bytes, and sent between two zero bytes. Text lines never contain a zero
+// byte, so the host can separate frames from text. See TrialSpeak.py.
+//
+// Binary records are only sent after the host sends "BINARY 1".
+#define __CHAT_H_MAX_RECORD_FIELDS 16
+#define __CHAT_H_RECORD_SZ (1 + 4 + 2 * __CHAT_H_MAX_RECORD_FIELDS + 2)
+
+extern bool binary_mode;
+
+uint16_t crc16_ccitt(const uint8_t *data, unsigned int len);
+unsigned int cobs_encode(const uint8_t *src, unsigned int len, uint8_t *dst);
+void send_binary_record(uint8_t record_type, unsigned long time,
+  const int *fields, uint8_t n_fields);
+
 
 #endif
\ No newline at end of file
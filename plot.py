@@ -21,6 +21,7 @@ code assumes that it is.
 """
 
 import numpy as np, pandas, time
+import collections
 import matplotlib.pyplot as plt
 import my
 import scipy.stats
@@ -139,25 +140,43 @@ class Plotter(object):
         Does nothing by default but child classes will redefine."""
         pass
     
-    def update(self, filename):   
-        """Read info from filename and update the plot"""
+    def update(self, filename, translated_trial_matrix=None, 
+        logfile_lines=None, splines=None):   
+        """Read info from filename and update the plot
+        
+        translated_trial_matrix : if not None, this is used instead of
+            constructing the trial matrix from the file. Typically this
+            is the one returned by TrialSetter.update. It is not modified.
+        logfile_lines, splines : if not None, the lines of the file and
+            the lines split by trial, eg LogFollower.lines and 
+            LogFollower.splines, which are used instead of reading the
+            file again
+        """
         ## Load data and make trials_info
         # Check log
-        lines = TrialSpeak.read_lines_from_file(filename)
-        splines = TrialSpeak.split_by_trial(lines)        
+        if logfile_lines is None or splines is None:
+            lines = TrialSpeak.read_lines_from_file(filename)
+            splines = TrialSpeak.split_by_trial(lines)        
+        else:
+            lines = logfile_lines
         
         # Really we should wait until we hear something from the arduino
         # Simply wait till at least one line has been received
         if len(splines) == 0 or len(splines[0]) == 0:
             return
 
-        # Construct trial_matrix. I believe this will always have at least
-        # one line in it now, even if it's composed entirely of Nones.
-        trials_info = TrialMatrix.make_trials_info_from_splines(splines)
+        if translated_trial_matrix is None:
+            # Construct trial_matrix. I believe this will always have at least
+            # one line in it now, even if it's composed entirely of Nones.
+            trials_info = TrialMatrix.make_trials_info_from_splines(splines)
 
-        ## Translate condensed trialspeak into full data
-        # Put this part into TrialSpeak.py
-        translated_trial_matrix = TrialSpeak.translate_trial_matrix(trials_info)
+            ## Translate condensed trialspeak into full data
+            # Put this part into TrialSpeak.py
+            translated_trial_matrix = TrialSpeak.translate_trial_matrix(
+                trials_info)
+        else:
+            # Copy, because it is shared with the trial setter
+            translated_trial_matrix = translated_trial_matrix.copy()
         
         # return if nothing to do
         if len(translated_trial_matrix) < 1:
@@ -423,21 +442,43 @@ class PlotterByStimNumber(Plotter):
 
 class SensorPlotter():
     """Plots sensor values by step"""
-    def __init__(self):
+    def __init__(self, max_records=10000):
         self.handles = {}
+        
+        # Sensor histories from events, accumulated across updates
+        self.sensor_records = collections.deque(maxlen=max_records)
+        self.n_events_seen = 0
     
     def init_handles(self):
         self.handles['f'], self.handles['ax'] = plt.subplots()
 
-    def update(self, logfile_lines):
-        """Update plot with new sensor values"""
+    def parse_new_events(self, event_recorder):
+        """Adds the SENH events received since the last call to the records"""
+        new_events, self.n_events_seen = event_recorder.get_events_since(
+            self.n_events_seen)
+        for event in new_events:
+            if event.command == 'SENH':
+                self.sensor_records.append(map(int, event.args))
+
+    def update(self, logfile_lines, event_recorder=None):
+        """Update plot with new sensor values
+        
+        event_recorder : if not None, a chat.DeviceEventRecorder subscribed
+            to SENH on Chatter.event_bus. Only the events it received 
+            since the last update are parsed, instead of searching 
+            `logfile_lines`.
+        """
         # Extract sensor values from each SENH line
         rec_l = []
-        senh_lines = filter(lambda l: ' SENH ' in l, logfile_lines)
-        for line in senh_lines:
-            post_senh_text = line.split(' SENH ')[1]
-            sensor_history = post_senh_text.split()
-            rec_l.append(map(int, sensor_history))
+        if event_recorder is not None:
+            self.parse_new_events(event_recorder)
+            rec_l = self.sensor_records
+        else:
+            senh_lines = filter(lambda l: ' SENH ' in l, logfile_lines)
+            for line in senh_lines:
+                post_senh_text = line.split(' SENH ')[1]
+                sensor_history = post_senh_text.split()
+                rec_l.append(map(int, sensor_history))
 
         # Plot each
         for line in self.handles['ax'].lines:
@@ -447,8 +488,15 @@ class SensorPlotter():
 
 class LickPlotter():
     """Plots licks by time"""
-    def __init__(self):
+    def __init__(self, max_records=10000):
         self.handles = {}
+        
+        # IR values and touches from events, accumulated across updates
+        self.side2ir_records = {
+            'L': collections.deque(maxlen=max_records),
+            'R': collections.deque(maxlen=max_records)}
+        self.tch_records = collections.deque(maxlen=max_records)
+        self.n_events_seen = 0
     
     def init_handles(self):
         self.handles['f'], self.handles['axa'] = plt.subplots(2, 1,
@@ -482,7 +530,8 @@ class LickPlotter():
 
         plt.show()
     
-    def update(self, logfile_lines):
+    def parse_ir_lines(self, logfile_lines):
+        """Returns DataFrames of the left and right IR debug lines, or None"""
         # Extract licks
         l_rec_l = []
         lick_lines = filter(lambda l: 'DBG L:' in l, logfile_lines)
@@ -512,17 +561,89 @@ class LickPlotter():
             r_resdf = pandas.DataFrame.from_records(r_rec_l).set_index('time')
         except KeyError:
             r_resdf = None
+        
+        return l_resdf, r_resdf
+    
+    def parse_new_events(self, event_recorder):
+        """Adds the DBG and TCH events received since the last call
+        
+        The IR values of "DBG L:" and "DBG R:" events go to 
+        `side2ir_records` and nonzero touches to `tch_records`.
+        """
+        new_events, self.n_events_seen = event_recorder.get_events_since(
+            self.n_events_seen)
+        for event in new_events:
+            if len(event.args) == 0:
+                continue
+            if event.command == 'TCH':
+                tch_type = int(event.args[0])
+                if tch_type != 0:
+                    self.tch_records.append({'time': event.time / 1000., 
+                        'tch': tch_type})
+                continue
+            if event.command != 'DBG':
+                continue
+            side = event.args[0][:2]
+            if side not in ('L:', 'R:'):
+                continue
+            c, m, x = event.args[0].split('=')[1:4]
+            self.side2ir_records[side[0]].append({
+                'c': int(c.split(';')[0]), 
+                'm': int(m.split(';')[0]),
+                'x': int(x.split('.')[0]), 
+                'time': event.time / 1000.})
+    
+    def parse_ir_events(self):
+        """Returns DataFrames of the left and right IR debug events, or None"""
+        res = []
+        for side in ['L', 'R']:
+            try:
+                res.append(pandas.DataFrame.from_records(
+                    list(self.side2ir_records[side])).set_index('time'))
+            except KeyError:
+                res.append(None)
+        return res
+    
+    def update(self, logfile_lines, ir_records=None, event_recorder=None):
+        """Plot the IR values and touches.
+        
+        ir_records : if not None, the 'IR' records of a Chatter with
+            binary_frames, from TrialSpeak.read_binary_records. These are
+            plotted instead of parsing the "DBG L:" and "DBG R:" lines.
+        event_recorder : if not None, a chat.DeviceEventRecorder subscribed
+            to DBG and TCH on Chatter.event_bus. Only the events it 
+            received since the last update are parsed, instead of 
+            searching `logfile_lines`.
+        """
+        if event_recorder is not None:
+            self.parse_new_events(event_recorder)
+        
+        if ir_records is None and event_recorder is not None:
+            l_resdf, r_resdf = self.parse_ir_events()
+        elif ir_records is None:
+            l_resdf, r_resdf = self.parse_ir_lines(logfile_lines)
+        elif len(ir_records) == 0:
+            l_resdf, r_resdf = None, None
+        else:
+            times = ir_records['time'] / 1000.
+            l_resdf = pandas.DataFrame({'c': ir_records['l_c'], 
+                'm': ir_records['l_m'], 'x': ir_records['l_x']}, index=times)
+            r_resdf = pandas.DataFrame({'c': ir_records['r_c'], 
+                'm': ir_records['r_m'], 'x': ir_records['r_x']}, index=times)
 
         # Extact touches
         tch_rec_l = []
-        lick_lines = filter(lambda l: 'TCH' in l, logfile_lines)
-        for line in lick_lines:
-            tch_type = int(line.split()[2])
-            if tch_type == 0:
-                continue
-            else:
-                tch_rec_l.append({'time': int(line.split()[0]) / 1000., 
-                    'tch': tch_type})
+        if event_recorder is not None:
+            tch_rec_l = list(self.tch_records)
+        else:
+            lick_lines = filter(lambda l: 'TCH' in l, logfile_lines)
+            for line in lick_lines:
+                tch_type = int(line.split()[2])
+                if tch_type == 0:
+                    continue
+                else:
+                    tch_rec_l.append({'time': int(line.split()[0]) / 1000., 
+                        'tch': tch_type})
         try:
             tch_resdf = pandas.DataFrame.from_records(tch_rec_l).set_index('time')
         except KeyError:
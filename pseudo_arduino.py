@@ -0,0 +1,956 @@
+"""Emulates an Arduino running the TwoChoice protocol on a pseudo-terminal.
+
+This lets chat.Chatter, TrialSetter, the UI and the plotters be run and
+benchmarked without any hardware. The emulator opens a pty pair and
+speaks TrialSpeak on it the way TwoChoice.ino does: it ACKs every
+received line, releases trials, announces state changes, reports trial
+parameters and results, and emits touch (TCH) lines, events (EV) and
+debug lines.
+
+Usage:
+    emulator = pseudo_arduino.TwoChoicePseudoArduino(speedup=10)
+    emulator.start()
+    chatter = chat.Chatter(serial_port=emulator.port_name, ...)
+    ...
+    chatter.close()
+    emulator.close()
+
+Or run this module directly and point `serial_port` in parameters.json at
+the port name that it prints.
+
+ReplayDevice instead plays back a recorded ardulines file, at its
+original pace, faster, or as fast as the host reads, so the host can be
+profiled with the traffic of a real session:
+    python pseudo_arduino.py [speedup|max] [ardulines file]
+
+The emulator keeps the sketch's timing constraints that matter to the
+host: at most one received line is handled per loop, the serial receive
+buffer holds only 64 bytes (anything beyond that is dropped), and
+rewards block the loop for their duration.
+
+The subject is simulated by a response model. This is any callable that
+takes the dict of trial parameters and a random.Random, and returns a list
+of (time, port) licks, where time is in ms from the start of the response
+window and port is LEFT or RIGHT. See RandomResponseModel.
+"""
+import os
+import sys
+import time
+import errno
+import select
+import random
+import struct
+import threading
+try:
+    import pty
+    import tty
+    import fcntl
+except ImportError:
+    # Not available on Windows
+    pty = None
+
+# Monotonic clock if available (Python 3), otherwise wall clock
+get_monotonic_time = getattr(time, 'monotonic', time.time)
+
+# These must match the arduino code. See TrialSpeak and States.h
+LEFT = 1
+RIGHT = 2
+NOGO = 3
+
+OUTCOME_HIT = 1
+OUTCOME_ERROR = 2
+OUTCOME_SPOIL = 3
+
+YES = 3
+NO = 2
+
+# Sizes of the Uno's serial receive buffer and of chat's line buffer
+serial_rx_buffer_size = 64
+chat_receive_buffer_size = 100
+chat_max_tokens = 3
+
+# Type of the IR detector's binary record, as in ir_detector.h
+ir_record_type = ord('I')
+
+def crc16_ccitt(data):
+    """CRC-16/CCITT-FALSE of `data`, as in chat.cpp"""
+    crc = 0xFFFF
+    for byte in bytearray(data):
+        crc ^= byte << 8
+        for bit in range(8):
+            if crc & 0x8000:
+                crc = ((crc << 1) ^ 0x1021) & 0xFFFF
+            else:
+                crc = (crc << 1) & 0xFFFF
+    return crc
+
+def cobs_encode(data):
+    """COBS-encode `data`, which must be shorter than 254 bytes"""
+    res = bytearray([0])
+    code_idx = 0
+    for byte in bytearray(data):
+        if byte == 0:
+            res[code_idx] = len(res) - code_idx
+            code_idx = len(res)
+            res.append(0)
+        else:
+            res.append(byte)
+    res[code_idx] = len(res) - code_idx
+    return bytes(res)
+
+# The states of TwoChoice, in the order of STATE_TYPE in States.h, so
+# that the ST_CHG lines match
+WAIT_TO_START_TRIAL = 0
+TRIAL_START = 1
+ROTATE_STEPPER1 = 2
+INTER_ROTATION_PAUSE = 3
+ROTATE_STEPPER2 = 4
+MOVE_SERVO = 5
+WAIT_FOR_SERVO_MOVE = 6
+RESPONSE_WINDOW = 7
+REWARD_L = 8
+REWARD_R = 9
+POST_REWARD_TIMER_START = 10
+POST_REWARD_TIMER_WAIT = 11
+START_INTER_TRIAL_INTERVAL = 12
+INTER_TRIAL_INTERVAL = 13
+ERROR = 14
+PRE_SERVO_WAIT = 15
+SERVO_WAIT = 16
+POST_REWARD_PAUSE = 17
+
+# Trial parameters, their defaults, and whether they are reported on each
+# trial, as in States.cpp
+twochoice_param_abbrevs = [
+    "STPPOS", "MRT", "RWSD", "SRVPOS", "ITI",
+    "2PSTP", "SRVFAR", "SRVTT", "RWIN", "IRI",
+    "RD_L", "RD_R", "SRVST", "PSW", "TOE",
+    "TO", "STPSPD", "STPFR", "STPIP", "ISRND",
+    "TOUT", "RELT", "STPHAL", "HALPOS", "DIRDEL",
+    "OPTO",
+    ]
+twochoice_param_values = [
+    1, 1, 1, 1, 3000,
+    0, 1900, 4500, 45000, 500,
+    40, 40, 1000, 1, 1,
+    6000, 20, 50, 50, 0,
+    6, 3, 0, 50, 0,
+    0,
+    ]
+twochoice_param_report_ET = [
+    1, 0, 1, 1, 0,
+    0, 0, 0, 0, 0,
+    0, 0, 0, 0, 0,
+    0, 0, 0, 0, 1,
+    0, 0, 0, 0, 1,
+    1,
+    ]
+twochoice_results_abbrevs = ["RESP", "OUTC"]
+
+
+class RandomResponseModel(object):
+    """Simulates a subject that licks one port on most trials.
+    
+    `p_correct` : probability of licking the rewarded side
+    `p_nogo` : probability of not licking at all
+    `latency` : mean time in ms from the start of the response window to
+        the first lick. Latencies are exponentially distributed beyond
+        `min_latency`.
+    `n_licks`, `lick_interval` : each response is a bout of this many licks
+        at this interval (ms)
+    """
+    def __init__(self, p_correct=0.8, p_nogo=0.05, latency=800.,
+        min_latency=150., n_licks=5, lick_interval=150.):
+        self.p_correct = p_correct
+        self.p_nogo = p_nogo
+        self.latency = latency
+        self.min_latency = min_latency
+        self.n_licks = n_licks
+        self.lick_interval = lick_interval
+    
+    def __call__(self, params, rng):
+        """Returns a list of (time, port) licks for a trial with `params`"""
+        rewside = params['RWSD']
+        
+        # Choose which port to lick, if any
+        if rng.random() < self.p_nogo:
+            return []
+        correct = rng.random() < self.p_correct
+        if rewside == NOGO:
+            if correct:
+                return []
+            port = rng.choice([LEFT, RIGHT])
+        elif correct:
+            port = rewside
+        else:
+            port = {LEFT: RIGHT, RIGHT: LEFT}[rewside]
+        
+        # A bout of licks on that port
+        first_lick = self.min_latency + rng.expovariate(
+            1. / max(self.latency - self.min_latency, 1.))
+        return [(first_lick + n * self.lick_interval, port)
+            for n in range(self.n_licks)]
+
+
+class PseudoTimedState(object):
+    """Mirrors TimedState from the arduino libraries.
+    
+    On the first `run`, calls `s_setup` and starts the timer. Afterwards
+    calls `loop` on every `run`, until the timer expires or `flag_stop` is
+    set, at which point `s_finish` is called and the timer is cleared.
+    """
+    def __init__(self, duration, s_setup=None, loop=None, s_finish=None):
+        self.duration = duration
+        self.timer = 0
+        self.flag_stop = False
+        self.time_of_last_call = 0
+        self.s_setup = s_setup
+        self.loop = loop
+        self.s_finish = s_finish
+    
+    def run(self, time):
+        self.time_of_last_call = time
+        if self.timer == 0:
+            if self.s_setup is not None:
+                self.s_setup()
+            self.flag_stop = False
+            self.timer = time + self.duration
+        
+        if self.flag_stop or time >= self.timer:
+            if self.s_finish is not None:
+                self.s_finish()
+            self.timer = 0
+        elif self.loop is not None:
+            self.loop()
+
+
+class PseudoArduino(threading.Thread):
+    """Emulates the chat and TrialSpeak layer of an ArduFSM sketch on a pty.
+    
+    This handles what libraries/chat does for every protocol: buffering
+    received characters, ACKing each line, parsing SET, ACT, BINARY, HELLO and
+    RELEASE_TRL, setting trial parameters, and announcing the time.
+    Protocols derive from this and define `run_states`, and optionally
+    `take_act`.
+    
+    The thread runs the sketch's loop() continuously, once every
+    `loop_period` seconds of real time. The emulated millis() runs
+    `speedup` times faster than real time, so trials take proportionally
+    less time.
+    
+    If `baud_rate` is not None, output to the host takes as long as it
+    would on a serial link at that rate, at 10 bits per byte. Otherwise
+    the pty is as fast as the host can read it.
+    
+    Call `start` to begin, and `close` to stop and close the pty.
+    """
+    def __init__(self, param_abbrevs, param_values, param_report_ET=None,
+        speedup=1.0, loop_period=0.001, seed=None, baud_rate=None):
+        if pty is None:
+            raise ValueError("PseudoArduino requires a Unix-based system")
+        threading.Thread.__init__(self)
+        self.daemon = True
+        
+        self.param_abbrevs = list(param_abbrevs)
+        self.param_values = list(param_values)
+        if param_report_ET is None:
+            param_report_ET = [1] * len(self.param_abbrevs)
+        self.param_report_ET = list(param_report_ET)
+        self.speedup = speedup
+        self.loop_period = loop_period
+        self.rng = random.Random(seed)
+        self.baud_rate = baud_rate
+        self.tx_free_time = 0.
+        
+        ## Open the pty
+        # The host opens the slave, by name, as a serial port
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        fcntl.fcntl(self.master, fcntl.F_SETFL,
+            fcntl.fcntl(self.master, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.port_name = os.ttyname(self.slave)
+        
+        # State of the chat library
+        self.serial_rx_buffer = b''
+        self.receive_buffer = b''
+        self.flag_start_trial = False
+        self.speak_at = 1000
+        self.interval = 1000
+        self.in_setup = True
+        self.binary_mode = False
+        
+        # Lines waiting to be written to the host
+        self.output_lines = []
+        
+        # Statistics
+        self.n_lines_received = 0
+        self.n_lines_written = 0
+        self.n_bytes_written = 0
+        self.n_rx_bytes_dropped = 0
+        
+        self.start_time = get_monotonic_time()
+        self.stop_event = threading.Event()
+    
+    ## Timing
+    def millis(self):
+        """Emulated milliseconds since start"""
+        return int((get_monotonic_time() - self.start_time) * 1000. *
+            self.speedup)
+    
+    def delay(self, ms):
+        """Block the loop for `ms` emulated milliseconds"""
+        self.flush_output()
+        time.sleep(ms / 1000. / self.speedup)
+    
+    ## Writing to the host
+    def println(self, line):
+        """Queue `line` for the host. It is sent at the end of the loop."""
+        self.output_lines.append(line + '\r\n')
+    
+    def flush_output(self):
+        """Write the queued lines to the host.
+        
+        Like Serial.print, this blocks while the host is not reading.
+        """
+        if len(self.output_lines) == 0:
+            return
+        data = b''.join([line if isinstance(line, bytes) 
+            else line.encode('ascii') for line in self.output_lines])
+        self.n_lines_written += len(self.output_lines)
+        self.n_bytes_written += len(data)
+        self.output_lines = []
+        n_bytes = len(data)
+        
+        while len(data) > 0 and not self.stop_event.is_set():
+            try:
+                n_written = os.write(self.master, data)
+            except OSError as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+                select.select([], [self.master], [], self.loop_period)
+                continue
+            data = data[n_written:]
+        
+        # Block until the link would have finished sending it
+        if self.baud_rate is not None:
+            now = get_monotonic_time()
+            self.tx_free_time = max(now, self.tx_free_time) + (
+                n_bytes * 10. / self.baud_rate)
+            if self.tx_free_time > now:
+                time.sleep(self.tx_free_time - now)
+    
+    def write_binary_record(self, record_type, time, fields):
+        """Queue a binary record for the host, as send_binary_record does"""
+        record = struct.pack('<BI%dh' % len(fields), record_type, 
+            time & 0xFFFFFFFF, *fields)
+        record += struct.pack('<H', crc16_ccitt(record))
+        self.output_lines.append(b'\0' + cobs_encode(record) + b'\0')
+    
+    ## Receiving from the host, as in libraries/chat
+    def read_serial(self):
+        """Move bytes from the pty into the emulated serial buffer.
+        
+        Bytes that do not fit into the buffer are dropped, as on the Uno.
+        """
+        while True:
+            try:
+                data = os.read(self.master, 1024)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EIO):
+                    return
+                raise
+            if len(data) == 0:
+                return
+            
+            room = serial_rx_buffer_size - 1 - len(self.serial_rx_buffer)
+            if len(data) > room:
+                self.n_rx_bytes_dropped += len(data) - max(room, 0)
+                data = data[:max(room, 0)]
+            self.serial_rx_buffer += data
+    
+    def receive_chat(self):
+        """Returns the next received line, or None.
+        
+        Like receive_chat in chat.cpp, this consumes characters only up to
+        the end of the first line, and ACKs that line.
+        """
+        line = None
+        while len(self.serial_rx_buffer) > 0:
+            got = self.serial_rx_buffer[:1]
+            self.serial_rx_buffer = self.serial_rx_buffer[1:]
+            
+            # Error if overflow
+            if len(self.receive_buffer) >= chat_receive_buffer_size - 1:
+                if got != b'\n':
+                    self.println("ERR truncating buf overflow")
+                    got = b'\n'
+            
+            self.receive_buffer += got
+            if got == b'\n':
+                line = self.receive_buffer.decode('ascii', 'replace')
+                self.receive_buffer = b''
+                break
+        
+        if line is not None:
+            # The line still ends with its newline
+            self.n_lines_received += 1
+            self.output_lines.append("%d ACK %s" % (self.millis(), line))
+        return line
+    
+    def communications(self, time):
+        """Announce the time, and handle at most one received line"""
+        if time >= self.speak_at:
+            self.println("%d DBG" % time)
+            self.speak_at += self.interval
+        
+        received_chat = self.receive_chat()
+        if received_chat is None:
+            return
+        
+        status = self.handle_chat(received_chat)
+        if status != 0:
+            self.println("%d DBG RC_ERR %d" % (time, status))
+    
+    def handle_chat(self, received_chat):
+        """Parse a received line and act on it. Returns a chat.cpp status.
+        
+        0 - command parsed successfully
+        1 - command contained no tokens or was empty
+        2 - unimplemented command (first word)
+        3 - syntax error: number of words did not match command
+        4 - too many tokens
+        """
+        strs = received_chat.split()
+        if len(strs) == 0:
+            return 1
+        if len(strs) > chat_max_tokens:
+            return 4
+        
+        if strs[0] == 'SET':
+            if len(strs) != 3:
+                return 3
+            return self.take_action('SET', strs[1], strs[2])
+        elif strs[0] == 'RELEASE_TRL':
+            if len(strs) != 1:
+                return 3
+            self.flag_start_trial = True
+            return 0
+        elif strs[0] == 'BINARY':
+            if len(strs) != 2:
+                return 3
+            self.binary_mode = strs[1] != '0'
+            return 0
+        elif strs[0] == 'HELLO':
+            if len(strs) != 1:
+                return 3
+            self.println("%d HELLO" % self.millis())
+            return 0
+        elif strs[0] == 'ACT':
+            if len(strs) not in (2, 3):
+                return 3
+            return self.take_action('ACT', *strs[1:])
+        return 2
+    
+    def take_action(self, protocol_cmd, argument1, argument2=''):
+        """Set a parameter, or run an asynchronous action.
+        
+        Errors are announced as TA_ERR, and do not count as chat errors.
+        """
+        time = self.millis()
+        status = 0
+        if protocol_cmd == 'SET':
+            if argument1 not in self.param_abbrevs:
+                self.println("ERR param not found %s" % argument1)
+                status = 4
+            else:
+                try:
+                    value = int(argument2)
+                except ValueError:
+                    self.println("ERR SIC cannot parse -%s-" % argument2)
+                    self.println("ERR can't set var")
+                    status = 5
+                else:
+                    self.param_values[
+                        self.param_abbrevs.index(argument1)] = value
+        elif protocol_cmd == 'ACT':
+            if not self.take_act(argument1):
+                status = 6
+        
+        if status != 0:
+            self.println("%d DBG TA_ERR %d" % (time, status))
+        return 0
+    
+    def take_act(self, action):
+        """Run asynchronous `action`. Returns False if it is unknown."""
+        return False
+    
+    def get_param(self, abbrev):
+        return self.param_values[self.param_abbrevs.index(abbrev)]
+    
+    def get_params(self):
+        """Returns a dict of the current trial parameters"""
+        return dict(zip(self.param_abbrevs, self.param_values))
+    
+    ## Running
+    def setup(self):
+        self.println("%d DBG begin setup" % self.millis())
+    
+    def loop(self):
+        """One pass of the sketch's loop()"""
+        time = self.millis()
+        self.read_serial()
+        self.communications(time)
+        
+        # Like setup(), wait for the first trial release before running
+        # the state machine
+        if self.in_setup:
+            if not self.flag_start_trial:
+                return
+            self.in_setup = False
+        
+        self.run_states(time)
+    
+    def run_states(self, time):
+        """Run the protocol's state machine. Defined by each protocol."""
+        pass
+    
+    def run(self):
+        self.setup()
+        self.flush_output()
+        while not self.stop_event.is_set():
+            self.loop()
+            self.flush_output()
+            
+            # Wait for the next loop, waking early if the host writes
+            select.select([self.master], [], [], self.loop_period)
+    
+    def get_stats(self):
+        """Returns a dict of line and byte counts"""
+        return {
+            'n_lines_received': self.n_lines_received,
+            'n_lines_written': self.n_lines_written,
+            'n_bytes_written': self.n_bytes_written,
+            'n_rx_bytes_dropped': self.n_rx_bytes_dropped,
+            }
+    
+    def close(self):
+        """Stop the thread, if running, and close the pty"""
+        self.stop_event.set()
+        if self.is_alive():
+            self.join()
+        os.close(self.master)
+        os.close(self.slave)
+
+
+class TwoChoicePseudoArduino(PseudoArduino):
+    """Emulates TwoChoice.ino.
+    
+    `response_model` : simulates the subject's licks on each trial.
+        Defaults to RandomResponseModel().
+    `lick_duration` : how long (ms) each lick touches the port
+    `ir_detector` : if True, emit the "DBG L:" and "DBG R:" lines of the
+        IR lick detector every `ir_debug_interval` ms, or its binary 
+        record after "BINARY 1"
+    `param_values` : overrides for the defaults of the trial parameters
+    
+    See PseudoArduino for `speedup`, `loop_period` and `seed`.
+    """
+    def __init__(self, response_model=None, lick_duration=40,
+        ir_detector=False, ir_debug_interval=500, param_values=None,
+        **kwargs):
+        PseudoArduino.__init__(self, twochoice_param_abbrevs,
+            twochoice_param_values, twochoice_param_report_ET, **kwargs)
+        if param_values is not None:
+            for abbrev, value in param_values.items():
+                self.param_values[self.param_abbrevs.index(abbrev)] = value
+        
+        if response_model is None:
+            response_model = RandomResponseModel()
+        self.response_model = response_model
+        self.lick_duration = lick_duration
+        self.ir_detector = ir_detector
+        self.ir_debug_interval = ir_debug_interval
+        self.next_ir_debug_time = 0
+        
+        # State machine
+        self.current_state = WAIT_TO_START_TRIAL
+        self.next_state = WAIT_TO_START_TRIAL
+        self.results = {'RESP': 0, 'OUTC': 0}
+        self.sticky_touched = 0
+        self.licks = []
+        self.rewards_this_trial = 0
+        self.direct_delivery_delivered = False
+        self.make_states()
+        
+        # Statistics
+        self.n_trials = 0
+    
+    def make_states(self):
+        """Create the timed states afresh, as at the start of each trial"""
+        self.state_interrotation_pause = PseudoTimedState(50,
+            s_finish=lambda: self.set_next_state(ROTATE_STEPPER2))
+        self.state_wait_for_servo_move = PseudoTimedState(
+            self.get_param('SRVTT'), loop=self.loop_wait_for_servo_move,
+            s_finish=lambda: self.set_next_state(RESPONSE_WINDOW))
+        self.state_response_window = PseudoTimedState(
+            self.get_param('RWIN'), s_setup=self.setup_response_window,
+            loop=self.loop_response_window,
+            s_finish=self.finish_response_window)
+        self.state_post_reward_pause = PseudoTimedState(
+            self.get_param('IRI'),
+            s_finish=lambda: self.set_next_state(RESPONSE_WINDOW))
+        self.state_error_timeout = PseudoTimedState(self.get_param('TO'),
+            s_finish=lambda: self.set_next_state(INTER_TRIAL_INTERVAL))
+        self.state_inter_trial_interval = PseudoTimedState(
+            self.get_param('ITI'), s_setup=self.report_results,
+            s_finish=lambda: self.set_next_state(WAIT_TO_START_TRIAL))
+    
+    def set_next_state(self, state):
+        self.next_state = state
+    
+    ## Subject
+    def poll_touch_inputs(self, time):
+        """Returns the touched bitmask: 1 for left, 2 for right"""
+        touched = 0
+        for lick_time, port in self.licks:
+            if lick_time <= time < lick_time + self.lick_duration:
+                touched |= {LEFT: 1, RIGHT: 2}[port]
+        return touched
+    
+    def announce_ir_detector(self, time):
+        """Fake the debugging output of the IR lick detector"""
+        if self.binary_mode:
+            self.write_binary_record(ir_record_type, time, [
+                self.rng.randint(500, 520), 510, self.rng.randint(490, 500),
+                self.rng.randint(500, 520), 510, self.rng.randint(490, 500)])
+            return
+        for side in ['L', 'R']:
+            self.println("%d DBG %s:c=%d;m=%d;x=%d." % (time, side,
+                self.rng.randint(500, 520), 510, self.rng.randint(490, 500)))
+    
+    ## States
+    def loop_wait_for_servo_move(self):
+        """Direct delivery of water, 500ms before the servo arrives"""
+        state = self.state_wait_for_servo_move
+        if (self.get_param('DIRDEL') == NO or
+            self.direct_delivery_delivered):
+            return
+        if state.time_of_last_call - state.timer > -500:
+            rewside = self.get_param('RWSD')
+            if rewside == LEFT:
+                self.println("%d EV DDR_L" % state.time_of_last_call)
+                self.delay(self.get_param('RD_L'))
+            elif rewside == RIGHT:
+                self.println("%d EV DDR_R" % state.time_of_last_call)
+                self.delay(self.get_param('RD_R'))
+            self.direct_delivery_delivered = True
+    
+    def setup_response_window(self):
+        """Ask the subject what it will do on this trial"""
+        start = self.state_response_window.time_of_last_call
+        self.licks = [(start + lick_time, port) for lick_time, port in
+            self.response_model(self.get_params(), self.rng)]
+    
+    def loop_response_window(self):
+        """Respond to licks, as StateResponseWindow::loop"""
+        state = self.state_response_window
+        rewside = self.get_param('RWSD')
+        
+        # Transition if max rewards reached
+        if self.rewards_this_trial >= self.get_param('MRT'):
+            self.next_state = INTER_TRIAL_INTERVAL
+            state.flag_stop = True
+            return
+        
+        licking_l = bool(self.sticky_touched & 1)
+        licking_r = bool(self.sticky_touched & 2)
+        if licking_l == licking_r:
+            return
+        current_response = LEFT if licking_l else RIGHT
+        
+        # Only assign result if this is the first response
+        if self.results['RESP'] == 0:
+            self.results['RESP'] = current_response
+        
+        if current_response == rewside:
+            self.next_state = {LEFT: REWARD_L, RIGHT: REWARD_R}[rewside]
+            self.rewards_this_trial += 1
+            self.results['OUTC'] = OUTCOME_HIT
+        elif self.get_param('TOE') == NO:
+            pass
+        else:
+            self.next_state = ERROR
+            if rewside == NOGO and current_response == LEFT:
+                self.results['OUTC'] = OUTCOME_SPOIL
+            else:
+                self.results['OUTC'] = OUTCOME_ERROR
+    
+    def finish_response_window(self):
+        """If the subject never responded, this was a nogo response"""
+        if self.results['RESP'] == 0:
+            self.results['RESP'] = NOGO
+            if self.get_param('RWSD') == NOGO:
+                self.results['OUTC'] = OUTCOME_HIT
+            else:
+                self.results['OUTC'] = OUTCOME_SPOIL
+        self.next_state = INTER_TRIAL_INTERVAL
+    
+    def report_results(self):
+        time = self.state_inter_trial_interval.time_of_last_call
+        for abbrev in twochoice_results_abbrevs:
+            self.println("%d TRLR %s %d" % (time, abbrev, self.results[abbrev]))
+        self.n_trials += 1
+    
+    def start_trial(self, time):
+        """Announce the trial parameters and reset for the new trial"""
+        self.println("%d TRL_START" % time)
+        for abbrev, value, report in zip(self.param_abbrevs,
+            self.param_values, self.param_report_ET):
+            if report:
+                self.println("%d TRLP %s %d" % (time, abbrev, value))
+        
+        self.results = {'RESP': 0, 'OUTC': 0}
+        self.licks = []
+        self.rewards_this_trial = 0
+        self.direct_delivery_delivered = False
+        self.make_states()
+    
+    def run_states(self, time):
+        self.next_state = self.current_state
+        
+        # Announce changes in touch
+        touched = self.poll_touch_inputs(time)
+        if touched != self.sticky_touched:
+            self.println("%d TCH %d" % (time, touched))
+            self.sticky_touched = touched
+        
+        if self.ir_detector and time >= self.next_ir_debug_time:
+            self.announce_ir_detector(time)
+            self.next_ir_debug_time = time + self.ir_debug_interval
+        
+        state = self.current_state
+        if state == WAIT_TO_START_TRIAL:
+            if self.flag_start_trial:
+                self.println("%d TRL_RELEASED" % time)
+                self.flag_start_trial = False
+                self.next_state = TRIAL_START
+        elif state == TRIAL_START:
+            self.start_trial(time)
+            self.next_state = ROTATE_STEPPER1
+        elif state == ROTATE_STEPPER1:
+            self.next_state = INTER_ROTATION_PAUSE
+        elif state == INTER_ROTATION_PAUSE:
+            self.state_interrotation_pause.run(time)
+        elif state == ROTATE_STEPPER2:
+            self.next_state = MOVE_SERVO
+        elif state in (MOVE_SERVO, WAIT_FOR_SERVO_MOVE):
+            self.state_wait_for_servo_move.run(time)
+        elif state == RESPONSE_WINDOW:
+            self.state_response_window.run(time)
+        elif state == REWARD_L:
+            self.println("%d EV R_L" % time)
+            self.delay(self.get_param('RD_L'))
+            self.next_state = POST_REWARD_PAUSE
+        elif state == REWARD_R:
+            self.println("%d EV R_R" % time)
+            self.delay(self.get_param('RD_R'))
+            self.next_state = POST_REWARD_PAUSE
+        elif state == POST_REWARD_PAUSE:
+            self.state_post_reward_pause.run(time)
+        elif state == ERROR:
+            self.state_error_timeout.run(time)
+        elif state == INTER_TRIAL_INTERVAL:
+            self.state_inter_trial_interval.run(time)
+        
+        if self.next_state != self.current_state:
+            self.println("%d ST_CHG %d %d" % (
+                time, self.current_state, self.next_state))
+            self.println("%d ST_CHG2 %d %d" % (
+                self.millis(), self.current_state, self.next_state))
+        self.current_state = self.next_state
+    
+    def take_act(self, action):
+        """The asynchronous actions of TwoChoice.ino"""
+        time = self.millis()
+        if action == 'REWARD':
+            action = {LEFT: 'REWARD_L', RIGHT: 'REWARD_R'}.get(
+                self.get_param('RWSD'))
+            if action is None:
+                self.println("ERR unknown rewside")
+                return True
+        
+        if action == 'REWARD_L':
+            self.println("%d EV AAR_L" % time)
+            self.delay(self.get_param('RD_L'))
+        elif action == 'REWARD_R':
+            self.println("%d EV AAR_R" % time)
+            self.delay(self.get_param('RD_R'))
+        elif action == 'THRESH':
+            self.println("%d EV AAST" % time)
+        elif action == 'HLON':
+            self.println("%d EV HLON" % time)
+        else:
+            return False
+        return True
+    
+    def get_stats(self):
+        res = PseudoArduino.get_stats(self)
+        res['n_trials'] = self.n_trials
+        return res
+
+
+class ReplayDevice(PseudoArduino):
+    """Plays back a recorded session on a pty, as the device sent it.
+    
+    `lines` : the lines of an ardulines file, eg from 
+        TrialSpeak.read_lines_from_file
+    `speedup` : play back this many times faster than real time. If None,
+        play back as fast as the host reads.
+    `replay_acks` : if False, the recorded ACK lines are not played back,
+        because they acknowledged what the original host sent.
+    `max_lines_per_loop` : at most this many lines are sent on each loop,
+        so that writes from the host are still ACKed promptly when
+        playing back as fast as possible
+    
+    Each line is sent when the emulated millis() reaches its timestamp, so
+    the time between lines is as recorded. Lines without a timestamp are
+    sent with the line before them. If the timestamps go backwards (eg, 
+    the device was reset), the rest are shifted to follow on.
+    
+    Nothing is played back until the host sends its first line (eg, 
+    HELLO from chat.wait_for_device_ready), so that the start of the
+    session is not discarded when the host opens the port and flushes 
+    its input. The recording's clock starts then too.
+    
+    Lines from the host are ACKed, and HELLO is answered, as chat.cpp 
+    does, but they are otherwise ignored: the session plays out as it was
+    recorded. `finished` is set once every line has been sent.
+    
+    Usage:
+        lines = TrialSpeak.read_lines_from_file(filename)
+        device = pseudo_arduino.ReplayDevice(lines, speedup=10)
+        device.start()
+        chatter = chat.Chatter(serial_port=device.port_name, ...)
+    """
+    def __init__(self, lines, speedup=1.0, replay_acks=False, 
+        max_lines_per_loop=100, loop_period=0.001, baud_rate=None):
+        PseudoArduino.__init__(self, [], [], loop_period=loop_period,
+            baud_rate=baud_rate)
+        self.speedup = speedup
+        self.max_lines_per_loop = max_lines_per_loop
+        
+        # When to send each line, in the emulated millis()
+        self.lines = []
+        self.line_times = []
+        time_offset = 0
+        last_time = None
+        for line in lines:
+            sp_line = line.split(None, 2)
+            if not replay_acks and len(sp_line) > 1 and sp_line[1] == 'ACK':
+                continue
+            try:
+                line_time = int(sp_line[0]) + time_offset
+            except (IndexError, ValueError):
+                line_time = last_time
+            if line_time is None:
+                line_time = 0
+            elif last_time is not None and line_time < last_time:
+                time_offset += last_time - line_time
+                line_time = last_time
+            
+            if not line.endswith('\n'):
+                line = line + '\r\n'
+            self.lines.append(line)
+            self.line_times.append(line_time)
+            last_time = line_time
+        
+        # Where we are in the session
+        self.first_time = self.line_times[0] if len(self.lines) > 0 else 0
+        self.replay_time = self.first_time
+        self.n_lines_replayed = 0
+        self.host_connected = False
+        self.finished = threading.Event()
+    
+    def millis(self):
+        """Emulated milliseconds, on the recording's clock"""
+        if self.speedup is None:
+            return self.replay_time
+        return self.first_time + int((get_monotonic_time() - 
+            self.start_time) * 1000. * self.speedup)
+    
+    def setup(self):
+        """The recorded session includes its own setup"""
+        pass
+    
+    def loop(self):
+        """ACK at most one line from the host, and send the lines due.
+        
+        Until the host has sent a line, nothing is sent.
+        """
+        # The recording's clock is held at its start until then
+        if not self.host_connected:
+            self.start_time = get_monotonic_time()
+        
+        self.read_serial()
+        received_chat = self.receive_chat()
+        if received_chat is None and not self.host_connected:
+            return
+        if received_chat is not None:
+            self.host_connected = True
+            if received_chat.split() == ['HELLO']:
+                # Stamped so as not to run ahead of the next line
+                self.println("%d HELLO" % self.replay_time)
+        
+        now = self.millis()
+        n_lines = 0
+        while (self.n_lines_replayed < len(self.lines) and 
+            n_lines < self.max_lines_per_loop):
+            line_time = self.line_times[self.n_lines_replayed]
+            if self.speedup is not None and line_time > now:
+                break
+            self.output_lines.append(self.lines[self.n_lines_replayed])
+            self.replay_time = line_time
+            self.n_lines_replayed += 1
+            n_lines += 1
+        
+        if self.n_lines_replayed == len(self.lines):
+            self.finished.set()
+    
+    def get_stats(self):
+        """Returns a dict of line and byte counts, and playback progress"""
+        stats = PseudoArduino.get_stats(self)
+        stats['n_lines_replayed'] = self.n_lines_replayed
+        stats['n_lines_to_replay'] = len(self.lines)
+        stats['replay_time'] = self.replay_time
+        stats['host_connected'] = self.host_connected
+        return stats
+
+
+if __name__ == '__main__':
+    # Run an emulator, or replay an ardulines file, until CTRL+C
+    speedup = 1.0
+    if len(sys.argv) > 1:
+        if sys.argv[1] == 'max':
+            # Only playback can run as fast as the host reads
+            if len(sys.argv) < 3:
+                sys.exit("'max' requires an ardulines file to replay")
+            speedup = None
+        else:
+            speedup = float(sys.argv[1])
+    if len(sys.argv) > 2:
+        import TrialSpeak
+        emulator = ReplayDevice(TrialSpeak.read_lines_from_file(sys.argv[2]),
+            speedup=speedup)
+        emulator.start()
+        print("Replaying %s on %s" % (sys.argv[2], emulator.port_name))
+    else:
+        emulator = TwoChoicePseudoArduino(speedup=speedup)
+        emulator.start()
+        print("Emulating TwoChoice on %s" % emulator.port_name)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        print("Keyboard interrupt received")
+    finally:
+        emulator.close()
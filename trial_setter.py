@@ -43,6 +43,10 @@ class TrialSetter:
         self.params_table = params_table
         self.scheduler = scheduler
         self.last_released_trial = -1
+        
+        # Build the trial matrix incrementally from the lines not yet parsed
+        self.trial_matrix_builder = TrialSpeak.IncrementalTrialMatrix()
+        self.n_logfile_lines_parsed = 0
     
     def send_initial_params_when_ready(self, splines):
         """Sends initial params at the right time
@@ -92,12 +96,14 @@ class TrialSetter:
         # Now we know that the Arduino has booted up and that the initial
         # params have been sent.
         # Construct trial_matrix
+        # Only the lines that have arrived since the last call are parsed.
+        # This assumes that logfile_lines is only ever appended to.
         #trial_matrix = TrialMatrix.make_trials_info_from_splines(splines)
-        trial_matrix = TrialSpeak.make_trials_matrix_from_logfile_lines2(logfile_lines)
-        current_trial = len(trial_matrix) - 1
-        
-        # Translate
-        translated_trial_matrix = TrialSpeak.translate_trial_matrix(trial_matrix)
+        #trial_matrix = TrialSpeak.make_trials_matrix_from_logfile_lines2(logfile_lines)
+        new_lines = logfile_lines[self.n_logfile_lines_parsed:]
+        self.n_logfile_lines_parsed = len(logfile_lines)
+        translated_trial_matrix = self.trial_matrix_builder.update(new_lines)
+        current_trial = len(translated_trial_matrix) - 1
         
         ## Trial releasing logic
         # Was the last released trial the current one or the next one?
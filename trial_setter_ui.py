@@ -33,21 +33,23 @@ class UIActionTaker:
         self.ui = ui
         self.chatter = chatter
     
+    # Operator actions use the urgent lane so that they are not stuck
+    # behind a parameter upload
     def ui_action_house_light_on(self):
-        self.chatter.queued_write_to_device('ACT HLON')
+        self.chatter.queued_write_to_device('ACT HLON', lane='urgent')
     
     def ui_action_reward_l(self):
         # these tokens should be in TrialSpeak
-        self.chatter.queued_write_to_device('ACT REWARD_L')
+        self.chatter.queued_write_to_device('ACT REWARD_L', lane='urgent')
 
     def ui_action_reward_r(self):
-        self.chatter.queued_write_to_device('ACT REWARD_R')
+        self.chatter.queued_write_to_device('ACT REWARD_R', lane='urgent')
 
     def ui_action_reward_current(self):
-        self.chatter.queued_write_to_device('ACT REWARD')
+        self.chatter.queued_write_to_device('ACT REWARD', lane='urgent')
     
     def ui_action_threshold(self):
-        self.chatter.queued_write_to_device('ACT THRESH')
+        self.chatter.queued_write_to_device('ACT THRESH', lane='urgent')
 
     def ui_action_save(self):
         """No longer does anything because this is now handled by TwoChoice.py